@@ -252,8 +252,9 @@ def demo_page():
                 st.session_state.conversation_start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
             add_message("Doctor", doctor_message)
-            with st.spinner("Patient agent is generating a response..."):
-                patient_response = st.session_state.patient_agent.inference(doctor_message)
+            # Show the reply while it is generated; the agent keeps the cleaned-up answer in its history
+            st.write_stream(st.session_state.patient_agent.inference_stream(doctor_message))
+            patient_response = st.session_state.patient_agent.messages[-1]["content"]
 
             add_message("Patient", patient_response)
             st.rerun()
@@ -1,12 +1,18 @@
 import os
+import re
+import uuid
 import logging
 
-from utils import file_to_string, prompt_valid_check
-from models import get_response_method, vllm_model_setup, get_answer, get_token_log
+from utils import file_to_string, prompt_valid_check, TerminationDetector
+from models import get_response_method, get_stream_method, get_async_response_method, get_answer, get_token_log
+from llm_client.registry import resolve_model
+
+# Sentences of the system prompt that mention the turn counter; moved to the newest user message in prefix-stable mode
+TURN_COUNTER_PATTERN = re.compile(r"[^.\n]*\{(?:curr_idx|remain_idx)\}[^.\n]*\.[ \t]*")
 
 
 class DoctorAgent:
-    def __init__(self, max_infs=15, top_k_diagnosis=5, backend_str="gpt4", backend_api_type="gpt_azure",  prompt_dir=None, prompt_file=None, patient_info=None, client_params=None, verbose=False) -> None:
+    def __init__(self, max_infs=15, top_k_diagnosis=5, backend_str="gpt4", backend_api_type="gpt_azure",  prompt_dir=None, prompt_file=None, patient_info=None, client_params=None, prefix_stable=False, stop_at_ddx=False, verbose=False) -> None:
         self.prompt_dir = prompt_dir
         self.prompt_file = prompt_file
         self.infs = 0  # number of inference calls to the doctor
@@ -17,15 +23,25 @@ class DoctorAgent:
         self.patient_info = patient_info if patient_info is not None else {}
         self.client_params = client_params if client_params is not None else {}
         self.verbose = verbose
+        # prefix_stable: keep the system prompt byte-identical across turns (so vLLM / provider prompt caching can reuse the
+        # whole history) and give the turn counter in the newest user message instead
+        self.prefix_stable = prefix_stable
+        # stop_at_ddx: end a streamed reply once its differential diagnosis list is complete (the rest is not generated)
+        self.stop_at_ddx = stop_at_ddx
         
         self.client = get_response_method(self.backend_api_type)
-        self.model = vllm_model_setup(self.backend) if self.backend_api_type == "vllm" else self.backend
+        self.stream_client = get_stream_method(self.backend_api_type)
+        self.async_client = get_async_response_method(self.backend_api_type)
+        self.model = resolve_model(self.backend)
 
         if verbose:
             logging.info(f"Setting doctor agent with backend: {self.model} ({self.backend_api_type})")
 
         # Load prompt text file
         self.system_prompt_text = file_to_string(os.path.join(self.prompt_dir, self.prompt_file + ".txt"))
+        self.turn_counter_text = " ".join(sentence.strip() for sentence in TURN_COUNTER_PATTERN.findall(self.system_prompt_text))
+        if self.prefix_stable:
+            self.system_prompt_text = TURN_COUNTER_PATTERN.sub("", self.system_prompt_text).rstrip()
 
         # prepare initial conditions for LLM
         self.doctor_greet = "Hello, how can I help you?"
@@ -44,7 +60,13 @@ class DoctorAgent:
     def reset(self) -> None:
         system_message = {"role": "system", "content": self.system_prompt()}
         self.messages = [system_message]
+        self.session = uuid.uuid4().hex  # conversation id: routes the whole dialogue to the same vLLM replica
         self.token_log = {"prompt_tokens": [], "completion_tokens": [], "total_tokens": [], "extra_info": {}}
+        self.fallback_log = []  # replies that came from the fallback backend while the circuit of this agent's backend was open
+
+    def log_fallback(self, call_info) -> None:
+        if call_info:
+            self.fallback_log.append({"turn": len(self.token_log["total_tokens"]), **call_info})
 
     def log_token_usage(self, response) -> None:
         token_usage = get_token_log(response)
@@ -58,17 +80,65 @@ class DoctorAgent:
                 else:
                     self.token_log["extra_info"][key].append(value)
 
+    def add_question(self, question) -> None:
+        if self.prefix_stable and self.turn_counter_text:
+            turn_counter = self.turn_counter_text.format(curr_idx=self.infs, remain_idx=self.max_infs - self.infs)
+            self.messages.append({"role": "user", "content": f"{question}\n\n({turn_counter})"})
+        else:
+            self.messages[0]["content"] = self.system_prompt()  # update current turns
+            self.messages.append({"role": "user", "content": f"{question}"})
+
+    def add_answer(self, response, call_info) -> str:
+        answer = get_answer(response)
+        self.log_token_usage(response)
+        self.log_fallback(call_info)
+        self.messages.append({"role": "assistant", "content": f"{answer}"})
+        return answer
+
     def inference(self, question) -> str:
-        answer = str()
         if self.infs >= self.max_infs:
             return "Maximum inferences reached"
         self.infs += 1
-        self.messages[0]["content"] = self.system_prompt()  # update current turns
-        self.messages.append({"role": "user", "content": f"{question}"})
+        self.add_question(question)
 
-        response = self.client(self.messages, model=self.model, **self.client_params)
-        answer = get_answer(response)
-        self.log_token_usage(response)
+        call_info = {}
+        response = self.client(self.messages, model=self.model, caller="doctor", session=self.session, call_info=call_info, **self.client_params)
+        return self.add_answer(response, call_info)
+
+    async def ainference(self, question) -> str:
+        # inference() on the async client, so many dialogues can be stepped together on one event loop
+        if self.infs >= self.max_infs:
+            return "Maximum inferences reached"
+        self.infs += 1
+        self.add_question(question)
+
+        call_info = {}
+        response = await self.async_client(self.messages, model=self.model, caller="doctor", session=self.session, call_info=call_info, **self.client_params)
+        return self.add_answer(response, call_info)
+
+    def inference_stream(self, question):
+        # Yields the reply as text deltas; the final answer is added to the history (and returned) once the stream ends
+        if self.infs >= self.max_infs:
+            yield "Maximum inferences reached"
+            return "Maximum inferences reached"
+        self.infs += 1
+        self.add_question(question)
+
+        call_info = {}
+        detector = TerminationDetector(self.top_k_diagnosis)
+        stream = self.stream_client(self.messages, model=self.model, caller="doctor", session=self.session, call_info=call_info, **self.client_params)
+        try:
+            for delta in stream:
+                yield delta
+                if self.stop_at_ddx and detector.feed(delta):
+                    break  # the DDX list is complete: stop generating (the usage is estimated from the text received)
+        finally:
+            stream.close()
+        answer = get_answer(stream.response)
+        if detector.complete:
+            answer = answer.rstrip()
+        self.log_token_usage(stream.response)
+        self.log_fallback(call_info)
         self.messages.append({"role": "assistant", "content": f"{answer}"})
         return answer
 
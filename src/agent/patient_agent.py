@@ -1,9 +1,11 @@
 import os
+import uuid
 import json
 import logging
 
 from utils import file_to_string, prompt_valid_check, process_string
-from models import get_response_method, vllm_model_setup, get_answer, get_token_log
+from models import get_response_method, get_stream_method, get_async_response_method, get_answer, get_token_log
+from llm_client.registry import resolve_model
 
 
 class PatientAgent:
@@ -31,7 +33,9 @@ class PatientAgent:
         self.verbose = verbose
         
         self.client = get_response_method(self.backend_api_type)
-        self.model = vllm_model_setup(self.backend) if self.backend_api_type == "vllm" else self.backend
+        self.stream_client = get_stream_method(self.backend_api_type)
+        self.async_client = get_async_response_method(self.backend_api_type)
+        self.model = resolve_model(self.backend)
 
         if verbose:
             logging.info(f"Setting patient agent with backend: {self.model} ({self.backend_api_type})")
@@ -149,7 +153,13 @@ class PatientAgent:
         self.set_system_prompt()
         system_message = {"role": "system", "content": self.system_prompt}
         self.messages = [system_message]
+        self.session = uuid.uuid4().hex  # conversation id: routes the whole dialogue to the same vLLM replica
         self.token_log = {"prompt_tokens": [], "completion_tokens": [], "total_tokens": [], "extra_info": {}}
+        self.fallback_log = []  # replies that came from the fallback backend while the circuit of this agent's backend was open
+
+    def log_fallback(self, call_info) -> None:
+        if call_info:
+            self.fallback_log.append({"turn": len(self.token_log["total_tokens"]), **call_info})
 
     def log_token_usage(self, response) -> None:
         token_usage = get_token_log(response)
@@ -163,12 +173,39 @@ class PatientAgent:
                 else:
                     self.token_log["extra_info"][key].append(value)
 
-    def inference(self, question) -> str:
-        answer = str()
-        self.messages.append({"role": "user", "content": f"{question}"})
-        response = self.client(self.messages, model=self.model, **self.client_params)
+    def add_answer(self, response, call_info) -> str:
         answer = get_answer(response)
         answer = process_string(answer)
         self.log_token_usage(response)
+        self.log_fallback(call_info)
+        self.messages.append({"role": "assistant", "content": f"{answer}"})
+        return answer
+
+    def inference(self, question) -> str:
+        self.messages.append({"role": "user", "content": f"{question}"})
+        call_info = {}
+        response = self.client(self.messages, model=self.model, caller="patient", session=self.session, call_info=call_info, **self.client_params)
+        return self.add_answer(response, call_info)
+
+    async def ainference(self, question) -> str:
+        # inference() on the async client, so many dialogues can be stepped together on one event loop
+        self.messages.append({"role": "user", "content": f"{question}"})
+        call_info = {}
+        response = await self.async_client(self.messages, model=self.model, caller="patient", session=self.session, call_info=call_info, **self.client_params)
+        return self.add_answer(response, call_info)
+
+    def inference_stream(self, question):
+        # Yields the reply as text deltas; the cleaned-up answer is added to the history (and returned) once the stream ends
+        self.messages.append({"role": "user", "content": f"{question}"})
+        call_info = {}
+        stream = self.stream_client(self.messages, model=self.model, caller="patient", session=self.session, call_info=call_info, **self.client_params)
+        try:
+            yield from stream
+        finally:
+            stream.close()
+        answer = get_answer(stream.response)
+        answer = process_string(answer)
+        self.log_token_usage(stream.response)
+        self.log_fallback(call_info)
         self.messages.append({"role": "assistant", "content": f"{answer}"})
         return answer
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+# Manual benchmark of the startup cost; tests/test_import_time.py enforces the same budget in the test suite
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported as a side effect of `import models, utils`
+HEAVY_MODULES = ["torch", "numpy", "openai", "google.genai", "httpx", "transformers"]
+
+
+def measure_import(modules, num_runs):
+    # Fresh interpreter per run, so nothing is already cached in sys.modules
+    code = f"import time; t = time.perf_counter(); import {', '.join(modules)}; print(time.perf_counter() - t)"
+    base = float(subprocess.check_output([sys.executable, "-c", "import time; t = time.perf_counter(); print(time.perf_counter() - t)"], cwd=SRC_DIR))
+    timings = [float(subprocess.check_output([sys.executable, "-c", code], cwd=SRC_DIR)) - base for _ in range(num_runs)]
+    return statistics.median(timings)
+
+
+def loaded_heavy_modules(modules):
+    code = f"import sys; import {', '.join(modules)}; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    return subprocess.check_output([sys.executable, "-c", code], cwd=SRC_DIR, text=True).split()
+
+
+def main(args):
+    modules = args.modules.split(",")
+    elapsed = measure_import(modules, args.num_runs)
+    heavy = loaded_heavy_modules(modules)
+    print(f"import {', '.join(modules)}: {elapsed * 1000:.1f} ms (median of {args.num_runs}, budget {args.budget_ms:.0f} ms)")
+    if heavy:
+        print(f"Heavy modules imported eagerly: {', '.join(heavy)}")
+
+    if elapsed * 1000 > args.budget_ms or heavy:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the startup cost of the client layer")
+    parser.add_argument("--modules", type=str, default="models,utils", help="comma separated modules to import")
+    parser.add_argument("--budget_ms", type=float, default=150.0, help="maximum median import time in milliseconds")
+    parser.add_argument("--num_runs", type=int, default=5)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,128 @@
+import os
+import re
+import sys
+import json
+import copy
+import argparse
+import statistics
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent.doctor_agent import DoctorAgent
+from llm_client.mock_backend import configure_mock, PATIENT_REPLIES
+
+# Local stand-in for a vLLM server with automatic prefix caching. The prompt is rendered with a chat template and split
+# into fixed-size token blocks; a block is served from the cache only if the whole prefix up to and including it was
+# computed by an earlier request (vLLM hashes each block together with its parent). Latency = prefill of the uncached
+# tokens + decode of the reply, at the given token rates.
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]|\s+")
+
+
+def render_prompt(messages):
+    return "".join(f"<|{item['role']}|>\n{item['content']}<|end|>\n" for item in messages) + "<|assistant|>\n"
+
+
+class PrefixCache:
+    def __init__(self, block_size=16, capacity_blocks=100000):
+        self.block_size = block_size
+        self.capacity_blocks = capacity_blocks
+        self.blocks = OrderedDict()  # prefix hash -> None, least recently used first
+
+    def process(self, tokens):
+        # Returns the number of prompt tokens served from the cache, and caches every full block of the prompt
+        cached_tokens, parent, hit = 0, None, True
+        for start in range(0, len(tokens) - len(tokens) % self.block_size, self.block_size):
+            parent = hash((parent, tuple(tokens[start : start + self.block_size])))
+            if hit and parent in self.blocks:
+                cached_tokens += self.block_size
+                self.blocks.move_to_end(parent)
+            else:
+                hit = False
+                self.blocks[parent] = None
+                if len(self.blocks) > self.capacity_blocks:
+                    self.blocks.popitem(last=False)
+        return cached_tokens
+
+
+def patient_info(idx):
+    return {"gender": ["F", "M"][idx % 2], "age": 30 + 7 * idx, "arrival_transport": ["WALK IN", "AMBULANCE"][idx % 2]}
+
+
+def capture_requests(args, prefix_stable, dialogue_idx):
+    # Runs one doctor dialogue on the mock backend and returns the message list of every doctor request
+    doctor_agent = DoctorAgent(
+        max_infs=args.num_turns,
+        backend_str="mock-doctor",
+        backend_api_type="mock",
+        prompt_dir=args.prompt_dir,
+        prompt_file=args.prompt_file,
+        patient_info=patient_info(dialogue_idx),
+        prefix_stable=prefix_stable,
+    )
+    requests = []
+    client = doctor_agent.client
+
+    def recording_client(messages, **kwargs):
+        requests.append(copy.deepcopy(messages))
+        return client(messages, **kwargs)
+
+    doctor_agent.client = recording_client
+    doctor_agent.messages.append({"role": "assistant", "content": doctor_agent.doctor_greet})
+    for turn in range(args.num_turns):
+        doctor_agent.inference(PATIENT_REPLIES[(dialogue_idx + turn) % len(PATIENT_REPLIES)])
+    return requests
+
+
+def run_mode(args, prefix_stable):
+    cache = PrefixCache(block_size=args.block_size)
+    prompt_tokens, cached_tokens, latencies = 0, 0, []
+    for dialogue_idx in range(args.num_dialogues):
+        for messages in capture_requests(args, prefix_stable, dialogue_idx):
+            tokens = TOKEN_PATTERN.findall(render_prompt(messages))
+            hit = cache.process(tokens)
+            prompt_tokens += len(tokens)
+            cached_tokens += hit
+            latencies.append((len(tokens) - hit) / args.prefill_tokens_per_s + args.completion_tokens / args.decode_tokens_per_s)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "cache_hit_rate": cached_tokens / max(prompt_tokens, 1),
+        "turn_latency_mean": statistics.mean(latencies),
+        "turn_latency_p50": statistics.median(latencies),
+        "turn_latency_p95": sorted(latencies)[int(0.95 * (len(latencies) - 1))],
+        "last_turn_latency": latencies[-1],
+    }
+
+
+def main(args):
+    configure_mock(latency_median=0.0, ddx_turn=args.num_turns + 1)
+    results = {"baseline": run_mode(args, prefix_stable=False), "prefix_stable": run_mode(args, prefix_stable=True)}
+
+    print(f"{args.num_dialogues} dialogues x {args.num_turns} doctor turns, block size {args.block_size}")
+    print(f"{'mode':<15}{'prompt tok':>12}{'cached tok':>12}{'hit rate':>10}{'mean (s)':>10}{'p50 (s)':>10}{'p95 (s)':>10}{'last (s)':>10}")
+    for mode, result in results.items():
+        print(
+            f"{mode:<15}{result['prompt_tokens']:>12}{result['cached_tokens']:>12}{result['cache_hit_rate']:>10.1%}"
+            f"{result['turn_latency_mean']:>10.3f}{result['turn_latency_p50']:>10.3f}{result['turn_latency_p95']:>10.3f}{result['last_turn_latency']:>10.3f}"
+        )
+    if args.save_path:
+        with open(args.save_path, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prompt-cache hit rate and per-turn latency of the doctor prompt layouts")
+    parser.add_argument("--prompt_dir", type=str, default="./prompts/simulation")
+    parser.add_argument("--prompt_file", type=str, default="initial_system_doctor")
+    parser.add_argument("--num_dialogues", type=int, default=5)
+    parser.add_argument("--num_turns", type=int, default=30)
+    parser.add_argument("--block_size", type=int, default=16, help="tokens per cache block (vLLM default: 16)")
+    parser.add_argument("--prefill_tokens_per_s", type=float, default=4000.0)
+    parser.add_argument("--decode_tokens_per_s", type=float, default=30.0)
+    parser.add_argument("--completion_tokens", type=int, default=40, help="reply length used for the decode time")
+    parser.add_argument("--save_path", type=str, default=None, help="optional json file for the results")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import get_profile
+from scenario_store import ScenarioStore
+
+# Synthetic profile with the size and fields of a real one (long free-text fields, CEFR word lists)
+TEXT = "word " * 400
+DIAGNOSES = ["Pneumonia", "Urinary tract infection", "Myocardial infarction", "Intestinal obstruction", "Cerebral infarction"]
+
+
+def write_profiles(data_dir, num_profiles):
+    with open(os.path.join(data_dir, "profiles.json"), "w") as f_json, open(os.path.join(data_dir, "profiles.jsonl"), "w") as f_jsonl:
+        profiles = []
+        for i in range(num_profiles):
+            profile = {
+                "hadm_id": 20000000 + i,
+                "diagnosis": DIAGNOSES[i % len(DIAGNOSES)],
+                "split": "info" if i % 2 else "all",
+                "cefr": "ABC"[i % 3],
+                "personality": "plain",
+                "recall_level": "low",
+                "dazed_level": "normal",
+                **{key: TEXT for key in ["present_illness_positive", "medical_history", "cefr_A1", "cefr_B1", "cefr_C1", "med_A"]},
+            }
+            profiles.append(profile)
+            f_jsonl.write(json.dumps(profile) + "\n")
+        json.dump(profiles, f_json)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_profiles(data_dir, args.num_profiles)
+        lookups = [20000000 + random.Random(args.random_seed).randrange(args.num_profiles) for _ in range(args.num_lookups)]
+
+        # Before: whole-file json.load, then a linear get_profile scan per dialogue
+        profiles, load_time = timed(lambda: json.load(open(os.path.join(data_dir, "profiles.json"))))
+        _, lookup_time = timed(lambda: [get_profile(profiles, hadm_id) for hadm_id in lookups])
+        print(f"json + get_profile:   load {load_time:.2f}s, {args.num_lookups} lookups {lookup_time:.2f}s")
+        del profiles
+
+        # After: indexed JSONL store (first open builds and caches the index, later opens only read it)
+        _, build_time = timed(lambda: ScenarioStore(os.path.join(data_dir, "profiles.jsonl")))
+        store, open_time = timed(lambda: ScenarioStore(os.path.join(data_dir, "profiles.jsonl")))
+        _, lookup_time = timed(lambda: [store.get(hadm_id) for hadm_id in lookups])
+        subset, filter_time = timed(lambda: store.filter(split="info", diagnosis=["Pneumonia"]))
+        print(f"ScenarioStore (jsonl): index build {build_time:.2f}s, open {open_time:.2f}s, {args.num_lookups} lookups {lookup_time:.3f}s")
+        print(f"                       filter(split, diagnosis) -> {len(subset)} profiles in {filter_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the whole-file profile load + linear lookups with the indexed scenario store")
+    parser.add_argument("--num_profiles", type=int, default=100000)
+    parser.add_argument("--num_lookups", type=int, default=1000)
+    parser.add_argument("--random_seed", type=int, default=42)
+
+    args = parser.parse_args()
+    main(args)
@@ -9,7 +9,10 @@ import pandas as pd
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils import file_to_string, find_missing_keys, save_to_json
-from models import get_response_method, vllm_model_setup, get_answer
+from models import get_response_method, get_answer
+from llm_client.rate_limiter import configure_rate_limit
+from llm_client.registry import resolve_model, list_models
+from llm_client.response_cache import configure_cache, log_cache_stats
 
 
 def main(args):
@@ -29,7 +32,9 @@ def main(args):
     
     print(f"{args.model_api_type} api call")
     client = get_response_method(args.model_api_type)
-    model = vllm_model_setup(args.model) if "vllm" in args.model else args.model
+    model = resolve_model(args.model)
+    configure_rate_limit(args.model_api_type, model, rpm=args.rpm, tpm=args.tpm)
+    configure_cache(args.cache_path, readonly=args.cache_readonly)
 
     # Extract dataset using chatgpt model
     total_result = {}
@@ -66,6 +71,7 @@ def main(args):
     
     total_result = dict(sorted(total_result.items()))
     save_to_json(total_result, os.path.join(args.save_dir, f"{args.model}_results.json"))
+    log_cache_stats()
 
 
 if __name__ == "__main__":
@@ -78,15 +84,16 @@ if __name__ == "__main__":
         "--model",
         type=str,
         default="gemini-2.5-flash",
-        choices=[
-            "gpt-4o",
-            "gemini-2.5-flash",
-        ],
+        choices=list_models(["gpt_azure", "genai"]),
     )
     parser.add_argument("--model_api_type", type=str, default="genai", choices=["gpt_azure", "genai"])
     parser.add_argument("--temperature", type=float, default=0.0, help="model temperature")
     parser.add_argument("--random_seed", type=int, default=42)
     parser.add_argument("--thinking_budget", type=int, default=1024)
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute limit")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute limit")
+    parser.add_argument("--cache_path", type=str, default=None, help="sqlite file caching deterministic LLM responses (disabled if not set)")
+    parser.add_argument("--cache_readonly", action="store_true", help="serve cached responses without writing new ones")
 
     parser.add_argument("--data_dir", type=str, default="./data", help="save dir")
     parser.add_argument("--save_dir", type=str, default="./results/key_extraction", help="save dir")
@@ -4,22 +4,25 @@ import sys
 import ast
 import json
 import copy
-import torch
 import random
 import argparse
 import numpy as np
 import pandas as pd
 
-from torch import nn
-from transformers import AutoTokenizer, AutoModel
-
 os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from tqdm import tqdm
 from copy import deepcopy
-from models import get_response_method, vllm_model_setup, get_answer
-from utils import load_json, load_jsonl, save_to_json, get_profile, file_to_string, set_seed, detect_termination, process_string
+from models import get_response_method, get_answer
+from llm_client.rate_limiter import configure_rate_limit
+from llm_client.registry import resolve_model, list_models, list_providers
+from llm_client.response_cache import configure_cache, log_cache_stats
+from llm_client.cassette import configure_cassette
+from llm_client.telemetry import metrics, serve_metrics
+from llm_client.cost import cost_ledger, configure_budget
+from scenario_store import ScenarioStore
+from utils import load_json, load_jsonl, save_to_json, file_to_string, set_seed, detect_termination, process_string, record_key, shard_of, shard_path
 from prompts.eval.prompts import ABS_SYSTEM_PROMPT, SCORE_RUBRIC_TEMPLATE, PATIENT_PROFILE_TEMPLATE, PATIENT_PROFILE_TEMPLATE_UTI, PATIENT_PERSONA_TEMPLATE
 
 
@@ -68,6 +71,8 @@ def get_valid_answer_with_retries(client, messages, model, temperature, max_retr
 
 
 def get_embedding(tokenizer, model, text):
+    import torch
+
     device = next(model.parameters()).device
     inputs = tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=512)
     inputs = {key: val.to(device) for key, val in inputs.items()}
@@ -103,11 +108,23 @@ def main(args):
 
     # Setup the moderator
     client = get_response_method(args.moderator_api_type)
-    model = vllm_model_setup(args.moderator) if "vllm" in args.moderator else args.moderator
+    model = resolve_model(args.moderator)
+    configure_rate_limit(args.moderator_api_type, model, rpm=args.rpm, tpm=args.tpm)
+    configure_cache(args.cache_path, readonly=args.cache_readonly)
+    if args.cassette:
+        configure_cassette(args.cassette, mode=args.cassette_mode)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    configure_budget(args.budget_usd)
 
     # Load test data
-    scenario_dict = load_json(os.path.join(args.data_dir, f"{args.data_file_name}.json"))
+    scenario_store = ScenarioStore.open(args.data_dir, args.data_file_name)
     dialogue_hists = load_jsonl(os.path.join(result_path, "outputs", "dialogue.jsonl"))
+    if args.num_shards > 1:
+        # Evaluate only the dialogues (hashed on hadm_id + persona) of this shard; outputs are named <file>.shard-<i>-of-<n>
+        assert 0 <= args.shard_index < args.num_shards, "--shard_index must be in [0, num_shards)"
+        dialogue_hists = [data for data in dialogue_hists if shard_of(record_key(data), args.num_shards) == args.shard_index]
+        print(f"Shard {args.shard_index} / {args.num_shards}: {len(dialogue_hists)} dialogue(s)")
 
     # Eval DDX task
     if args.eval_ddx:
@@ -116,12 +133,16 @@ def main(args):
 
         # Set save path & save variables
         correct_cnt = 0
+        eval_cnt = 0
+        simulation_tokens, simulation_cost = 0, 0.0  # spent by the simulation on the evaluated dialogues
         total_ddx_result = {}
-        save_path = os.path.join(result_path, f"{args.moderator}_ddx_{args.trg_agent}.json")
+        save_path = shard_path(os.path.join(result_path, f"{args.moderator}_ddx_{args.trg_agent}.json"), args.shard_index, args.num_shards)
         assert not os.path.isfile(save_path)
 
         # Start evaluation
         for data in tqdm(dialogue_hists):
+            if cost_ledger.exhausted():
+                break
             # Load data per scenario
             scenario = data["hadm_id"]
             dialogue = data["dialog_history"]
@@ -152,9 +173,15 @@ def main(args):
             total_ddx_result[scenario]["answer"] = answer
             if answer.lower() == "y":
                 correct_cnt += 1
+            eval_cnt += 1
+            if "cost" in data:
+                simulation_tokens += data["cost"]["prompt_tokens"] + data["cost"]["completion_tokens"]
+                simulation_cost += data["cost"]["cost_usd"]
 
         # Logging & save
-        print(f"Prediction Acc: {(correct_cnt / len(dialogue_hists)) * 100:.2f}%")
+        print(f"Prediction Acc: {(correct_cnt / max(eval_cnt, 1)) * 100:.2f}%")
+        if correct_cnt and simulation_tokens:
+            print(f"Simulation tokens per correct DDX: {simulation_tokens / correct_cnt:.0f} (${simulation_cost / correct_cnt:.4f})")
         save_to_json(total_ddx_result, save_path)
 
 
@@ -167,9 +194,11 @@ def main(args):
 
         # Set save path & save variables
         total_persona_eval_result = {k: {} for k in eval_criteria_dict.keys()}
-        save_path = os.path.join(result_path, f"{args.moderator}_persona_quality_{args.trg_agent}.json")
+        save_path = shard_path(os.path.join(result_path, f"{args.moderator}_persona_quality_{args.trg_agent}.json"), args.shard_index, args.num_shards)
         assert not os.path.isfile(save_path)
         for data in tqdm(dialogue_hists):
+            if cost_ledger.exhausted():
+                break
             # Load data per scenario
             scenario = data["hadm_id"]
             dialogue = data["dialog_history"]
@@ -202,7 +231,7 @@ def main(args):
                 "Recall_level": RECALL_DICT[data["recall_level_type"]], 
                 "Dazed_level": DAZED_DICT[data["dazed_level_type"]]
             }
-            profile = get_profile(scenario_dict, scenario)
+            profile = scenario_store.get(scenario)
 
             conversation = ""
             for utter in dialogue[:-1]:
@@ -259,15 +288,17 @@ def main(args):
 
         # Set save path & save variables
         total_doc_eval_result = {k: {} for k in eval_criteria_dict.keys()}
-        save_path = os.path.join(result_path, f"{args.moderator}_doc_quality_{args.trg_agent}.json")
+        save_path = shard_path(os.path.join(result_path, f"{args.moderator}_doc_quality_{args.trg_agent}.json"), args.shard_index, args.num_shards)
         assert not os.path.isfile(save_path)
 
         # Start evaluation
         for data in tqdm(dialogue_hists):
+            if cost_ledger.exhausted():
+                break
             # Load data per scenario
             scenario = data["hadm_id"]
             dialogue = data["dialog_history"]
-            profile = get_profile(scenario_dict, scenario)
+            profile = scenario_store.get(scenario)
 
             conversation = ""
             for utter in dialogue[:-1]:
@@ -314,11 +345,13 @@ def main(args):
 
         # Set save path & save variables
         total_consistency_eval_result = {}
-        save_path = os.path.join(result_path, f"{args.moderator}_profile_consistency_{args.trg_agent}.json")
+        save_path = shard_path(os.path.join(result_path, f"{args.moderator}_profile_consistency_{args.trg_agent}.json"), args.shard_index, args.num_shards)
 
         if not os.path.isfile(save_path):
             # Start evaluation
             for data in tqdm(dialogue_hists):
+                if cost_ledger.exhausted():
+                    break
                 # Load data per scenario
                 scenario = data["hadm_id"]
                 dialogue = data["dialog_history"]
@@ -340,12 +373,13 @@ def main(args):
                 # Save the result
                 total_consistency_eval_result[scenario] = answer
 
-            # Logging & save
-            save_to_json(total_consistency_eval_result, save_path)
+            # Logging & save (a run stopped by the budget leaves no file, so the next run evaluates every dialogue again)
+            if not cost_ledger.exhausted():
+                save_to_json(total_consistency_eval_result, save_path)
 
-        total_consistency_eval_result = load_json(save_path)
-        BERTscore_save_path = os.path.join(result_path, f"{args.moderator}_profile_consistency_BERTscore_{args.trg_agent}.json")
-        LLMscore_save_path = os.path.join(result_path, f"{args.moderator}_profile_consistency_LLMscore_{args.trg_agent}.json")
+        total_consistency_eval_result = load_json(save_path) if os.path.isfile(save_path) else {}
+        BERTscore_save_path = shard_path(os.path.join(result_path, f"{args.moderator}_profile_consistency_BERTscore_{args.trg_agent}.json"), args.shard_index, args.num_shards)
+        LLMscore_save_path = shard_path(os.path.join(result_path, f"{args.moderator}_profile_consistency_LLMscore_{args.trg_agent}.json"), args.shard_index, args.num_shards)
         consistency_prompt = load_json(os.path.join(args.prompt_dir, "eval_profile_consistency.json"))
 
         BERT_SIM_result = {}
@@ -357,11 +391,18 @@ def main(args):
         if os.path.isfile(LLMscore_save_path):
             LLM_SIM_result = load_json(LLMscore_save_path)
 
+        # torch / transformers are only needed here, so they are not imported at startup
+        import torch
+        from torch import nn
+        from transformers import AutoTokenizer, AutoModel
+
         embedding_model_name = "emilyalsentzer/Bio_ClinicalBERT"
         tokenizer = AutoTokenizer.from_pretrained(embedding_model_name)
         embedding_model = AutoModel.from_pretrained(embedding_model_name).to("cuda" if torch.cuda.is_available() else "cpu")
         for scenario, predict_dict in tqdm(total_consistency_eval_result.items()):
-            profile_data = get_profile(scenario_dict, scenario)
+            if cost_ledger.exhausted():
+                break
+            profile_data = scenario_store.get(scenario)
             predict_dict = flatten_dict_simple(predict_dict)
             profile_data = {k: v for k, v in profile_data.items() if k in predict_dict.keys()}
             assert len(set(predict_dict.keys()).difference(profile_data)) == 0
@@ -390,6 +431,12 @@ def main(args):
                 save_to_json(BERT_SIM_result, BERTscore_save_path)
                 save_to_json(LLM_SIM_result, LLMscore_save_path)
 
+    log_cache_stats()
+    metrics.dump(shard_path(os.path.join(result_path, f"{args.moderator}_llm_metrics"), args.shard_index, args.num_shards))
+    if args.num_shards > 1:
+        metrics.save_snapshot(shard_path(os.path.join(result_path, f"{args.moderator}_llm_metrics_snapshot.json"), args.shard_index, args.num_shards))
+    cost_ledger.save(shard_path(os.path.join(result_path, f"{args.moderator}_cost_summary.json"), args.shard_index, args.num_shards))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Medical Diagnosis Simulation CLI")
@@ -397,20 +444,9 @@ if __name__ == "__main__":
         "--moderator",
         type=str,
         default="vllm-llama3.1-70b-instruct",
-        choices=[
-            "gpt-4o-mini",
-            "gpt-4o",
-            "gpt-5-nano",
-            "gemini-2.0-flash",
-            "gemini-2.5-flash",
-            "vllm-deepseek-llama-70b",
-            "vllm-llama3.1-70b-instruct",
-            "vllm-llama3.3-70b-instruct",
-            "vllm-llama4-scout",
-            "vllm-qwen2.5-72b-instruct",
-        ],
+        choices=list_models(),
     )
-    parser.add_argument("--moderator_api_type", type=str, default="vllm", choices=["gpt_azure", "vllm", "genai"])
+    parser.add_argument("--moderator_api_type", type=str, default="vllm", choices=list_providers())
     parser.add_argument("--trg_agent", type=str, default="Patient")
     parser.add_argument("--data_dir", type=str, default="./data/final_data")
     parser.add_argument("--data_file_name", type=str, default="patient_profile")
@@ -424,6 +460,16 @@ if __name__ == "__main__":
 
     parser.add_argument("--temperature", type=int, default=0)
     parser.add_argument("--random_seed", type=int, default=42)
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute limit for the moderator")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute limit for the moderator")
+    parser.add_argument("--cache_path", type=str, default=None, help="sqlite file caching deterministic LLM responses (disabled if not set)")
+    parser.add_argument("--cache_readonly", action="store_true", help="serve cached responses without writing new ones")
+    parser.add_argument("--cassette", type=str, default=None, help="record/replay every LLM call to this cassette file")
+    parser.add_argument("--cassette_mode", type=str, default="record", choices=["record", "append", "replay"])
+    parser.add_argument("--metrics_port", type=int, default=None, help="serve LLM call metrics live on this port")
+    parser.add_argument("--budget_usd", type=float, default=None, help="stop evaluating new dialogues once the moderator calls cost this much")
+    parser.add_argument("--shard_index", type=int, default=0, help="evaluate only the dialogues of this shard (see --num_shards)")
+    parser.add_argument("--num_shards", type=int, default=1, help="split the dialogues into this many shards (hashed on hadm_id + persona), e.g. one per node")
 
     args = parser.parse_args()
     set_seed(args.random_seed)
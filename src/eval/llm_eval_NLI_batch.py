@@ -14,8 +14,15 @@ from tqdm import tqdm
 from copy import deepcopy
 from multiprocessing import Pool
 from nltk.tokenize import sent_tokenize
-from models import get_response_method, vllm_model_setup
-from utils import load_json, load_jsonl, save_to_json, get_profile, set_seed, process_string
+from models import get_response_method
+from llm_client.rate_limiter import configure_rate_limit
+from llm_client.registry import resolve_model, list_models, list_providers
+from llm_client.response_cache import configure_cache, log_cache_stats
+from llm_client.cassette import configure_cassette
+from llm_client.telemetry import metrics
+from llm_client.cost import cost_ledger, configure_budget
+from scenario_store import ScenarioStore
+from utils import load_json, load_jsonl, save_to_json, set_seed, process_string, record_key, shard_of, shard_path
 from prompts.eval.prompts import PATIENT_PROFILE_TEMPLATE, PATIENT_PROFILE_TEMPLATE_UTI
 
 
@@ -132,21 +139,34 @@ def get_valid_answer_with_retries(client, messages, model, temperature, max_retr
         return None, None
 
 
-def process_batch(batch_data, args, scenario_dict, batch_idx, temp_dir):
+def init_worker(args):
+    # Once per pool worker: its rate limiter (an equal share of the limits) is then shared by all of its batches
+    configure_rate_limit(args.moderator_api_type, resolve_model(args.moderator), rpm=args.rpm, tpm=args.tpm, num_processes=args.num_workers)
+    configure_cache(args.cache_path, readonly=args.cache_readonly)
+    if args.cassette:
+        configure_cassette(args.cassette, mode="replay" if args.cassette_mode == "replay" else "append")  # started by main()
+
+
+def process_batch(batch_data, args, scenario_store, batch_idx, temp_dir):
     batch_results = {} 
+    metrics.reset()  # a pool worker can process several batches; each snapshot covers only its own batch
+    cost_ledger.reset()
+    configure_budget(args.budget_usd / args.num_workers if args.budget_usd is not None else None)  # an equal share per worker
     client = get_response_method(args.moderator_api_type)
-    model = vllm_model_setup(args.moderator) if "vllm" in args.moderator else args.moderator
+    model = resolve_model(args.moderator)
     batch_save_path = os.path.join(temp_dir, f"batch_{batch_idx}.json")
     if os.path.exists(batch_save_path):
         batch_results = load_json(batch_save_path)
         
     for idx, data in enumerate(batch_data):
+        if cost_ledger.exhausted():
+            break
         scenario = data["hadm_id"]
         dialogue = data["dialog_history"]
 
         if scenario not in batch_results:
             # Get patient profile
-            profile = get_profile(scenario_dict, str(scenario))
+            profile = scenario_store.get(scenario)
             if profile:
                 profile["medical_history"] = "\n\t" + profile["medical_history"].replace("; ", "\n\t")
                 if profile["diagnosis"] == "Urinary tract infection":
@@ -236,10 +256,12 @@ def process_batch(batch_data, args, scenario_dict, batch_idx, temp_dir):
                 batch_results[scenario] = utterance_results
                 save_to_json(batch_results, batch_save_path)
             else:
-                scenario_path = os.path.join(args.data_dir, f"{args.data_file_name}.json")
-                print(f"Scenario {scenario} not found in the scenario {scenario_path}.")
+                print(f"Scenario {scenario} not found in the scenario {scenario_store.path}.")
 
     save_to_json(batch_results, batch_save_path)
+    log_cache_stats()
+    metrics.save_snapshot(os.path.join(temp_dir, f"metrics_{batch_idx}.json"))
+    cost_ledger.save(os.path.join(temp_dir, f"cost_{batch_idx}.json"))
     return batch_save_path
 
 
@@ -263,24 +285,32 @@ def process_batch_wrapper(args_tuple):
 def main(args):
     # Set evaluate path & setting
     result_path = os.path.join(args.result_dir, args.trg_exp_name)
-    temp_dir = os.path.join(result_path, "temp_batches") 
+    temp_dir = shard_path(os.path.join(result_path, "temp_batches"), args.shard_index, args.num_shards)
     os.makedirs(temp_dir, exist_ok=True)
 
     # Setup the moderator
     print(f"{args.moderator_api_type} api call")
     client = get_response_method(args.moderator_api_type)
-    model = vllm_model_setup(args.moderator) if "vllm" in args.moderator else args.moderator
+    model = resolve_model(args.moderator)
+
+    # A recorded cassette is started (emptied) once here; the pool workers add their calls to it
+    if args.cassette and args.cassette_mode == "record":
+        configure_cassette(args.cassette, mode="record")
 
     # Load test data
-    scenario_dict = load_json(os.path.join(args.data_dir, f"{args.data_file_name}.json"))
+    scenario_store = ScenarioStore.open(args.data_dir, args.data_file_name)
     dialogue_hists = load_jsonl(os.path.join(result_path, "dialogue.jsonl"))[:1]
+    if args.num_shards > 1:
+        # Evaluate only the dialogues (hashed on hadm_id + persona) of this shard; outputs are named <file>.shard-<i>-of-<n>
+        assert 0 <= args.shard_index < args.num_shards, "--shard_index must be in [0, num_shards)"
+        dialogue_hists = [data for data in dialogue_hists if shard_of(record_key(data), args.num_shards) == args.shard_index]
 
     # Evaluate only the information set
     if args.eval_target == "info":
-        scenario_dict = [subdict for subdict in scenario_dict if subdict["split"] == "info"]
+        scenario_store = scenario_store.filter(split="info")
 
     # Eval NLI task
-    save_path = os.path.join(result_path, f"{args.moderator}_nli.json")
+    save_path = shard_path(os.path.join(result_path, f"{args.moderator}_nli.json"), args.shard_index, args.num_shards)
     if os.path.isfile(save_path):
         total_nli_result = load_json(save_path)
     else:
@@ -290,17 +320,30 @@ def main(args):
     batch_size = args.batch_size
     dialogue_hists_batches = [dialogue_hists[i:i + batch_size] for i in range(0, len(dialogue_hists), batch_size)]
     print(len(dialogue_hists_batches))
-    batch_save_paths = []
-    with Pool(processes=len(dialogue_hists_batches)) as pool:  
-        batch_args = [
-            (batch_data, args, scenario_dict, batch_idx, temp_dir)
-            for batch_idx, batch_data in enumerate(dialogue_hists_batches)
-            if not all(str(data["hadm_id"]) in total_nli_result for data in batch_data)
-        ]
+    batch_args = [
+        (batch_data, args, scenario_store, batch_idx, temp_dir)
+        for batch_idx, batch_data in enumerate(dialogue_hists_batches)
+        if not all(str(data["hadm_id"]) in total_nli_result for data in batch_data)
+    ]
+    # Every worker process gets an equal share of the rate limit and budget (a shard can be left with no dialogues)
+    args.num_workers = max(len(batch_args), 1)
+    with Pool(processes=args.num_workers, initializer=init_worker, initargs=(args,)) as pool:
         batch_save_paths = pool.map(process_batch_wrapper, batch_args)
 
     merge_batch_results(temp_dir, save_path, total_nli_result)
 
+    # Each worker saved the metrics and costs of its own calls
+    for metrics_file in sorted(os.listdir(temp_dir)):
+        if metrics_file.startswith("metrics_") and metrics_file.endswith(".json"):
+            metrics.merge(load_json(os.path.join(temp_dir, metrics_file)))
+        elif metrics_file.startswith("cost_") and metrics_file.endswith(".json"):
+            cost_ledger.merge(load_json(os.path.join(temp_dir, metrics_file)))
+    metrics.dump(shard_path(os.path.join(result_path, f"{args.moderator}_nli_llm_metrics"), args.shard_index, args.num_shards))
+    if args.num_shards > 1:
+        metrics.save_snapshot(shard_path(os.path.join(result_path, f"{args.moderator}_nli_llm_metrics_snapshot.json"), args.shard_index, args.num_shards))
+    configure_budget(args.budget_usd)
+    cost_ledger.save(shard_path(os.path.join(result_path, f"{args.moderator}_nli_cost_summary.json"), args.shard_index, args.num_shards))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Medical Diagnosis Simulation CLI")
@@ -308,19 +351,9 @@ if __name__ == "__main__":
         "--moderator",
         type=str,
         default="vllm-llama3.1-70b-instruct",
-        choices=[
-            "gpt-4o-mini",
-            "gpt-4o",
-            "gpt-5-nano",
-            "gemini-2.0-flash",
-            "gemini-2.5-flash",
-            "vllm-deepseek-llama-70b",
-            "vllm-llama3.1-70b-instruct",
-            "vllm-llama3.3-70b-instruct",
-            "vllm-qwen2.5-72b-instruct",
-        ],
+        choices=list_models(),
     )
-    parser.add_argument("--moderator_api_type", type=str, default="vllm", choices=["gpt_azure", "vllm", "genai"])
+    parser.add_argument("--moderator_api_type", type=str, default="vllm", choices=list_providers())
     parser.add_argument("--data_dir", type=str, default="./data/final_data")
     parser.add_argument("--data_file_name", type=str, default="patient_profile")
     parser.add_argument("--eval_target", type=str, default="info", choices=["info", "all"])
@@ -330,6 +363,15 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=10, required=False, help="batch size for nli")
     parser.add_argument("--temperature", type=int, default=0)
     parser.add_argument("--random_seed", type=int, default=42)
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute limit for the moderator (shared by all workers)")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute limit for the moderator (shared by all workers)")
+    parser.add_argument("--cache_path", type=str, default=None, help="sqlite file caching deterministic LLM responses (disabled if not set)")
+    parser.add_argument("--cache_readonly", action="store_true", help="serve cached responses without writing new ones")
+    parser.add_argument("--cassette", type=str, default=None, help="record/replay every LLM call to this cassette file")
+    parser.add_argument("--cassette_mode", type=str, default="record", choices=["record", "append", "replay"])
+    parser.add_argument("--budget_usd", type=float, default=None, help="stop evaluating new dialogues once the moderator calls cost this much (split equally between workers)")
+    parser.add_argument("--shard_index", type=int, default=0, help="evaluate only the dialogues of this shard (see --num_shards)")
+    parser.add_argument("--num_shards", type=int, default=1, help="split the dialogues into this many shards (hashed on hadm_id + persona), e.g. one per node")
 
     args = parser.parse_args()
     set_seed(args.random_seed)
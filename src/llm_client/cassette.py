@@ -0,0 +1,88 @@
+import os
+import gzip
+import json
+import threading
+from collections import defaultdict, deque
+
+
+class CassetteMissError(Exception):
+    pass
+
+
+class Cassette:
+    """Records every request/response pair of a run, or serves them back by request fingerprint.
+
+    The file is JSON lines, gzip-compressed when the path ends with `.gz`. Every line is written with a single
+    append, so several processes (e.g. the NLI pool workers) can record into the same cassette.
+    mode: "record" starts a new cassette (an existing file is emptied, so replay never serves stale entries),
+    "append" adds to an existing one (resumed runs, pool workers, later stages of a pipeline), "replay" serves it.
+    """
+
+    def __init__(self, path, mode="record", replay_latency=False):
+        assert mode in ["record", "append", "replay"], f"Invalid cassette mode: {mode}"
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.lock = threading.Lock()
+        self.entries = defaultdict(deque)
+        self.last_entry = {}
+        if mode == "replay":
+            self.load()
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if mode == "record":
+            open(path, "wb").close()
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def load(self):
+        opener = gzip.open if self.path.endswith(".gz") else open
+        with opener(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[entry["key"]].append(entry)
+
+    def replay(self, key):
+        # Identical requests (e.g. sampled with temperature > 0) are served in the order they were recorded
+        with self.lock:
+            if self.entries[key]:
+                self.last_entry[key] = self.entries[key].popleft()
+            elif key not in self.last_entry:
+                raise CassetteMissError(f"Request {key} not found in cassette {self.path}")
+            entry = self.last_entry[key]
+        return entry["record"], entry["latency"] if self.replay_latency else 0.0
+
+    def record(self, key, api_type, model, record, latency):
+        line = json.dumps({"key": key, "api_type": api_type, "model": model, "latency": latency, "record": record}, ensure_ascii=False) + "\n"
+        data = gzip.compress(line.encode("utf-8")) if self.path.endswith(".gz") else line.encode("utf-8")
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+
+_cassette = None
+
+
+def configure_cassette(path, mode="record", replay_latency=False):
+    global _cassette
+    _cassette = Cassette(path, mode=mode, replay_latency=replay_latency) if path else None
+    return _cassette
+
+
+def get_cassette():
+    # LLM_CASSETTE / LLM_CASSETTE_MODE let a whole pipeline (simulation + evaluation) share one cassette. Every process
+    # of the pipeline adds to it by default; remove the file (or set LLM_CASSETTE_MODE=record) to record a new one.
+    if _cassette is None and os.environ.get("LLM_CASSETTE"):
+        configure_cassette(
+            os.environ["LLM_CASSETTE"],
+            mode=os.environ.get("LLM_CASSETTE_MODE", "append"),
+            replay_latency=os.environ.get("LLM_CASSETTE_REPLAY_LATENCY", "") == "1",
+        )
+    return _cassette
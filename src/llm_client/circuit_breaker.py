@@ -0,0 +1,102 @@
+import time
+import logging
+import threading
+
+from llm_client.retry import CircuitOpenError
+from llm_client.telemetry import metrics
+
+# Error classes that mean the backend itself is degraded. Rate limits are left to the rate limiter, and bad requests
+# show that the backend is answering.
+BREAKER_ERRORS = {"server", "timeout", "connection"}
+
+
+class CircuitBreaker:
+    """Stops calling a backend after `failure_threshold` consecutive server / timeout / connection errors.
+
+    closed: calls go through. open: calls fail at once with CircuitOpenError for `recovery_timeout` seconds.
+    half_open: up to `half_open_max_calls` probe calls go through; a success closes the breaker, a failure opens it again.
+    """
+
+    def __init__(self, api_type, enabled=False, failure_threshold=5, recovery_timeout=30.0, half_open_max_calls=1):
+        self.api_type = api_type
+        self.enabled = enabled
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+
+    def retry_after(self):
+        # Seconds until the breaker lets a probe call through (0 when it is not open)
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def before_call(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.state == "open" and self.retry_after() == 0.0:
+                self.state, self.probes = "half_open", 0
+                logging.info(f"[{self.api_type}] circuit half-open, probing the backend")
+            if self.state == "open" or (self.state == "half_open" and self.probes >= self.half_open_max_calls):
+                metrics.inc("llm_circuit_rejected_total", {"backend": self.api_type})
+                raise CircuitOpenError(self.api_type, self.retry_after() or self.recovery_timeout)
+            if self.state == "half_open":
+                self.probes += 1
+
+    def record(self, error_class=None):
+        # Called after every attempt that passed before_call, with the error class of a failed attempt
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.state == "half_open":
+                self.probes -= 1
+            if error_class not in BREAKER_ERRORS:
+                if self.state != "closed":
+                    logging.info(f"[{self.api_type}] circuit closed")
+                self.state, self.failures = "closed", 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state, self.opened_at = "open", time.monotonic()
+                metrics.inc("llm_circuit_opened_total", {"backend": self.api_type})
+                logging.warning(f"[{self.api_type}] circuit open for {self.recovery_timeout:g}s after {self.failures} consecutive failures ({error_class})")
+
+
+_breakers = {}
+_options = {}  # api_type -> options; None -> default options for every backend
+_fallbacks = {}  # (caller, api_type, model) -> fallback (api_type, model)
+_lock = threading.Lock()
+
+
+def configure_circuit_breaker(api_type=None, **kwargs):
+    # api_type=None changes the default options shared by every backend
+    with _lock:
+        _options[api_type] = kwargs
+        for key in list(_breakers):
+            if api_type is None or key == api_type:
+                del _breakers[key]
+
+
+def get_circuit_breaker(api_type):
+    with _lock:
+        if api_type not in _breakers:
+            _breakers[api_type] = CircuitBreaker(api_type, **_options.get(api_type, _options.get(None, {})))
+        return _breakers[api_type]
+
+
+def configure_fallback(caller, api_type, model, fallback_api_type=None, fallback_model=None):
+    # Calls made for `caller` (e.g. "doctor") to api_type/model go to the fallback backend model while the circuit of
+    # their own backend is open. Keyed by backend too, so the backend combinations of a sweep keep their own fallbacks.
+    if fallback_api_type is None or fallback_model is None:
+        _fallbacks.pop((caller, api_type, model), None)
+    else:
+        _fallbacks[(caller, api_type, model)] = (fallback_api_type, fallback_model)
+
+
+def get_fallback(caller, api_type, model):
+    return _fallbacks.get((caller, api_type, model))
@@ -0,0 +1,91 @@
+import os
+import asyncio
+import weakref
+import threading
+
+# Connection pool settings shared by every backend client
+POOL_LIMITS = {"max_connections": 256, "max_keepalive_connections": 64, "keepalive_expiry": 60.0}
+POOL_TIMEOUT = {"timeout": 600.0, "connect": 10.0}
+AZURE_API_VERSION = "2024-10-21"
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {(backend, base_url): client}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # A forked child (e.g. a multiprocessing.Pool worker) must not share sockets with its parent,
+    # so drop the inherited clients without closing them and build new ones on first use.
+    global _lock
+    _clients.clear()
+    _async_clients.clear()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def http_client(backend, use_async=False):
+    import httpx
+    from llm_client.pacing import record_rate_limit_headers
+
+    limits = httpx.Limits(**POOL_LIMITS)
+    timeout = httpx.Timeout(POOL_TIMEOUT["timeout"], connect=POOL_TIMEOUT["connect"])
+    hook, async_hook = record_rate_limit_headers(backend)  # rate-limit headers of every response drive the turn pacing
+    if use_async:
+        return httpx.AsyncClient(limits=limits, timeout=timeout, event_hooks={"response": [async_hook]})
+    return httpx.Client(limits=limits, timeout=timeout, event_hooks={"response": [hook]})
+
+
+def create_client(backend, base_url=None, use_async=False):
+    if backend == "gpt_azure":
+        from openai import AzureOpenAI, AsyncAzureOpenAI
+
+        client_cls = AsyncAzureOpenAI if use_async else AzureOpenAI
+        return client_cls(
+            azure_endpoint=base_url or os.environ.get("AZURE_ENDPOINT", ""),
+            api_key=os.environ.get("AZURE_OPENAI_KEY", ""),
+            api_version=AZURE_API_VERSION,
+            http_client=http_client(backend, use_async),
+        )
+    elif backend == "vllm":
+        from openai import OpenAI, AsyncOpenAI
+
+        client_cls = AsyncOpenAI if use_async else OpenAI
+        return client_cls(api_key="EMPTY", base_url=base_url, http_client=http_client(backend, use_async))
+    elif backend == "genai":
+        import httpx
+        from google import genai
+        from google.genai.types import HttpOptions
+
+        client_args = {"limits": httpx.Limits(**POOL_LIMITS)}
+        http_options = HttpOptions(api_version="v1", client_args=client_args, async_client_args=client_args)
+        return genai.Client(vertexai=True, api_key=os.environ.get("GENAI_API_KEY", ""), http_options=http_options)
+    raise NotImplementedError(f"No client for backend: {backend}")
+
+
+def get_client(backend, base_url=None):
+    # Long-lived client per (backend, base_url) so HTTP connections are kept alive across calls
+    key = (backend, base_url)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = create_client(backend, base_url)
+        return _clients[key]
+
+
+def get_async_client(backend, base_url=None):
+    # Async HTTP connections belong to the event loop that opened them, so keep one client per loop
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (backend, base_url)
+    if key not in clients:
+        clients[key] = create_client(backend, base_url, use_async=True)
+    return clients[key]
+
+
+def close_clients():
+    with _lock:
+        for client in _clients.values():
+            if hasattr(client, "close"):
+                client.close()
+        _clients.clear()
@@ -0,0 +1,172 @@
+import json
+import logging
+import threading
+import functools
+from collections import defaultdict
+
+from llm_client.registry import get_context_window, get_max_tokens, get_tokenizer_name
+
+CHARS_PER_TOKEN = 4  # fallback estimate when no local tokenizer is available
+MESSAGE_OVERHEAD = 4  # role / separator tokens added by chat templates per message
+SUMMARY_HEADER = "\n\nSummary of the earlier conversation (older turns were removed to fit the context window):\n"
+
+_tokenizers = {}
+_lock = threading.Lock()
+
+
+def load_tokenizer(name):
+    # Returns text -> token ids, or None when the tokenizer cannot be loaded (missing package, gated model, offline)
+    try:
+        if name.startswith("tiktoken:"):
+            import tiktoken
+
+            return tiktoken.get_encoding(name.split(":", 1)[1]).encode
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(name)
+        return functools.partial(tokenizer.encode, add_special_tokens=False)
+    except Exception as e:
+        logging.warning(f"Tokenizer {name} is not available ({e}), estimating {CHARS_PER_TOKEN} characters per token")
+        return None
+
+
+def get_tokenizer(name):
+    if name is None:
+        return None
+    with _lock:
+        if name not in _tokenizers:
+            _tokenizers[name] = load_tokenizer(name)
+        return _tokenizers[name]
+
+
+@functools.lru_cache(maxsize=65536)
+def count_text_tokens(tokenizer_name, text):
+    # Dialogue histories are re-sent every turn, so each message is tokenized only once
+    encode = get_tokenizer(tokenizer_name)
+    if encode is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encode(text))
+
+
+def count_tokens(message, api_type, model):
+    tokenizer_name = get_tokenizer_name(api_type, model)
+    if isinstance(message, str):
+        return count_text_tokens(tokenizer_name, message)
+    return sum(count_text_tokens(tokenizer_name, str(item["content"])) + MESSAGE_OVERHEAD for item in message) + 2
+
+
+class ContextStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: {"calls": 0, "trimmed": 0, "summarized": 0, "dropped_messages": 0, "dropped_tokens": 0, "max_prompt_tokens": 0})
+
+    def record(self, caller, prompt_tokens, dropped_messages=0, dropped_tokens=0, summarized=False):
+        with self.lock:
+            stats = self.stats[caller]
+            stats["calls"] += 1
+            stats["max_prompt_tokens"] = max(stats["max_prompt_tokens"], prompt_tokens + dropped_tokens)
+            if dropped_messages:
+                stats["trimmed"] += 1
+                stats["summarized"] += int(summarized)
+                stats["dropped_messages"] += dropped_messages
+                stats["dropped_tokens"] += dropped_tokens
+
+    def summary(self):
+        with self.lock:
+            return {caller: dict(stats) for caller, stats in self.stats.items()}
+
+
+context_stats = ContextStats()
+
+
+class ContextPolicy:
+    """How a chat history is fitted into the model's context window before it is sent.
+
+    strategy: "truncate" drops the oldest turns, "summarize" also replaces them with a summary appended to the
+    system prompt, "none" sends the history unchanged. The system prompt and the newest message are always kept.
+    keep_last_turns: if set, at most this many of the most recent messages are sent, even when more would fit.
+    reserve_tokens: completion budget kept free (defaults to the registry `max_tokens` of the model).
+    """
+
+    def __init__(self, strategy="truncate", keep_last_turns=None, reserve_tokens=None, summary_tokens=256, margin=64):
+        assert strategy in ["truncate", "summarize", "none"], f"Invalid context strategy: {strategy}"
+        self.strategy = strategy
+        self.keep_last_turns = keep_last_turns
+        self.reserve_tokens = reserve_tokens
+        self.summary_tokens = summary_tokens
+        self.margin = margin
+
+    def budget(self, model):
+        context_window = get_context_window(model)
+        if context_window is None:
+            return None
+        reserve = self.reserve_tokens if self.reserve_tokens is not None else (get_max_tokens(model) or 0)
+        summary = self.summary_tokens if self.strategy == "summarize" else 0
+        return context_window - reserve - summary - self.margin
+
+    def fit(self, message, api_type, model, caller=None):
+        # Returns (message to send, dropped messages)
+        if self.strategy == "none" or not isinstance(message, list) or len(message) < 2:
+            return message, []
+        head = message[:1] if message[0]["role"] == "system" else []
+        turns = message[len(head):]
+        dropped = []
+        if self.keep_last_turns is not None and len(turns) > self.keep_last_turns:
+            cut = len(turns) - max(self.keep_last_turns, 1)
+            dropped, turns = turns[:cut], turns[cut:]
+
+        budget = self.budget(model)
+        if budget is not None:
+            tokens = count_tokens(head + turns, api_type, model)
+            while tokens > budget and len(turns) > 1:
+                tokens -= count_tokens(turns[:1], api_type, model) - 2
+                dropped.append(turns.pop(0))
+
+        # After an eviction, start the kept history on a user message, so no assistant turn is left without the question
+        # it answers. An untrimmed history (e.g. the doctor's greeting right after the system prompt) is sent as is.
+        if dropped:
+            while len(turns) > 1 and turns[0]["role"] != "user":
+                dropped.append(turns.pop(0))
+
+        prompt_tokens = count_tokens(head + turns, api_type, model)
+        dropped_tokens = count_tokens(dropped, api_type, model) - 2 if dropped else 0
+        context_stats.record(caller or api_type, prompt_tokens, len(dropped), dropped_tokens, summarized=bool(dropped) and self.strategy == "summarize")
+        return head + turns, dropped
+
+
+def merge_summary(message, summary):
+    # The summary goes into the system prompt, which keeps the user / assistant alternation of the kept turns intact
+    if message[0]["role"] == "system":
+        return [{"role": "system", "content": message[0]["content"] + SUMMARY_HEADER + summary}] + message[1:]
+    return [{"role": "system", "content": SUMMARY_HEADER.strip() + "\n" + summary}] + message
+
+
+def summary_request(dropped):
+    transcript = "\n".join(f"{item['role']}: {item['content']}" for item in dropped)
+    return [
+        {"role": "system", "content": "You summarize conversations. Keep every stated fact, symptom, answer and question; do not add new information. Answer in at most 150 words."},
+        {"role": "user", "content": f"Summarize this conversation:\n{transcript}"},
+    ]
+
+
+def summary_key(dropped):
+    return json.dumps(dropped, sort_keys=True, ensure_ascii=False)
+
+
+_default_policy = ContextPolicy()
+_policies = {"summarizer": ContextPolicy(strategy="none")}
+
+
+def configure_context(caller=None, **kwargs):
+    # caller=None changes the policy of every caller without its own policy
+    global _default_policy
+    policy = ContextPolicy(**{k: v for k, v in kwargs.items() if v is not None})
+    if caller is None:
+        _default_policy = policy
+    else:
+        _policies[caller] = policy
+    return policy
+
+
+def get_context_policy(caller=None):
+    return _policies.get(caller, _default_policy)
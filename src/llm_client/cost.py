@@ -0,0 +1,123 @@
+import json
+import logging
+import threading
+import contextvars
+from collections import defaultdict
+
+from llm_client.registry import get_model_spec, estimate_cost
+from llm_client.telemetry import metrics
+
+# Job the current calls belong to, set by the simulation loop for per-dialogue costs: a hadm_id, or the key of a
+# dialogue (hadm_id, persona..., backends), since a sweep simulates one hadm_id with several personas at once
+current_scenario = contextvars.ContextVar("llm_scenario", default=None)
+
+FIELDS = ["calls", "prompt_tokens", "completion_tokens", "cost_usd"]
+
+
+def scenario_of(job):
+    # hadm_id of a job
+    return job[0] if isinstance(job, tuple) else job
+
+
+class CostLedger:
+    """Running USD cost of the backend calls of a run, priced with the model registry.
+
+    Costs are aggregated per job (see current_scenario), agent (caller) and backend model, and summarized per hadm_id. With a `budget` (USD), exhausted() turns true
+    once the total reaches it: callers then stop scheduling new scenarios / eval items and let running ones finish.
+    Cache and cassette hits cost nothing and are not recorded.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.entries = defaultdict(lambda: dict.fromkeys(FIELDS, 0))  # (job, caller, api_type, model) -> totals
+            self.unpriced = set()
+            self.total = 0.0
+            self.stopped = False
+
+    def add(self, key, calls, prompt_tokens, completion_tokens, cost):
+        with self.lock:
+            entry = self.entries[key]
+            entry["calls"] += calls
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["cost_usd"] += cost
+            self.total += cost
+
+    def record(self, labels, prompt_tokens, completion_tokens):
+        # labels: call_labels() of the call
+        prompt_tokens, completion_tokens = prompt_tokens or 0, completion_tokens or 0
+        model = labels["model"]
+        if not (get_model_spec(model) or {}).get("pricing") and model not in self.unpriced:
+            self.unpriced.add(model)
+            logging.warning(f"No pricing for {model} in the model registry; its calls are counted at $0")
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+        self.add((current_scenario.get(), labels["caller"], labels["backend"], model), 1, prompt_tokens, completion_tokens, cost)
+        metrics.inc("llm_cost_usd_total", labels, cost)
+
+    def exhausted(self):
+        # True once the budget is spent; logged the first time
+        if self.budget is None or self.total < self.budget:
+            return False
+        if not self.stopped:
+            self.stopped = True
+            logging.warning(f"Budget of ${self.budget:.2f} reached (${self.total:.2f} spent): no new work is scheduled")
+        return True
+
+    def totals(self, select=lambda key: True):
+        totals = dict.fromkeys(FIELDS, 0)
+        with self.lock:
+            for key, entry in self.entries.items():
+                if select(key):
+                    for field in FIELDS:
+                        totals[field] += entry[field]
+        return totals
+
+    def job_cost(self, job):
+        return self.totals(lambda key: key[0] == job)
+
+    def summary(self):
+        grouped = {"by_scenario": defaultdict(lambda: dict.fromkeys(FIELDS, 0)), "by_agent": defaultdict(lambda: dict.fromkeys(FIELDS, 0)), "by_backend": defaultdict(lambda: dict.fromkeys(FIELDS, 0))}
+        with self.lock:
+            entries = [
+                {"scenario": scenario_of(key[0]), "job": list(key[0]) if isinstance(key[0], tuple) else None, "caller": key[1], "api_type": key[2], "model": key[3], **entry}
+                for key, entry in self.entries.items()
+            ]
+        for entry in entries:
+            for group, name in [("by_scenario", entry["scenario"]), ("by_agent", entry["caller"]), ("by_backend", f"{entry['api_type']}/{entry['model']}")]:
+                for field in FIELDS:
+                    grouped[group][str(name)][field] += entry[field]
+        return {
+            **self.totals(),
+            "budget_usd": self.budget,
+            "budget_exhausted": self.stopped,
+            **{group: dict(values) for group, values in grouped.items()},
+            "unpriced_models": sorted(self.unpriced),
+            "entries": entries,
+        }
+
+    def merge(self, summary):
+        # Adds the entries of another ledger's summary (e.g. from a worker process)
+        for entry in summary["entries"]:
+            job = tuple(entry["job"]) if entry.get("job") else entry["scenario"]
+            key = (job, entry["caller"], entry["api_type"], entry["model"])
+            self.add(key, entry["calls"], entry["prompt_tokens"], entry["completion_tokens"], entry["cost_usd"])
+        self.unpriced.update(summary.get("unpriced_models", []))
+        self.stopped = self.stopped or summary.get("budget_exhausted", False)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+cost_ledger = CostLedger()
+
+
+def configure_budget(budget=None):
+    # Hard cap in USD for the whole run (None: unlimited)
+    cost_ledger.budget = budget
+    return cost_ledger
@@ -0,0 +1,192 @@
+import time
+import asyncio
+import threading
+import contextvars
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from llm_client.telemetry import metrics, call_labels
+from llm_client.load_balancer import current_session, current_route, current_avoid
+
+LATENCY_WINDOW = 500  # recent latencies per (api_type, model) used for the hedge delay
+
+
+class HedgePolicy:
+    """Sends a duplicate of a request that is still running after the backend's observed latency quantile.
+
+    The first response wins. An async loser is cancelled; a sync loser cannot be interrupted mid-request, so it finishes
+    in the background and its result is dropped (at most `max_losers` of them at a time, further requests are not
+    hedged meanwhile). Hedges are capped at `max_extra_load` times the number of requests, and no hedge is sent until
+    `min_samples` latencies have been observed. A hedge only helps on another server: it is sent only when the backend
+    has several endpoints (vLLM replicas), and is routed to a different one than the request it duplicates.
+    """
+
+    def __init__(self, enabled=False, quantile=0.95, min_delay=0.5, max_extra_load=0.1, min_samples=20, max_losers=8, max_workers=64):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_extra_load = max_extra_load
+        self.min_samples = min_samples
+        self.max_losers = max_losers
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.requests = 0
+        self.hedges = 0
+        self.losers = 0  # sync losers still running
+        self.executor = None
+
+    def delay(self, key, num_endpoints=1):
+        with self.lock:
+            latencies = sorted(self.latencies[key])
+        if not self.enabled or num_endpoints < 2 or len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, latencies[min(len(latencies) - 1, int(self.quantile * len(latencies)))])
+
+    def observe(self, key, latency):
+        with self.lock:
+            self.latencies[key].append(latency)
+
+    def allow_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > self.max_extra_load * self.requests or self.losers >= self.max_losers:
+                return False
+            self.hedges += 1
+            return True
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+            return self.executor
+
+    def observe_when_done(self, key, future, start_time):
+        # Each request's own latency feeds the window, whether it won or not
+        def done(future):
+            if not future.cancelled() and future.exception() is None:
+                self.observe(key, time.monotonic() - start_time)
+
+        future.add_done_callback(done)
+        return future
+
+    def drop_loser(self, future):
+        # A loser that is already running cannot be cancelled: it counts against max_losers until it ends
+        if future.cancel():
+            return
+        with self.lock:
+            self.losers += 1
+
+        def done(future):
+            with self.lock:
+                self.losers -= 1
+
+        future.add_done_callback(done)
+
+    def submit(self, key, send, context):
+        return self.observe_when_done(key, self.get_executor().submit(context.run, send), time.monotonic())
+
+    def call(self, api_type, model, send, num_endpoints=1):
+        # send() -> response; num_endpoints: servers the request can be sent to
+        key = (api_type, model)
+        delay = self.delay(key, num_endpoints)
+        self.count_request()
+        if delay is None:
+            start_time = time.monotonic()
+            response = send()
+            self.observe(key, time.monotonic() - start_time)
+            return response
+
+        route = {}
+        primary = self.submit(key, send, primary_context(route))
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.allow_hedge():
+            if not done:
+                metrics.inc("llm_hedges_skipped_total", call_labels(api_type, model))
+            return primary.result()
+
+        metrics.inc("llm_hedges_total", call_labels(api_type, model))
+        hedge = self.submit(key, send, hedge_context(route))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        self.drop_loser(loser)
+                    if future is hedge:
+                        metrics.inc("llm_hedge_wins_total", call_labels(api_type, model))
+                    return future.result()
+        return primary.result()  # both failed: raise the primary's error
+
+    async def call_async(self, api_type, model, send, num_endpoints=1):
+        # send() -> coroutine
+        key = (api_type, model)
+        delay = self.delay(key, num_endpoints)
+        self.count_request()
+        if delay is None:
+            start_time = time.monotonic()
+            response = await send()
+            self.observe(key, time.monotonic() - start_time)
+            return response
+
+        loop = asyncio.get_running_loop()
+        route = {}
+        primary = self.observe_when_done(key, loop.create_task(send(), context=primary_context(route)), time.monotonic())
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self.allow_hedge():
+            if not done:
+                metrics.inc("llm_hedges_skipped_total", call_labels(api_type, model))
+            return await primary
+
+        metrics.inc("llm_hedges_total", call_labels(api_type, model))
+        hedge = self.observe_when_done(key, loop.create_task(send(), context=hedge_context(route)), time.monotonic())
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if task is hedge:
+                        metrics.inc("llm_hedge_wins_total", call_labels(api_type, model))
+                    return task.result()
+        return primary.result()
+
+
+def primary_context(route):
+    # The endpoint the request is routed to is recorded in `route`
+    context = contextvars.copy_context()
+    context.run(current_route.set, route)
+    return context
+
+
+def hedge_context(route):
+    # The duplicate must not follow the conversation's sticky replica, and goes to another endpoint than the request
+    context = contextvars.copy_context()
+    context.run(current_session.set, None)
+    context.run(current_route.set, None)
+    context.run(current_avoid.set, route.get("endpoint"))
+    return context
+
+
+_policies = {}
+_default_policy = HedgePolicy()
+
+
+def configure_hedging(api_type=None, **kwargs):
+    # api_type=None changes the default policy shared by every backend
+    global _default_policy
+    policy = HedgePolicy(**kwargs)
+    if api_type is None:
+        _default_policy = policy
+    else:
+        _policies[api_type] = policy
+    return policy
+
+
+def get_hedge_policy(api_type):
+    return _policies.get(api_type, _default_policy)
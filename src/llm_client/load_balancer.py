@@ -0,0 +1,196 @@
+import os
+import re
+import random
+import logging
+import threading
+import contextvars
+import contextlib
+from collections import OrderedDict
+
+from llm_client.retry import classify_error
+from llm_client.telemetry import metrics
+
+# Conversation id of the current call (the `session` argument of the response methods), used for sticky routing
+current_session = contextvars.ContextVar("llm_session", default=None)
+# Set by the hedging policy: a dict the endpoint of a request is recorded in, and the endpoint its hedge must avoid
+current_route = contextvars.ContextVar("llm_route", default=None)
+current_avoid = contextvars.ContextVar("llm_avoid", default=None)
+
+REPLICA_ERRORS = {"connection", "timeout", "server"}  # errors that count against the replica, not the request
+VLLM_LOAD_METRICS = re.compile(r"^vllm:num_requests_(?:running|waiting)(?:\{[^}]*\})?\s+([0-9.eE+-]+)", re.MULTILINE)
+
+
+def parse_server_load(text):
+    # Running + waiting requests from a vLLM /metrics page
+    return sum(float(value) for value in VLLM_LOAD_METRICS.findall(text))
+
+
+class Replica:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.outstanding = 0  # requests in flight from this process
+        self.server_load = 0.0  # requests in flight on the server (all clients), from the last /metrics probe
+        self.healthy = True
+        self.failures = 0
+
+    @property
+    def root_url(self):
+        base_url = self.base_url.rstrip("/")
+        return base_url[: -len("/v1")] if base_url.endswith("/v1") else base_url
+
+    @property
+    def load(self):
+        return max(self.outstanding, self.server_load)
+
+
+class EndpointPool:
+    """Routes the requests for one model across its vLLM replicas.
+
+    routing: "least_outstanding" picks the least loaded replica, "p2c" the less loaded of two random ones.
+    sticky: requests with the same session go to the same replica while it is healthy, so its prefix cache is reused.
+    Replicas are ejected after `max_failures` consecutive connection / server errors or a failed /health probe,
+    and re-admitted once /health answers again.
+    """
+
+    def __init__(self, model, base_urls, routing="least_outstanding", sticky=True, probe_interval=10.0, probe_timeout=2.0, max_failures=3, max_sessions=10000):
+        assert routing in ["least_outstanding", "p2c"], f"Invalid routing: {routing}"
+        self.model = model
+        self.replicas = [Replica(base_url) for base_url in base_urls]
+        self.routing = routing
+        self.sticky = sticky
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.max_failures = max_failures
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # session -> replica, least recently used first
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.prober = None
+
+    def candidates(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        return healthy or self.replicas  # every replica ejected: keep trying all of them rather than failing every call
+
+    def pick(self, session=None, avoid=None):
+        with self.lock:
+            candidates = self.candidates()
+            if avoid is not None:
+                candidates = [replica for replica in candidates if replica.base_url != avoid] or candidates
+            replica = self.sessions.get(session) if self.sticky and session is not None else None
+            if replica in candidates:
+                self.sessions.move_to_end(session)
+            elif self.routing == "p2c" and len(candidates) > 2:
+                replica = min(random.sample(candidates, 2), key=lambda r: r.load)
+            else:
+                lowest = min(r.load for r in candidates)
+                replica = random.choice([r for r in candidates if r.load == lowest])
+            if self.sticky and session is not None:
+                self.sessions[session] = replica
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            replica.outstanding += 1
+        return replica
+
+    def mark(self, replica, ok, session=None):
+        with self.lock:
+            if ok:
+                replica.failures = 0
+                return
+            replica.failures += 1
+            if session is not None:
+                self.sessions.pop(session, None)  # let the retry go to another replica
+            if replica.healthy and replica.failures >= self.max_failures and len(self.replicas) > 1:
+                replica.healthy = False
+                metrics.inc("llm_endpoint_ejections_total", {"model": self.model, "endpoint": replica.base_url})
+                logging.warning(f"[vllm/{self.model}] ejecting {replica.base_url} after {replica.failures} consecutive failures")
+
+    @contextlib.contextmanager
+    def route(self, session=None):
+        # with pool.route(session) as base_url: ...  (counts the request as outstanding on the replica until it ends)
+        self.start_probing()
+        replica = self.pick(session, avoid=current_avoid.get())
+        route = current_route.get()
+        if route is not None:
+            route["endpoint"] = replica.base_url
+        metrics.inc("llm_endpoint_requests_total", {"model": self.model, "endpoint": replica.base_url})
+        try:
+            yield replica.base_url
+            self.mark(replica, ok=True)
+        except Exception as e:
+            self.mark(replica, ok=classify_error(e) not in REPLICA_ERRORS, session=session)
+            raise
+        finally:
+            with self.lock:
+                replica.outstanding -= 1
+
+    def probe(self):
+        import httpx
+
+        for replica in self.replicas:
+            try:
+                healthy = httpx.get(f"{replica.root_url}/health", timeout=self.probe_timeout).status_code == 200
+                if healthy:
+                    response = httpx.get(f"{replica.root_url}/metrics", timeout=self.probe_timeout)
+                    replica.server_load = parse_server_load(response.text) if response.status_code == 200 else 0.0
+            except Exception:
+                healthy = False
+            with self.lock:
+                if healthy and not replica.healthy:
+                    logging.info(f"[vllm/{self.model}] re-admitting {replica.base_url}")
+                    replica.failures = 0
+                elif not healthy and replica.healthy:
+                    metrics.inc("llm_endpoint_ejections_total", {"model": self.model, "endpoint": replica.base_url})
+                    logging.warning(f"[vllm/{self.model}] ejecting {replica.base_url}: /health probe failed")
+                replica.healthy = healthy
+
+    def start_probing(self):
+        # A single replica has nowhere else to route, so it is not probed
+        if self.prober is not None or len(self.replicas) < 2 or not self.probe_interval:
+            return
+        with self.lock:
+            if self.prober is None:
+                self.prober = threading.Thread(target=self.probe_loop, name=f"probe-{self.model}", daemon=True)
+                self.prober.start()
+
+    def probe_loop(self):
+        while not self.stopped.wait(self.probe_interval):
+            self.probe()
+
+    def stop(self):
+        self.stopped.set()
+
+    def status(self):
+        with self.lock:
+            return [
+                {"endpoint": r.base_url, "healthy": r.healthy, "outstanding": r.outstanding, "server_load": r.server_load, "failures": r.failures}
+                for r in self.replicas
+            ]
+
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Probe threads do not survive a fork, so a child process builds its own pools
+    global _lock
+    _pools.clear()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_endpoint_pool(model, base_urls, **options):
+    with _lock:
+        if model not in _pools:
+            _pools[model] = EndpointPool(model, base_urls, **options)
+        return _pools[model]
+
+
+def close_endpoint_pools():
+    with _lock:
+        for pool in _pools.values():
+            pool.stop()
+        _pools.clear()
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+
+from llm_client.responses import record_to_response
+
+# Offline stand-in for a real backend, used to benchmark the simulation / evaluation drivers without API calls.
+# Latency is log-normal around `latency_median` seconds, token counts are estimated from characters.
+# Defaults can be overridden with MOCK_<OPTION> environment variables (e.g. MOCK_LATENCY_MEDIAN=0.2).
+MOCK_CONFIG = {
+    "latency_median": float(os.environ.get("MOCK_LATENCY_MEDIAN", 0.5)),
+    "latency_sigma": float(os.environ.get("MOCK_LATENCY_SIGMA", 0.5)),
+    "chars_per_token": float(os.environ.get("MOCK_CHARS_PER_TOKEN", 4.0)),
+    "error_rate": float(os.environ.get("MOCK_ERROR_RATE", 0.0)),  # fraction of calls failing with a synthetic 429 / 503
+    "ddx_turn": int(os.environ.get("MOCK_DDX_TURN", 10)),  # doctor turn at which the mock doctor gives its differential diagnosis
+    "ttft_fraction": float(os.environ.get("MOCK_TTFT_FRACTION", 0.3)),  # share of the latency spent before the first streamed token
+}
+
+PATIENT_REPLIES = [
+    "I've had this pain in my chest since yesterday morning.",
+    "It's kind of a pressure, and it gets worse when I walk.",
+    "No, I don't think I've had anything like this before.",
+    "I take a pill for my blood pressure, but I don't remember the name.",
+    "My father had heart problems, I think.",
+    "I don't smoke, and I only drink on weekends.",
+    "I'm not allergic to anything that I know of.",
+    "It's about a seven out of ten right now.",
+    "I feel a little short of breath too.",
+    "My wife drove me here.",
+]
+
+DOCTOR_QUESTIONS = [
+    "When did your symptoms start?",
+    "Can you describe the pain for me?",
+    "Does anything make it better or worse?",
+    "Do you have any medical conditions?",
+    "Are you taking any medications?",
+    "Do you have any allergies?",
+    "Does anyone in your family have similar problems?",
+    "Do you smoke or drink alcohol?",
+    "On a scale from 0 to 10, how bad is the pain?",
+    "Have you noticed any other symptoms?",
+]
+
+DDX_CLOSING = (
+    "These are ranked from most to least likely based on the symptoms, history and findings you shared. "
+    "Further tests such as blood work and imaging will help narrow them down, so please let me know if anything changes."
+)
+DDX_CANDIDATES = ["Acute coronary syndrome", "Pneumonia", "Pulmonary embolism", "Gastroesophageal reflux disease", "Costochondritis", "Urinary tract infection", "Sepsis"]
+
+NLI_CATEGORIES = [
+    "age", "gender", "race", "tobacco", "alcohol", "illicit_drug", "sexual_history", "exercise", "marital_status", "children", "living_situation",
+    "occupation", "insurance", "allergies", "family_medical_history", "medical_device", "medical_history", "present_illness", "chief_complaint",
+    "pain", "medication", "arrival_transport", "diagnosis",
+]
+
+
+class MockError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def configure_mock(**kwargs):
+    for key, value in kwargs.items():
+        if key not in MOCK_CONFIG:
+            raise ValueError(f"Invalid mock option: {key}")
+        MOCK_CONFIG[key] = value
+
+
+def request_rng(message, seed):
+    # Derived from the request itself so replies do not depend on call order or concurrency
+    digest = hashlib.sha256(json.dumps([message, seed], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+
+def patient_generator(message, rng):
+    return rng.choice(PATIENT_REPLIES)
+
+
+def doctor_generator(message, rng):
+    turn = sum(1 for item in message if item["role"] == "assistant")
+    if turn >= MOCK_CONFIG["ddx_turn"] or "final turn" in message[-1]["content"].lower():
+        diagnoses = rng.sample(DDX_CANDIDATES, 5)
+        # One diagnosis per line, followed by a closing remark like real doctor models write
+        return "Thank you for answering my questions. [DDX]\n" + "\n".join(f"{i + 1}. {ddx}" for i, ddx in enumerate(diagnoses)) + "\n\n" + DDX_CLOSING
+    return rng.choice(DOCTOR_QUESTIONS)
+
+
+def fill_json_template(text):
+    # Reply to extraction prompts with their own JSON template, every field set to "Not recorded"
+    def fill(template):
+        return {k: fill(v) if isinstance(v, dict) else "Not recorded" for k, v in template.items()}
+
+    for candidate in sorted(re.findall(r"\{[\s\S]*\}", text), key=len, reverse=True):
+        try:
+            return json.dumps(fill(json.loads(candidate)))
+        except json.JSONDecodeError:
+            continue
+    return "{}"
+
+
+def judge_generator(message, rng):
+    prompt = " ".join(str(item["content"]) for item in message)
+    try:
+        user_input = json.loads(message[-1]["content"])
+    except (json.JSONDecodeError, TypeError):
+        user_input = {}
+
+    if "'politeness', 'emotion', 'inquiry'" in prompt:  # NLI step 0
+        return json.dumps({"explanation": "mock", "prediction": rng.choice(["information", "information", "emotion", "politeness"])})
+    if "entailment_prediction" in prompt:  # NLI step 2 (classification)
+        profiles = user_input.get("profile", []) if isinstance(user_input, dict) else []
+        return json.dumps([{"profile": profile, "explanation": "mock", "entailment_prediction": rng.choice([1, 1, 0, -1])} for profile in profiles])
+    if "likelihood_rating" in prompt:  # NLI step 2 (rating)
+        return json.dumps({"explanation": "mock", "likelihood_rating": rng.randint(1, 4)})
+    if "each category of information" in prompt:  # NLI step 1
+        return json.dumps([{"category": category, "explanation": "mock", "prediction": int(rng.random() < 0.1)} for category in NLI_CATEGORIES])
+    if "new information" in prompt:  # NLI step 1 (hallucination)
+        return json.dumps({"explanation": "mock", "prediction": rng.randint(0, 1)})
+    if "GT_profile" in prompt:  # profile consistency (LLM similarity)
+        return json.dumps({key: f"[REASON]: mock, [RESULT]: {rng.randint(1, 4)}" for key in user_input.get("GT_profile", {})})
+    if "Answer [Y/N]" in prompt:  # DDX evaluation
+        return rng.choice(["Y", "N"])
+    if "[RESULT]" in prompt or "rubric" in prompt.lower():  # dialogue quality evaluation
+        return f"Feedback: mock feedback. [RESULT]: {rng.randint(1, 5)}"
+    return fill_json_template(prompt)
+
+
+GENERATORS = {"patient": patient_generator, "doctor": doctor_generator, "judge": judge_generator}
+
+
+def register_generator(name, generator):
+    # generator(message, rng) -> reply text; selected with model name "mock-<name>"
+    GENERATORS[name] = generator
+
+
+def select_generator(message, model):
+    name = model.split("-", 1)[1] if model and model.startswith("mock-") else None
+    if name in GENERATORS:
+        return GENERATORS[name]
+    system_prompt = message[0]["content"] if message[0]["role"] == "system" else ""
+    if "playing the role of a kind and patient doctor" in system_prompt:
+        return GENERATORS["doctor"]
+    if "role-play this patient" in system_prompt:
+        return GENERATORS["patient"]
+    return GENERATORS["judge"]
+
+
+def mock_completion(message, model=None, seed=None):
+    # Returns (response, latency); the caller is responsible for waiting `latency` seconds
+    rng = request_rng(message, seed)
+    latency = MOCK_CONFIG["latency_median"] * math.exp(MOCK_CONFIG["latency_sigma"] * rng.gauss(0, 1))
+    if MOCK_CONFIG["error_rate"] > 0 and random.random() < MOCK_CONFIG["error_rate"]:
+        status_code = random.choice([429, 503])
+        raise MockError(status_code, f"Mock error {status_code}")
+
+    text = select_generator(message, model)(message, rng)
+    prompt_tokens = int(sum(len(str(item["content"])) for item in message) / MOCK_CONFIG["chars_per_token"]) + 4 * len(message)
+    completion_tokens = max(1, int(len(text) / MOCK_CONFIG["chars_per_token"]))
+    record = {
+        "format": "openai",
+        "text": text,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    return record_to_response(record), latency
+
+
+def mock_send(message, model=None, seed=None):
+    response, latency = mock_completion(message, model, seed)
+    time.sleep(latency)
+    return response
+
+
+async def mock_send_async(message, model=None, seed=None):
+    response, latency = mock_completion(message, model, seed)
+    await asyncio.sleep(latency)
+    return response
+
+
+def mock_stream(message, model=None, seed=None):
+    # Streamed variant: (text delta, usage) pairs, one word (or line break) per chunk, spread over the same latency as mock_send
+    response, latency = mock_completion(message, model, seed)
+    words = re.findall(r"[^\S\n]*\S+|\n+", response.choices[0].message.content)
+    time.sleep(latency * MOCK_CONFIG["ttft_fraction"])
+    for i, word in enumerate(words):
+        if i > 0:
+            time.sleep(latency * (1 - MOCK_CONFIG["ttft_fraction"]) / max(len(words) - 1, 1))
+        yield word, None
+    usage = response.usage
+    yield "", {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens, "total_tokens": usage.total_tokens}
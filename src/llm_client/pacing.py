@@ -0,0 +1,117 @@
+import time
+import threading
+from collections import defaultdict, deque
+
+from llm_client.retry import retry_stats
+from llm_client.rate_limiter import get_rate_limiter
+from llm_client.telemetry import metrics
+
+# Remaining / limit headers sent by Azure OpenAI (and OpenAI-compatible servers that rate limit)
+RATE_LIMIT_HEADERS = [
+    ("x-ratelimit-remaining-requests", "x-ratelimit-limit-requests"),
+    ("x-ratelimit-remaining-tokens", "x-ratelimit-limit-tokens"),
+]
+
+
+class Pacer:
+    """Idle time between the turns of a dialogue, driven by feedback from the backends.
+
+    The gap is zero while a backend has headroom. It grows with the pressure on the backend, which is the largest of:
+    the share of recent attempts rejected with a 429 (relative to `max_rate_limit_share`), the quota left in the
+    rate-limit headers (relative to `min_headroom`), and recent latency against its usual level (relative to
+    `slow_factor` x the median). Pressure above 1 pauses for `base_gap` x pressure, capped at `max_gap`.
+    Signals older than `horizon` seconds are ignored, so the gap goes back to zero once the backend recovers.
+    `fixed_gap` replaces all of this with a constant pause (the old behaviour was 1 second).
+    """
+
+    def __init__(self, base_gap=1.0, max_gap=30.0, max_rate_limit_share=0.02, min_headroom=0.1, slow_factor=2.0, horizon=60.0, window=200, fixed_gap=None):
+        self.base_gap = base_gap
+        self.max_gap = max_gap
+        self.max_rate_limit_share = max_rate_limit_share
+        self.min_headroom = min_headroom
+        self.slow_factor = slow_factor
+        self.horizon = horizon
+        self.fixed_gap = fixed_gap
+        self.lock = threading.Lock()
+        self.attempts = defaultdict(lambda: deque(maxlen=window))  # (api_type, model) -> (time, rate limited, latency or None)
+        self.headroom = {}  # api_type -> (time, smallest remaining / limit share in the last response)
+
+    def observe_attempt(self, label, attempt, error_class=None, delay=0.0, elapsed=0.0):
+        # retry_stats hook: label is (api_type, model); elapsed is set for successful attempts
+        with self.lock:
+            self.attempts[label].append((time.monotonic(), error_class == "rate_limit", elapsed if error_class is None else None))
+
+    def observe_headers(self, api_type, headers):
+        shares = []
+        for remaining, limit in RATE_LIMIT_HEADERS:
+            try:
+                shares.append(float(headers[remaining]) / float(headers[limit]))
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                continue
+        if shares:
+            with self.lock:
+                self.headroom[api_type] = (time.monotonic(), min(shares))
+
+    def pressure(self, api_type, model):
+        now = time.monotonic()
+        with self.lock:
+            attempts = list(self.attempts[(api_type, model)])
+            headroom = self.headroom.get(api_type)
+        recent = [item for item in attempts if now - item[0] <= self.horizon]
+        pressure = 0.0
+        if recent:
+            pressure = max(pressure, sum(item[1] for item in recent) / len(recent) / self.max_rate_limit_share)
+        if headroom is not None and now - headroom[0] <= self.horizon:
+            pressure = max(pressure, self.min_headroom / max(headroom[1], 1e-3))
+        latencies = [item[2] for item in attempts if item[2] is not None]
+        recent_latencies = [item[2] for item in recent[-5:] if item[2] is not None]
+        if len(latencies) >= 20 and recent_latencies:
+            usual = sorted(latencies)[len(latencies) // 2]
+            pressure = max(pressure, sum(recent_latencies) / len(recent_latencies) / (self.slow_factor * usual))
+        return pressure
+
+    def gap(self, backends):
+        # backends: (api_type, model) pairs used by the dialogue
+        if self.fixed_gap is not None:
+            return self.fixed_gap
+        pressure = max((self.pressure(api_type, model) for api_type, model in backends), default=0.0)
+        if pressure <= 1.0:
+            return 0.0
+        return min(self.max_gap, self.base_gap * pressure)
+
+    def pause(self, backends):
+        # Sleeps for the current gap and returns it. A backend already paused by its rate limiter (after a 429 with
+        # Retry-After) holds the next call there, so that wait is not added again here.
+        gap = self.gap(backends)
+        blocked = max((get_rate_limiter(api_type, model).blocked_until - time.monotonic() for api_type, model in backends), default=0.0)
+        gap = max(0.0, gap - max(blocked, 0.0))
+        for api_type, model in backends:
+            metrics.observe("llm_pacing_idle_seconds", {"backend": api_type, "model": model}, gap)
+        if gap > 0:
+            time.sleep(gap)
+        return gap
+
+
+_pacer = Pacer()
+retry_stats.hooks.append(lambda **kwargs: _pacer.observe_attempt(**kwargs))
+
+
+def configure_pacing(**kwargs):
+    global _pacer
+    _pacer = Pacer(**kwargs)
+    return _pacer
+
+
+def get_pacer():
+    return _pacer
+
+
+def record_rate_limit_headers(api_type):
+    # httpx response hooks that feed the rate-limit headers of every response to the pacer
+    def hook(response):
+        _pacer.observe_headers(api_type, response.headers)
+
+    async def async_hook(response):
+        _pacer.observe_headers(api_type, response.headers)
+
+    return hook, async_hook
@@ -0,0 +1,117 @@
+import time
+import asyncio
+import threading
+
+DEFAULT_COMPLETION_TOKENS = 256  # completion reserved per request until replies of the model have been observed
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        # Take the amount right away (the level may go negative) and return how long the caller has to wait
+        self.refill(now)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """Requests-per-minute / tokens-per-minute limiter shared by every call to one backend model."""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self.completions = 0  # replies observed, and their completion tokens
+        self.completion_tokens = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, num_tokens=0):
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(num_tokens, now))
+        return wait
+
+    def acquire(self, num_tokens=0):
+        wait = self.reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, num_tokens=0):
+        wait = self.reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def expected_completion(self, max_tokens=None):
+        # Mean completion tokens of the replies so far (capped by the request's max_tokens)
+        with self.lock:
+            expected = -(-self.completion_tokens // self.completions) if self.completions else DEFAULT_COMPLETION_TOKENS
+        return min(expected, max_tokens) if max_tokens else expected
+
+    def record_usage(self, estimated_tokens, used_tokens, completion_tokens=None):
+        # Replace the up-front estimate with the usage reported by the backend
+        if completion_tokens is not None:
+            with self.lock:
+                self.completions += 1
+                self.completion_tokens += completion_tokens
+        if self.tokens is None or used_tokens is None:
+            return
+        with self.lock:
+            if used_tokens > estimated_tokens:
+                self.tokens.level -= used_tokens - estimated_tokens
+            else:
+                self.tokens.refund(estimated_tokens - used_tokens)
+
+    def penalize(self, seconds):
+        # Pause every caller sharing this limiter, e.g. after the backend answered with a 429
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+_limiters = {}
+
+
+def configure_rate_limit(api_type, model=None, rpm=None, tpm=None, num_processes=1):
+    # model=None sets the default for every model of the backend.
+    # With num_processes > 1 (e.g. a multiprocessing.Pool) each process gets an equal share of the budget.
+    rpm = rpm / num_processes if rpm else None
+    tpm = tpm / num_processes if tpm else None
+    _limiters[(api_type, model)] = RateLimiter(rpm=rpm, tpm=tpm)
+    return _limiters[(api_type, model)]
+
+
+def get_rate_limiter(api_type, model=None):
+    if (api_type, model) in _limiters:
+        return _limiters[(api_type, model)]
+    if (api_type, None) not in _limiters:
+        # Unlimited by default, but still a separate object so a 429 on one backend does not pause the others
+        _limiters[(api_type, None)] = RateLimiter()
+    return _limiters[(api_type, None)]
+
+
+def estimate_tokens(message, max_tokens=None):
+    # Rough count (~4 characters per token) used to reserve TPM budget before the real usage is known
+    if isinstance(message, str):
+        num_chars = len(message)
+    else:
+        num_chars = sum(len(str(item.get("content", ""))) + 16 for item in message)
+    return num_chars // 4 + (max_tokens or 0)
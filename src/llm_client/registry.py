@@ -0,0 +1,119 @@
+import os
+import threading
+
+REGISTRY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "model_registry.yaml")
+DEFAULT_CONCURRENCY = 8
+
+_registry = None
+_lock = threading.Lock()
+
+
+def load_registry(path=None):
+    # Parsed once per process; LLM_MODEL_REGISTRY points to a replacement file (e.g. a site-specific vLLM setup)
+    global _registry
+    import yaml
+
+    path = path or os.environ.get("LLM_MODEL_REGISTRY", REGISTRY_PATH)
+    with open(path, "r") as f:
+        registry = yaml.safe_load(f)
+
+    models = {}
+    for alias, spec in registry.get("models", {}).items():
+        assert spec.get("provider") in registry.get("providers", {}), f"Unknown provider for {alias}: {spec.get('provider')}"
+        models[alias] = dict(spec, alias=alias, model=spec.get("model", alias))
+    with _lock:
+        _registry = {"providers": registry.get("providers", {}), "models": models, "served": {spec["model"]: spec for spec in models.values()}}
+    return _registry
+
+
+def get_registry():
+    if _registry is None:
+        load_registry()
+    return _registry
+
+
+def register_model(alias, provider, **spec):
+    # Runtime registration, e.g. for a model served only in one experiment
+    registry = get_registry()
+    assert provider in registry["providers"], f"Unknown provider: {provider}"
+    spec = dict(spec, alias=alias, provider=provider, model=spec.get("model", alias))
+    with _lock:
+        registry["models"][alias] = spec
+        registry["served"][spec["model"]] = spec
+    return spec
+
+
+def get_model_spec(model):
+    # Accepts either the alias (vllm-llama3.3-70b-instruct) or the served name (meta-llama/Llama-3.3-70B-Instruct)
+    registry = get_registry()
+    return registry["models"].get(model) or registry["served"].get(model)
+
+
+def resolve_model(model):
+    # Alias -> name sent to the server. Unregistered names are passed through, except unknown vLLM aliases.
+    spec = get_model_spec(model)
+    if spec is not None:
+        return spec["model"]
+    if model.startswith("vllm-"):
+        raise ValueError(f"Invalid model: {model}")
+    return model
+
+
+def list_models(providers=None):
+    # Aliases for argparse `choices`, optionally restricted to some providers
+    return [alias for alias, spec in get_registry()["models"].items() if providers is None or spec["provider"] in providers]
+
+
+def list_providers():
+    return list(get_registry()["providers"])
+
+
+def get_endpoints(model, default=None):
+    spec = get_model_spec(model) or {}
+    return list(spec.get("endpoints") or ([default] if default else []))
+
+
+def get_load_balancing(api_type, model):
+    # Provider options, overridden by the model's own `load_balancing` block
+    options = dict(get_registry()["providers"].get(api_type, {}).get("load_balancing") or {})
+    options.update((get_model_spec(model) or {}).get("load_balancing") or {})
+    return options
+
+
+def get_concurrency(api_type, model=None):
+    spec = get_model_spec(model) if model else None
+    if spec is not None and spec.get("concurrency"):
+        return spec["concurrency"]
+    return get_registry()["providers"].get(api_type, {}).get("concurrency", DEFAULT_CONCURRENCY)
+
+
+def get_context_window(model, default=None):
+    spec = get_model_spec(model) or {}
+    return spec.get("context_window", default)
+
+
+def get_max_tokens(model, default=None):
+    spec = get_model_spec(model) or {}
+    return spec.get("max_tokens", default)
+
+
+def get_tokenizer_name(api_type, model):
+    # None means no local tokenizer is known and token counts are estimated from characters
+    spec = get_model_spec(model) or {}
+    if spec.get("tokenizer"):
+        return spec["tokenizer"]
+    if get_registry()["providers"].get(api_type, {}).get("tokenizer"):
+        return get_registry()["providers"][api_type]["tokenizer"]
+    return spec.get("model") if api_type == "vllm" else None
+
+
+def get_pricing(model):
+    # USD per 1M tokens; unregistered models are priced at zero
+    spec = get_model_spec(model) or {}
+    pricing = spec.get("pricing") or {}
+    return {"input": float(pricing.get("input", 0.0)), "output": float(pricing.get("output", 0.0))}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    pricing = get_pricing(model)
+    return (prompt_tokens * pricing["input"] + completion_tokens * pricing["output"]) / 1e6
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+def request_key(api_type, model, message, temperature, seed, **kwargs):
+    request = {"api_type": api_type, "model": model, "messages": message, "temperature": temperature, "seed": seed, "params": kwargs}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+
+def is_deterministic(temperature, seed):
+    return temperature == 0 and seed is not None
+
+
+class ResponseCache:
+    """On-disk (SQLite) cache of LLM responses keyed by request hash, with size and age based eviction.
+
+    The total size of the records is kept in a `meta` row, updated by triggers in the same transaction as each write,
+    so a put does not have to sum the whole table.
+    """
+
+    def __init__(self, path, max_size_mb=1024, max_age_days=None, readonly=False):
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb else None
+        self.max_age = max_age_days * 24 * 3600 if max_age_days else None
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pid = None
+        self.conn = None
+
+    def connect(self):
+        # SQLite connections must not cross a fork, so every process opens its own
+        if self.conn is None or self.pid != os.getpid():
+            if self.readonly:
+                self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+            else:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, record TEXT, size INTEGER, created REAL, accessed REAL);
+                    CREATE INDEX IF NOT EXISTS responses_created ON responses (created);
+                    CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+                    CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+                    BEGIN IMMEDIATE;
+                    INSERT OR IGNORE INTO meta SELECT 'total_size', COALESCE(SUM(size), 0) FROM responses;
+                    CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+                        BEGIN UPDATE meta SET value = value + new.size WHERE name = 'total_size'; END;
+                    CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+                        BEGIN UPDATE meta SET value = value - old.size WHERE name = 'total_size'; END;
+                    CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses
+                        BEGIN UPDATE meta SET value = value + new.size - old.size WHERE name = 'total_size'; END;
+                    COMMIT;
+                    """
+                )
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            conn = self.connect()
+            row = conn.execute("SELECT record, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age is not None and time.time() - row[1] > self.max_age:
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.readonly:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key, record):
+        if self.readonly:
+            return
+        data = json.dumps(record, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            conn = self.connect()
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete would not fire the size trigger
+            conn.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "record = excluded.record, size = excluded.size, created = excluded.created, accessed = excluded.accessed",
+                (key, data, len(data), now, now),
+            )
+            conn.commit()
+            self.evict(conn)
+
+    def total_size(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+
+    def evict(self, conn):
+        if self.max_age is not None:
+            conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+        if self.max_size is not None:
+            total_size = self.total_size(conn)
+            if total_size > self.max_size:
+                # Drop least recently used entries until the cache is back to 90% of its budget
+                excess = total_size - int(self.max_size * 0.9)
+                freed = 0
+                stale_keys = []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    stale_keys.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+        conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+_cache = None
+
+
+def configure_cache(path, max_size_mb=1024, max_age_days=None, readonly=False):
+    global _cache
+    _cache = ResponseCache(path, max_size_mb=max_size_mb, max_age_days=max_age_days, readonly=readonly) if path else None
+    return _cache
+
+
+def get_cache():
+    global _cache
+    if _cache is None and os.environ.get("LLM_CACHE_PATH"):
+        configure_cache(os.environ["LLM_CACHE_PATH"], readonly=os.environ.get("LLM_CACHE_READONLY", "") == "1")
+    return _cache
+
+
+def log_cache_stats():
+    if _cache is not None:
+        logging.info(f"LLM response cache ({_cache.path}): {_cache.stats()}")
+        print(f"LLM response cache: {_cache.stats()}")
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+
+def response_to_record(response):
+    # Keep only what get_answer / get_token_log read, so the record can be stored as JSON
+    if hasattr(response, "choices"):
+        usage = response.usage
+        record = {
+            "format": "openai",
+            "text": response.choices[0].message.content,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+        }
+        details = getattr(usage, "completion_tokens_details", None)
+        if details is not None and getattr(details, "reasoning_tokens", None) is not None:
+            record["reasoning_tokens"] = details.reasoning_tokens
+    elif hasattr(response, "text"):
+        usage = response.usage_metadata
+        record = {
+            "format": "genai",
+            "text": response.text,
+            "prompt_tokens": usage.prompt_token_count,
+            "completion_tokens": usage.candidates_token_count,
+            "total_tokens": usage.total_token_count,
+        }
+    else:
+        raise NotImplementedError(f"Fail to convert response: {response}")
+    return record
+
+
+def record_to_response(record):
+    # Rebuild a lightweight object shaped like the original OpenAI / genai response
+    if record["format"] == "genai":
+        usage_metadata = SimpleNamespace(
+            prompt_token_count=record["prompt_tokens"],
+            candidates_token_count=record["completion_tokens"],
+            total_token_count=record["total_tokens"],
+        )
+        return SimpleNamespace(text=record["text"], usage_metadata=usage_metadata)
+
+    usage = SimpleNamespace(
+        prompt_tokens=record["prompt_tokens"],
+        completion_tokens=record["completion_tokens"],
+        total_tokens=record["total_tokens"],
+    )
+    if "reasoning_tokens" in record:
+        usage.completion_tokens_details = SimpleNamespace(reasoning_tokens=record["reasoning_tokens"])
+    message = SimpleNamespace(role="assistant", content=record["text"])
+    return SimpleNamespace(choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")], usage=usage)
@@ -0,0 +1,185 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+
+# Error classes that are worth another attempt. Context-length errors are retried only after the prompt is trimmed.
+# Unclassified errors (e.g. an AttributeError in the client code) are raised right away.
+RETRYABLE_ERRORS = {"rate_limit", "server", "timeout", "connection"}
+
+
+class CircuitOpenError(Exception):
+    # Raised without calling the backend while its circuit breaker is open (see circuit_breaker.py)
+    def __init__(self, api_type, retry_after):
+        super().__init__(f"circuit open for {api_type}, retry in {retry_after:.1f}s")
+        self.api_type = api_type
+        self.retry_after = retry_after
+
+
+def get_status_code(error):
+    # openai errors carry `status_code`, google-genai errors carry `code`
+    for attr in ["status_code", "code"]:
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def classify_error(error):
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    status_code = get_status_code(error)
+    error_msg = str(error).lower()
+    error_name = type(error).__name__.lower()
+
+    if "context_length" in error_msg or "maximum context length" in error_msg or ("context" in error_msg and "length" in error_msg):
+        return "context_length"
+    if status_code == 429 or "rate limit" in error_msg or "resource_exhausted" in error_msg or "ratelimit" in error_name:
+        return "rate_limit"
+    if status_code in [401, 403] or "authentication" in error_name or "permissiondenied" in error_name:
+        return "auth"
+    if "timeout" in error_name:
+        return "timeout"
+    if "connection" in error_name or "protocolerror" in error_name or isinstance(error, ConnectionError):
+        return "connection"
+    if status_code is not None and status_code >= 500:
+        return "server"
+    if status_code is not None and 400 <= status_code < 500:
+        return "bad_request"
+    if isinstance(error, (TypeError, ValueError, KeyError, AssertionError, NotImplementedError)):
+        return "bad_request"
+    return "unknown"
+
+
+def get_retry_after(error):
+    # Seconds requested by the server through Retry-After style headers, if any
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    for header, scale in [("retry-after-ms", 0.001), ("retry-after", 1.0), ("x-ratelimit-reset-requests", 1.0)]:
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(str(value).rstrip("s")) * scale
+        except ValueError:
+            continue
+    return None
+
+
+class RetryStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = defaultdict(int)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.sleep_seconds = defaultdict(float)
+        self.hooks = []
+
+    def record(self, label, attempt, error_class=None, delay=0.0, elapsed=0.0):
+        with self.lock:
+            self.attempts[label] += 1
+            if error_class is not None:
+                self.errors[label][error_class] += 1
+            self.sleep_seconds[label] += delay
+        for hook in self.hooks:
+            hook(label=label, attempt=attempt, error_class=error_class, delay=delay, elapsed=elapsed)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "/".join(label): {"attempts": self.attempts[label], "errors": dict(self.errors[label]), "sleep_seconds": self.sleep_seconds[label]}
+                for label in self.attempts
+            }
+
+
+retry_stats = RetryStats()
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=6, base_delay=2.0, max_delay=60.0, jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def backoff(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def next_step(self, attempt, error, message, trim, limiter, label):
+        # Returns (message, delay) for the next attempt, or re-raises when the error is final
+        error_class = classify_error(error)
+        if error_class == "context_length":
+            trimmed = trim(message) if trim is not None else None
+            if trimmed is None or attempt >= self.max_attempts:
+                retry_stats.record(label, attempt, error_class)
+                raise error
+            logging.warning(f"[{'/'.join(label)}] attempt {attempt}: context too long, retrying with a trimmed prompt")
+            retry_stats.record(label, attempt, error_class)
+            return trimmed, 0.0
+        if error_class == "circuit_open":
+            retry_stats.record(label, attempt, error_class)
+            raise error  # already logged by the breaker, and handled by the caller (fallback or parking)
+        if error_class not in RETRYABLE_ERRORS or attempt >= self.max_attempts:
+            retry_stats.record(label, attempt, error_class)
+            logging.error(f"[{'/'.join(label)}] giving up after {attempt} attempt(s) ({error_class}): {error}")
+            raise error
+
+        delay = self.backoff(attempt, error)
+        if error_class == "rate_limit" and limiter is not None:
+            # Pause every caller sharing the limiter instead of only this one
+            limiter.penalize(delay)
+        retry_stats.record(label, attempt, error_class, delay)
+        logging.warning(f"[{'/'.join(label)}] attempt {attempt} failed ({error_class}), retrying in {delay:.1f}s: {error}")
+        return message, delay
+
+    def call(self, send, message, trim=None, limiter=None, label=("", "")):
+        attempt = 0
+        while True:
+            attempt += 1
+            start_time = time.monotonic()
+            try:
+                response = send(message)
+                retry_stats.record(label, attempt, elapsed=time.monotonic() - start_time)
+                return response
+            except Exception as e:
+                message, delay = self.next_step(attempt, e, message, trim, limiter, label)
+                time.sleep(delay)
+
+    async def call_async(self, send, message, trim=None, limiter=None, label=("", "")):
+        attempt = 0
+        while True:
+            attempt += 1
+            start_time = time.monotonic()
+            try:
+                response = await send(message)
+                retry_stats.record(label, attempt, elapsed=time.monotonic() - start_time)
+                return response
+            except Exception as e:
+                message, delay = self.next_step(attempt, e, message, trim, limiter, label)
+                await asyncio.sleep(delay)
+
+
+_policies = {}
+_default_policy = RetryPolicy()
+
+
+def configure_retry(api_type=None, **kwargs):
+    # api_type=None changes the default policy shared by every backend
+    global _default_policy
+    policy = RetryPolicy(**kwargs)
+    if api_type is None:
+        _default_policy = policy
+    else:
+        _policies[api_type] = policy
+    return policy
+
+
+def get_retry_policy(api_type):
+    return _policies.get(api_type, _default_policy)
@@ -0,0 +1,144 @@
+import time
+import threading
+from collections import defaultdict
+
+from llm_client.responses import record_to_response
+
+CHARS_PER_TOKEN = 4  # usage estimate for streams that end without a usage chunk (e.g. stopped early)
+
+
+def openai_chunks(stream):
+    # OpenAI-compatible stream -> (text delta, usage dict or None); usage comes in the last chunk with include_usage
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            yield text or "", {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens, "total_tokens": usage.total_tokens} if usage else None
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+def genai_chunks(stream):
+    # genai reports cumulative usage_metadata on the chunks, the last one is the total
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage is not None and usage.total_token_count:
+                usage = {"prompt_tokens": usage.prompt_token_count, "completion_tokens": usage.candidates_token_count or 0, "total_tokens": usage.total_token_count}
+            else:
+                usage = None
+            yield getattr(chunk, "text", None) or "", usage
+    finally:
+        if hasattr(stream, "close"):
+            stream.close()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StreamStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ttft = defaultdict(list)
+        self.inter_token = defaultdict(list)
+        self.durations = defaultdict(list)
+        self.completion_tokens = defaultdict(int)
+
+    def record(self, label, ttft, inter_token_latencies, duration, completion_tokens):
+        with self.lock:
+            if ttft is not None:
+                self.ttft[label].append(ttft)
+            self.inter_token[label].extend(inter_token_latencies)
+            self.durations[label].append(duration)
+            self.completion_tokens[label] += completion_tokens
+
+    def summary(self):
+        with self.lock:
+            return {
+                "/".join(str(part) for part in label): {
+                    "calls": len(self.durations[label]),
+                    "ttft_p50": percentile(self.ttft[label], 0.5),
+                    "ttft_p95": percentile(self.ttft[label], 0.95),
+                    "inter_token_p50": percentile(self.inter_token[label], 0.5),
+                    "inter_token_p95": percentile(self.inter_token[label], 0.95),
+                    "tokens_per_second": self.completion_tokens[label] / max(sum(self.durations[label]), 1e-9),
+                }
+                for label in self.durations
+            }
+
+
+stream_stats = StreamStats()
+
+
+class ResponseStream:
+    """Iterator of text deltas for one streamed request.
+
+    Once the iteration ends (or the consumer stops early), `response` holds a response object that works with
+    get_answer / get_token_log like a non-streamed one, and `ttft` / `inter_token_latencies` hold the timings
+    (latencies are measured between received chunks, which usually carry one token each).
+    """
+
+    def __init__(self, chunks, record_format, label, start_time, prompt_tokens=0, on_complete=None):
+        self.chunks = chunks
+        self.record_format = record_format
+        self.label = label
+        self.start_time = start_time
+        self.prompt_tokens = prompt_tokens
+        self.on_complete = on_complete
+        self.parts = []
+        self.usage = None
+        self.response = None
+        self.completed = False
+        self.failed = False
+        self.ttft = None
+        self.inter_token_latencies = []
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def __iter__(self):
+        last_time = None
+        try:
+            for delta, usage in self.chunks:
+                if usage is not None:
+                    self.usage = usage
+                if not delta:
+                    continue
+                now = time.monotonic()
+                if last_time is None:
+                    self.ttft = now - self.start_time
+                else:
+                    self.inter_token_latencies.append(now - last_time)
+                last_time = now
+                self.parts.append(delta)
+                yield delta
+            self.completed = True
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        # Ends the request (closing the HTTP stream if it is still open) and builds the final response
+        if self.response is not None:
+            return
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        text = self.text
+        usage = self.usage if self.completed and self.usage is not None else None
+        if usage is None:
+            completion_tokens = -(-len(text) // CHARS_PER_TOKEN)
+            usage = {"prompt_tokens": self.prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": self.prompt_tokens + completion_tokens}
+        self.response = record_to_response({"format": self.record_format, "text": text, **usage})
+        duration = time.monotonic() - self.start_time
+        if self.label is not None:  # label None: replayed from the cache, not a backend measurement
+            stream_stats.record(self.label, self.ttft, self.inter_token_latencies, duration, usage["completion_tokens"])
+        if self.on_complete is not None:
+            self.on_complete(self.response, duration, self.completed, self.failed, self.ttft)
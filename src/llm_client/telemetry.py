@@ -0,0 +1,228 @@
+import json
+import bisect
+import threading
+import contextvars
+from collections import defaultdict, deque
+
+from llm_client.retry import retry_stats
+
+# Set by the response methods for the duration of a call, so every layer below can label its metrics by caller
+current_caller = contextvars.ContextVar("llm_caller", default=None)
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+THROUGHPUT_BUCKETS = [1, 5, 10, 25, 50, 100, 200, 500, 1000]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10]
+WAVE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+SHARE_BUCKETS = [0.1, 0.25, 0.5, 0.75, 0.9, 1.0]
+WAVE_THROUGHPUT_BUCKETS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+HISTOGRAMS = {
+    "llm_request_latency_seconds": ("End-to-end latency of a backend call, retries included", LATENCY_BUCKETS),
+    "llm_time_to_first_token_seconds": ("Time to the first streamed token", LATENCY_BUCKETS),
+    "llm_tokens_per_second": ("Completion tokens per second of a call", THROUGHPUT_BUCKETS),
+    "llm_retries": ("Failed attempts before a call succeeded", COUNT_BUCKETS),
+    "llm_queue_wait_seconds": ("Time waiting for the rate limiter / concurrency slot", LATENCY_BUCKETS),
+    "llm_pacing_idle_seconds": ("Idle time between dialogue turns set by the pacer", LATENCY_BUCKETS),
+    "llm_wave_size": ("Dialogues stepped together in a phase of a lockstep wave", WAVE_BUCKETS),
+    "llm_wave_occupancy": ("Share of the lockstep wave slots in use", SHARE_BUCKETS),
+    "llm_wave_tokens_per_second": ("Completion tokens per second of a lockstep wave phase", WAVE_THROUGHPUT_BUCKETS),
+}
+COUNTERS = {
+    "llm_requests_total": "Completed backend calls",
+    "llm_cache_hits_total": "Calls served from the response cache or a replay cassette",
+    "llm_errors_total": "Failed attempts by error class",
+    "llm_prompt_tokens_total": "Prompt tokens",
+    "llm_completion_tokens_total": "Completion tokens",
+    "llm_endpoint_requests_total": "Requests routed to each vLLM replica",
+    "llm_endpoint_ejections_total": "Times a vLLM replica was taken out of rotation",
+    "llm_hedges_total": "Duplicate requests sent after the hedge delay",
+    "llm_hedge_wins_total": "Hedged requests whose duplicate answered first",
+    "llm_hedges_skipped_total": "Slow requests not hedged because the extra-load budget was used up",
+    "llm_circuit_opened_total": "Times a backend's circuit breaker opened",
+    "llm_circuit_rejected_total": "Calls rejected without a request while a circuit breaker was open",
+    "llm_cost_usd_total": "Cost of the backend calls in USD, from the model registry pricing",
+    "llm_fallback_calls_total": "Calls sent to the fallback backend while the circuit of their own backend was open",
+}
+SAMPLE_SIZE = 10000  # recent observations kept per series for the JSON quantiles
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def quantile(self, q):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {str(le): n for le, n in zip(self.buckets + ["+Inf"], self.counts)},
+            "samples": list(self.samples),
+        }
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(dict)  # name -> labels key -> Histogram
+        self.counters = defaultdict(lambda: defaultdict(float))  # name -> labels key -> value
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            series = self.histograms[name]
+            key = labels_key(labels)
+            if key not in series:
+                series[key] = Histogram(HISTOGRAMS[name][1])
+            series[key].observe(value)
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name][labels_key(labels)] += value
+
+    def record_call(self, labels, latency, prompt_tokens=None, completion_tokens=None, ttft=None):
+        self.inc("llm_requests_total", labels)
+        self.observe("llm_request_latency_seconds", labels, latency)
+        if ttft is not None:
+            self.observe("llm_time_to_first_token_seconds", labels, ttft)
+        if prompt_tokens is not None:
+            self.inc("llm_prompt_tokens_total", labels, prompt_tokens)
+        if completion_tokens is not None:
+            self.inc("llm_completion_tokens_total", labels, completion_tokens)
+            generation_time = latency - (ttft or 0.0)
+            if generation_time > 0:
+                self.observe("llm_tokens_per_second", labels, completion_tokens / generation_time)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "histograms": {name: [{"labels": dict(key), **hist.to_dict()} for key, hist in series.items()] for name, series in self.histograms.items()},
+                "counters": {name: [{"labels": dict(key), "value": value} for key, value in series.items()] for name, series in self.counters.items()},
+            }
+
+    def merge(self, snapshot):
+        # Add a snapshot taken in another process (e.g. a multiprocessing.Pool worker)
+        with self.lock:
+            for name, series in snapshot.get("histograms", {}).items():
+                for entry in series:
+                    key = labels_key(entry["labels"])
+                    hist = self.histograms[name].setdefault(key, Histogram(HISTOGRAMS[name][1]))
+                    hist.counts = [a + b for a, b in zip(hist.counts, entry["buckets"].values())]
+                    hist.count += entry["count"]
+                    hist.sum += entry["sum"]
+                    hist.samples.extend(entry["samples"])
+            for name, series in snapshot.get("counters", {}).items():
+                for entry in series:
+                    self.counters[name][labels_key(entry["labels"])] += entry["value"]
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        for series in snapshot["histograms"].values():
+            for entry in series:
+                entry.pop("samples")
+        return snapshot
+
+    def to_prometheus(self):
+        def format_labels(key, extra=()):
+            items = list(key) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+        lines = []
+        with self.lock:
+            for name, series in self.histograms.items():
+                lines += [f"# HELP {name} {HISTOGRAMS[name][0]}", f"# TYPE {name} histogram"]
+                for key, hist in series.items():
+                    cumulative = 0
+                    for le, n in zip(hist.buckets + ["+Inf"], hist.counts):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{format_labels(key, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(key)} {hist.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {hist.count}")
+            for name, series in self.counters.items():
+                lines += [f"# HELP {name} {COUNTERS[name]}", f"# TYPE {name} counter"]
+                for key, value in series.items():
+                    lines.append(f"{name}{format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path_prefix):
+        # Writes <prefix>.json (summary with quantiles) and <prefix>.prom (Prometheus text format)
+        with open(f"{path_prefix}.json", "w") as f:
+            json.dump(self.to_json(), f, indent=2)
+        with open(f"{path_prefix}.prom", "w") as f:
+            f.write(self.to_prometheus())
+
+    def save_snapshot(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f)
+
+
+metrics = MetricsRegistry()
+
+
+def call_labels(api_type, model, caller=None):
+    return {"backend": api_type, "model": model, "caller": caller or current_caller.get() or api_type}
+
+
+def record_attempt(label, attempt, error_class=None, delay=0.0, elapsed=0.0):
+    # retry_stats hook: label is (api_type, model)
+    labels = call_labels(*label)
+    if error_class is not None:
+        metrics.inc("llm_errors_total", dict(labels, error_class=error_class))
+    else:
+        metrics.observe("llm_retries", labels, attempt - 1)
+
+
+retry_stats.hooks.append(record_attempt)
+
+
+def serve_metrics(port, host="0.0.0.0"):
+    # Live endpoint for a running job: /metrics (Prometheus text) and /metrics.json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, content_type = json.dumps(metrics.to_json()).encode("utf-8"), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = metrics.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,151 @@
+import os
+import re
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import load_json, save_to_json, save_to_jsonl, record_key
+from llm_client.telemetry import MetricsRegistry
+from llm_client.cost import CostLedger
+
+# Output file of one shard, written by run_simulation.py / run_sweep.py / eval/*.py with num_shards > 1
+SHARD_FILE = re.compile(r"^(?P<name>.+)\.shard-(?P<index>\d+)-of-(?P<num_shards>\d+)(?P<ext>\.jsonl|\.json)$")
+
+
+def natural_key(values):
+    # hadm_ids sort as numbers
+    return tuple((0, int(value), "") if str(value).isdigit() else (1, 0, str(value)) for value in values)
+
+
+def find_shard_files(shard_dirs):
+    # (dir relative to its shard dir, file name, num_shards) -> {shard index: [paths]}
+    groups = defaultdict(lambda: defaultdict(list))
+    for shard_dir in shard_dirs:
+        for root, _, files in os.walk(shard_dir):
+            for file in sorted(files):
+                match = SHARD_FILE.match(file)
+                if match is not None:
+                    key = (os.path.relpath(root, shard_dir), match["name"] + match["ext"], int(match["num_shards"]))
+                    groups[key][int(match["index"])].append(os.path.join(root, file))
+    return groups
+
+
+def read_records(path):
+    # Records of a dialogue.jsonl; a last line cut off by a crash is skipped
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping an incomplete line in {path}")
+    return records
+
+
+def merge_dialogues(paths, stats):
+    # One record per hadm_id / persona / backends, sorted by that key
+    merged = {}
+    for path in paths:
+        for record in read_records(path):
+            key = record_key(record, with_backends=True)
+            if key not in merged:
+                merged[key] = record
+                continue
+            stats["duplicates"] += 1
+            if record["dialog_history"] != merged[key]["dialog_history"]:
+                stats["conflicts"] += 1
+                print(f"Conflicting dialogues for {key} in {path}: keeping the first one")
+    stats["records"] = len(merged)
+    return [merged[key] for key in sorted(merged, key=natural_key)]
+
+
+def merge_results(merged, results, path, stats):
+    # Eval results are nested dicts whose innermost keyed level is the hadm_id (e.g. {criterion: {hadm_id: answer}})
+    for key, value in results.items():
+        if key not in merged:
+            merged[key] = value
+            if str(key).isdigit():
+                stats["records"] += 1
+        elif str(key).isdigit() or not (isinstance(value, dict) and isinstance(merged[key], dict)):
+            stats["duplicates"] += 1
+            if value != merged[key]:
+                stats["conflicts"] += 1
+                print(f"Conflicting results for {key} in {path}: keeping the first one")
+        else:
+            merge_results(merged[key], value, path, stats)
+    return merged
+
+
+def normalize(results):
+    # hadm_id keys in numeric order; other keys (e.g. criteria) keep their order
+    if not isinstance(results, dict):
+        return results
+    if results and all(str(key).isdigit() for key in results):
+        return {key: results[key] for key in sorted(results, key=lambda key: int(key))}
+    return {key: normalize(value) for key, value in results.items()}
+
+
+def main(args):
+    groups = find_shard_files(args.shard_dirs)
+    if not groups:
+        print(f"No shard outputs (<file>.shard-<i>-of-<n>.json[l]) found in {args.shard_dirs}")
+        return
+    names = defaultdict(set)
+    for rel_dir, name, num_shards in groups:
+        names[(rel_dir, name)].add(num_shards)
+    for (rel_dir, name), counts in names.items():
+        assert len(counts) == 1, f"{os.path.join(rel_dir, name)} was sharded in different ways ({sorted(counts)} shards)"
+
+    for (rel_dir, name, num_shards), shards in sorted(groups.items()):
+        if name.endswith("llm_metrics.json"):
+            continue  # per-shard summaries (quantiles) cannot be merged; rebuilt from the snapshots
+        missing = sorted(set(range(num_shards)) - set(shards))
+        paths = [path for index in sorted(shards) for path in shards[index]]
+        stats = {"records": 0, "duplicates": 0, "conflicts": 0}
+        save_path = os.path.normpath(os.path.join(args.output_dir, rel_dir, name.replace("_snapshot.json", ".json")))
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        assert args.overwrite or not os.path.isfile(save_path), f"{save_path} exists (use --overwrite)"
+
+        if name.endswith(".jsonl"):
+            save_to_jsonl(merge_dialogues(paths, stats), save_path)
+        elif name.endswith("cost_summary.json"):
+            ledger = CostLedger()
+            budgets = []
+            for path in paths:
+                summary = load_json(path)
+                ledger.merge(summary)
+                budgets.append(summary.get("budget_usd"))
+            ledger.budget = sum(budgets) if None not in budgets else None
+            ledger.save(save_path)
+            stats["records"] = len(ledger.entries)
+        elif name.endswith("llm_metrics_snapshot.json"):
+            # Raw counts: merged, then written as <prefix>.json / .prom like an unsharded run
+            registry = MetricsRegistry()
+            for path in paths:
+                registry.merge(load_json(path))
+            registry.dump(save_path[: -len(".json")])
+            stats["records"] = sum(len(series) for series in registry.counters.values())
+        else:
+            merged = {}
+            for path in paths:
+                merge_results(merged, load_json(path), path, stats)
+            save_to_json(normalize(merged), save_path)
+
+        print(
+            f"{save_path}: {len(shards)} / {num_shards} shard(s), {stats['records']} record(s), "
+            f"{stats['duplicates']} duplicate(s) ({stats['conflicts']} conflicting)"
+            + (f", missing shard(s) {missing}" if missing else "")
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the outputs of sharded simulation / evaluation runs")
+    parser.add_argument("shard_dirs", nargs="+", help="run dirs (or result dirs) of the shards; they can also be one shared dir")
+    parser.add_argument("--output_dir", type=str, required=True, help="merged files are written here, at the same relative paths")
+    parser.add_argument("--overwrite", action="store_true", help="replace merged files that already exist")
+
+    args = parser.parse_args()
+    main(args)
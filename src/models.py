@@ -1,32 +1,61 @@
 import os
 import time
 import json
+import asyncio
 import datetime
-from google import genai
-from dotenv import load_dotenv
+import logging
+import weakref
+import threading
+from collections import OrderedDict
 
-from google.genai import types
-from google.genai.types import HttpOptions
-from openai import AzureOpenAI, OpenAI
+from llm_client.retry import get_retry_policy, classify_error
+from llm_client.rate_limiter import get_rate_limiter, estimate_tokens
+from llm_client.client_pool import get_client, get_async_client
+from llm_client.cassette import get_cassette
+from llm_client.response_cache import get_cache, request_key, is_deterministic
+from llm_client.responses import response_to_record, record_to_response
+from llm_client.mock_backend import mock_send, mock_send_async, mock_stream
+from llm_client.streaming import ResponseStream, openai_chunks, genai_chunks
+from llm_client.telemetry import metrics, current_caller, call_labels
+from llm_client.registry import get_model_spec, resolve_model, get_endpoints, get_concurrency, get_load_balancing
+from llm_client.load_balancer import get_endpoint_pool, current_session
+from llm_client.hedging import get_hedge_policy
+from llm_client.cost import cost_ledger
+from llm_client.circuit_breaker import CircuitOpenError, get_circuit_breaker, get_fallback
+from llm_client.context_window import get_context_policy, merge_summary, summary_request, summary_key
 
-# load_dotenv(override=True)
-GENAI_API_KEY = os.environ.get("GENAI_API_KEY", "")
-AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY", "")
-AZURE_ENDPOINT = os.environ.get("AZURE_ENDPOINT", "")
+# from dotenv import load_dotenv; load_dotenv(override=True)
 PORT = os.environ.get("VLLM_PORT", "")
+VLLM_API_BASE = f"http://localhost:{PORT.split(',')[0]}/v1"
+VLLM_API_BASES = [f"http://localhost:{port.strip()}/v1" for port in PORT.split(",")]  # VLLM_PORT=8000,8001 for local replicas
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "./google_credentials.json")
 
-if AZURE_OPENAI_KEY != "":
-    azure_client = AzureOpenAI(
-        azure_endpoint=AZURE_ENDPOINT,
-        api_key=AZURE_OPENAI_KEY,
-        api_version="2024-10-21",
-    )
+# Maximum number of in-flight async requests per backend model (per event loop).
+# Defaults come from config/model_registry.yaml; entries here override them for a whole api type.
+concurrency_limit = {}
+_semaphores = weakref.WeakKeyDictionary()
+# (api_type, model, dropped turns) -> summary, so a growing history is not re-summarized every turn. Least recently
+# used summaries are dropped beyond MAX_SUMMARIES (a finished dialogue's summaries are not needed again).
+MAX_SUMMARIES = 1024
+_summaries = OrderedDict()
+_summaries_lock = threading.Lock()
+
+
+def get_summary(key):
+    with _summaries_lock:
+        if key not in _summaries:
+            return None
+        _summaries.move_to_end(key)
+        return _summaries[key]
 
-if GENAI_API_KEY != "":
-    gen_client = genai.Client(vertexai=True, api_key=GENAI_API_KEY, http_options=HttpOptions(api_version="v1"))
 
-time_gap = {"gpt-4": 3}
+def put_summary(key, summary):
+    with _summaries_lock:
+        _summaries[key] = summary
+        _summaries.move_to_end(key)
+        while len(_summaries) > MAX_SUMMARIES:
+            _summaries.popitem(last=False)
+    return summary
 
 
 def get_answer(response):
@@ -59,22 +88,157 @@ def get_token_log(response):
     return token_usage
     
 
-def gpt_azure_response(message: list, model="gpt-4o", temperature=0, seed=42, **kwargs):
-    time.sleep(time_gap.get(model, 3))
+def completion_budget(limiter, **kwargs):
+    # Completion tokens reserved up front: the mean completion of the backend model so far, capped by the request's
+    # max_tokens (reserving the full max_tokens would hold back most of the TPM budget), reconciled by record_usage
+    return limiter.expected_completion(kwargs.get("max_tokens") or kwargs.get("max_completion_tokens"))
+
+
+def acquire_rate_limit(api_type, model, message, **kwargs):
+    limiter = get_rate_limiter(api_type, model)
+    estimated_tokens = estimate_tokens(message, completion_budget(limiter, **kwargs))
+    limiter.acquire(estimated_tokens)
+    return limiter, estimated_tokens
+
+
+async def acquire_rate_limit_async(api_type, model, message, **kwargs):
+    limiter = get_rate_limiter(api_type, model)
+    estimated_tokens = estimate_tokens(message, completion_budget(limiter, **kwargs))
+    await limiter.acquire_async(estimated_tokens)
+    return limiter, estimated_tokens
+
+
+def record_usage(limiter, estimated_tokens, response):
     try:
-        return azure_client.chat.completions.create(model=model, messages=message, temperature=temperature, seed=seed, **kwargs)
-    except Exception as e:
-        error_msg = str(e).lower()
-        if "context" in error_msg or "length" in error_msg:
-            if isinstance(message, list) and len(message) > 2:
-                message = [message[0]] + message[2:]
-        print(e)
-        time.sleep(time_gap.get(model, 3) * 2)
-        return gpt_azure_response(model=model, messages=message, temperature=temperature, seed=seed, **kwargs)
+        usage = get_token_log(response)
+        used_tokens, completion_tokens = usage["total_tokens"], usage["completion_tokens"]
+    except Exception:
+        used_tokens, completion_tokens = None, None
+    limiter.record_usage(estimated_tokens, used_tokens, completion_tokens)
+    return response
 
 
-def gemini_response(message: list, model="gemini-2.0-flash", temperature=0, seed=42, **kwargs):
-    time.sleep(time_gap.get(model, 3))
+def drop_oldest_turn(message):
+    # Used after a context-length error: drop the oldest non-system turn, or give up if nothing is left to drop
+    if isinstance(message, list) and len(message) > 2:
+        return [message[0]] + message[2:]
+    return None
+
+
+def fit_context(api_type, model, message, caller=None):
+    # Size the prompt with the model's tokenizer and apply the caller's context policy before sending it
+    policy = get_context_policy(caller)
+    message, dropped = policy.fit(message, api_type, model, caller)
+    if dropped and policy.strategy == "summarize":
+        key = (api_type, model, summary_key(dropped))
+        summary = get_summary(key)
+        if summary is None:
+            response = get_response_method(api_type)(summary_request(dropped), model=model, temperature=0, seed=0, caller="summarizer")
+            summary = put_summary(key, get_answer(response))
+        message = merge_summary(message, summary)
+    return message
+
+
+async def fit_context_async(api_type, model, message, caller=None):
+    policy = get_context_policy(caller)
+    message, dropped = policy.fit(message, api_type, model, caller)
+    if dropped and policy.strategy == "summarize":
+        key = (api_type, model, summary_key(dropped))
+        summary = get_summary(key)
+        if summary is None:
+            response = await get_async_response_method(api_type)(summary_request(dropped), model=model, temperature=0, seed=0, caller="summarizer")
+            summary = put_summary(key, get_answer(response))
+        message = merge_summary(message, summary)
+    return message
+
+
+def record_call_metrics(labels, response, latency):
+    try:
+        token_usage = get_token_log(response)
+    except Exception:
+        token_usage = {}
+    metrics.record_call(labels, latency, token_usage.get("prompt_tokens"), token_usage.get("completion_tokens"))
+    cost_ledger.record(labels, token_usage.get("prompt_tokens"), token_usage.get("completion_tokens"))
+
+
+def guarded(breaker, send):
+    # Checks the backend's circuit breaker before an attempt and reports its outcome
+    def attempt(message):
+        breaker.before_call()
+        try:
+            response = send(message)
+        except Exception as e:
+            breaker.record(classify_error(e))
+            raise
+        breaker.record()
+        return response
+
+    return attempt
+
+
+def guarded_async(breaker, send):
+    async def attempt(message):
+        breaker.before_call()
+        try:
+            response = await send(message)
+        except Exception as e:
+            breaker.record(classify_error(e))
+            raise
+        breaker.record()
+        return response
+
+    return attempt
+
+
+def call_backend(api_type, model, message, send, **kwargs):
+    # Circuit breaker + rate limiting + bounded retries around a single backend request
+    limiter = get_rate_limiter(api_type, model)
+    labels = call_labels(api_type, model)
+
+    def attempt(message):
+        wait_start = time.monotonic()
+        _, estimated_tokens = acquire_rate_limit(api_type, model, message, **kwargs)
+        metrics.observe("llm_queue_wait_seconds", labels, time.monotonic() - wait_start)
+        return record_usage(limiter, estimated_tokens, send(message))
+
+    start_time = time.monotonic()
+    response = get_retry_policy(api_type).call(
+        guarded(get_circuit_breaker(api_type), attempt), message, trim=drop_oldest_turn, limiter=limiter, label=(api_type, model)
+    )
+    record_call_metrics(labels, response, time.monotonic() - start_time)
+    return response
+
+
+async def call_backend_async(api_type, model, message, send, **kwargs):
+    limiter = get_rate_limiter(api_type, model)
+    labels = call_labels(api_type, model)
+
+    async def attempt(message):
+        wait_start = time.monotonic()
+        async with get_semaphore(api_type, model):
+            _, estimated_tokens = await acquire_rate_limit_async(api_type, model, message, **kwargs)
+            metrics.observe("llm_queue_wait_seconds", labels, time.monotonic() - wait_start)
+            response = await send(message)
+        return record_usage(limiter, estimated_tokens, response)
+
+    start_time = time.monotonic()
+    response = await get_retry_policy(api_type).call_async(
+        guarded_async(get_circuit_breaker(api_type), attempt), message, trim=drop_oldest_turn, limiter=limiter, label=(api_type, model)
+    )
+    record_call_metrics(labels, response, time.monotonic() - start_time)
+    return response
+
+
+def gpt_azure_response(message: list, model="gpt-4o", temperature=0, seed=42, **kwargs):
+    def send(message):
+        return get_client("gpt_azure").chat.completions.create(model=model, messages=message, temperature=temperature, seed=seed, **kwargs)
+
+    return call_backend("gpt_azure", model, message, send, **kwargs)
+
+
+def gemini_request(message, model, temperature, seed, **kwargs):
+    from google.genai import types  # imported on first use: the genai SDK is slow to import
+
     system_prompt = message[0]["content"] if message[0]["role"] == "system" else None
     if system_prompt:
         contents = message[1:]
@@ -86,93 +250,139 @@ def gemini_response(message: list, model="gemini-2.0-flash", temperature=0, seed
     except:
         raise NotImplementedError
 
-    try:
-        if model == "gemini-2.5-flash":
-            return gen_client.models.generate_content(
-                model=model,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    system_instruction=system_prompt,
-                    temperature=temperature,
-                    seed=seed,
-                    thinking_config=types.ThinkingConfig(thinking_budget=kwargs.get("thinking_budget", 0))
-                ),
-            )
-        else:
-            return gen_client.models.generate_content(
-                model=model,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    system_instruction=system_prompt,
-                    temperature=temperature,
-                    seed=seed,
-                ),
-            )
+    if model == "gemini-2.5-flash":
+        config = types.GenerateContentConfig(
+            system_instruction=system_prompt,
+            temperature=temperature,
+            seed=seed,
+            thinking_config=types.ThinkingConfig(thinking_budget=kwargs.get("thinking_budget", 0))
+        )
+    else:
+        config = types.GenerateContentConfig(
+            system_instruction=system_prompt,
+            temperature=temperature,
+            seed=seed,
+        )
+    return {"model": model, "contents": contents, "config": config}
+
+
+def gemini_response(message: list, model="gemini-2.0-flash", temperature=0, seed=42, **kwargs):
+    def send(message):
+        return get_client("genai").models.generate_content(**gemini_request(message, model, temperature, seed, **kwargs))
 
-    except Exception as e:
-        error_msg = str(e).lower()
-        if "context" in error_msg or "length" in error_msg or 'maximum context length' in error_msg:
-            if isinstance(message, list) and len(message) > 2:
-                message = [message[0]] + message[2:]
-        print(e)
-        time.sleep(time_gap.get(model, 3) * 2)
-        return gemini_response(message, model, temperature, seed, **kwargs)
+    return call_backend("genai", model, message, send, **kwargs)
 
 
 def vllm_model_setup(model):
-    if model == "vllm-llama3-70b-instruct":
-        model = "meta-llama/Llama-3-70B-Instruct"
-    elif model == "vllm-llama3-8b-instruct":
-        model = "meta-llama/Llama-3-8B-Instruct"
-    elif model == "vllm-llama3.1-8b-instruct":
-        model = "meta-llama/Llama-3.1-8B-Instruct"
-    elif model == "vllm-llama3.1-70b-instruct":
-        model = "meta-llama/Llama-3.1-70B-Instruct"
-    elif model == "vllm-llama3.3-70b-instruct":
-        model = "meta-llama/Llama-3.3-70B-Instruct"
-    elif model == "vllm-qwen2.5-72b-instruct":
-        model = "Qwen/Qwen2.5-72B-Instruct"
-    elif model == "vllm-qwen2.5-7b-instruct":
-        model = "Qwen/Qwen2.5-7B-Instruct"
-    elif model == "vllm-deepseek-llama-70b":
-        model = "deepseek-ai/DeepSeek-R1-Distill-Llama-70B"
-    else:
-        raise ValueError(f"Invalid model: {model}")
-    return model
+    # Kept for existing callers; aliases are defined in config/model_registry.yaml
+    return resolve_model(model)
+
+
+def vllm_endpoints(model):
+    # Replicas of a vLLM model; the request goes to the one picked by `with vllm_endpoints(model).route(session) as base_url`
+    return get_endpoint_pool(model, get_endpoints(model) or VLLM_API_BASES, **get_load_balancing("vllm", model))
+
+
+def hedge_endpoints(api_type, model):
+    # Servers a hedge can be sent to: only vLLM models can have several (replicas)
+    return len(vllm_endpoints(model).replicas) if api_type == "vllm" else 1
 
 
 def vllm_response(message: list, model=None, temperature=0, seed=42, **kwargs):
-    VLLM_API_KEY = "EMPTY"
-    VLLM_API_BASE = f"http://localhost:{PORT}/v1"
-    vllm_client = OpenAI(api_key=VLLM_API_KEY, base_url=VLLM_API_BASE)
-
-    assert model in [
-        "meta-llama/Llama-3-70B-Instruct",
-        "meta-llama/Llama-3-8B-Instruct",
-        "meta-llama/Llama-3.1-8B-Instruct",
-        "meta-llama/Llama-3.1-70B-Instruct",
-        "meta-llama/Llama-3.3-70B-Instruct",
-        "Qwen/Qwen2.5-72B-Instruct",
-        "Qwen/Qwen2.5-7B-Instruct",
-        "deepseek-ai/DeepSeek-R1-Distill-Llama-70B",
-    ]
-    time.sleep(time_gap.get(model, 3))
+    assert (get_model_spec(model) or {}).get("provider") == "vllm", f"Unregistered vLLM model: {model}"
 
-    try:
-        return vllm_client.chat.completions.create(
-            model=model,
-            messages=message,
-            temperature=temperature,
-            seed=seed,
-        )
-    except Exception as e:
-        error_msg = str(e).lower()
-        if "context" in error_msg or "length" in error_msg or 'maximum context length' in error_msg:
-            if isinstance(message, list) and len(message) > 2:
-                message = [message[0]] + message[2:]
-        print(e)
-        time.sleep(time_gap.get(model, 3) * 2)
-        return vllm_response(message, model, temperature, seed)
+    def send(message):
+        with vllm_endpoints(model).route(current_session.get()) as base_url:
+            return get_client("vllm", base_url).chat.completions.create(
+                model=model,
+                messages=message,
+                temperature=temperature,
+                seed=seed,
+            )
+
+    return call_backend("vllm", model, message, send, **kwargs)
+
+
+def mock_response(message: list, model="mock", temperature=0, seed=42, **kwargs):
+    return call_backend("mock", model, message, lambda message: mock_send(message, model, seed), **kwargs)
+
+
+def lookup_response(api_type, message, model, temperature, seed, **kwargs):
+    # Returns (request key, stored record, replay latency); the record is None when the backend has to be called
+    cassette, cache = get_cassette(), get_cache()
+    if cassette is None and cache is None:
+        return None, None, 0.0
+    key = request_key(api_type, model, message, temperature, seed, **kwargs)
+    if cassette is not None and cassette.replaying:
+        record, latency = cassette.replay(key)
+        return key, record, latency
+    if cache is not None and is_deterministic(temperature, seed):
+        record = cache.get(key)
+        if record is not None and cassette is not None:
+            # A recording cassette needs every answer of the run, including the ones served from the cache
+            cassette.record(key, api_type, model, record, 0.0)
+        return key, record, 0.0
+    return key, None, 0.0
+
+
+def store_response(key, api_type, model, temperature, seed, response, latency, truncated=False):
+    # A truncated response (a stream stopped by the caller) is not reusable, so it is only recorded to the cassette,
+    # which has to serve the same cut-off text back on replay
+    if key is None:
+        return
+    cassette, cache = get_cassette(), get_cache()
+    record = response_to_record(response)
+    if truncated:
+        record["truncated"] = True
+    elif cache is not None and is_deterministic(temperature, seed):
+        cache.put(key, record)
+    if cassette is not None and not cassette.replaying:
+        cassette.record(key, api_type, model, record, latency)
+
+
+def use_fallback(api_type, model, caller, call_info):
+    # Returns the (api_type, model) that takes over a call rejected by the open circuit of its backend, or None.
+    # A fallback on the same api type would be rejected by the same breaker.
+    fallback = get_fallback(caller, api_type, model)
+    if fallback is None or fallback[0] == api_type:
+        return None
+    logging.warning(f"[{api_type}/{model}] circuit open, sending the {caller} call to {fallback[0]}/{fallback[1]}")
+    metrics.inc("llm_fallback_calls_total", call_labels(api_type, model))
+    if call_info is not None:
+        call_info.update({"api_type": api_type, "model": model, "fallback_api_type": fallback[0], "fallback_model": fallback[1]})
+    return fallback
+
+
+def with_cache(api_type, response_method):
+    # Fit the prompt into the context window, then serve calls from a replay cassette, or deterministic calls (temperature 0 with a fixed seed) from the on-disk cache
+    def cached_response(message, model=None, temperature=0, seed=42, caller=None, session=None, call_info=None, **kwargs):
+        # `caller` (e.g. "doctor", "patient") selects the context policy, the fallback backend and labels metrics,
+        # `session` (a conversation id) keeps a dialogue on the same vLLM replica, and `call_info` (a dict) records
+        # which fallback answered the call; none of them is sent to the backend
+        token, session_token = current_caller.set(caller), current_session.set(session)
+        try:
+            fitted = fit_context(api_type, model, message, caller)
+            key, record, latency = lookup_response(api_type, fitted, model, temperature, seed, **kwargs)
+            if record is not None:
+                metrics.inc("llm_cache_hits_total", call_labels(api_type, model))
+                time.sleep(latency)
+                return record_to_response(record)
+            start_time = time.monotonic()
+            response = get_hedge_policy(api_type).call(
+                api_type, model, lambda: response_method(fitted, model=model, temperature=temperature, seed=seed, **kwargs), hedge_endpoints(api_type, model)
+            )
+            store_response(key, api_type, model, temperature, seed, response, time.monotonic() - start_time)
+            return response
+        except CircuitOpenError:
+            fallback = use_fallback(api_type, model, caller, call_info)
+            if fallback is None:
+                raise
+        finally:
+            current_caller.reset(token)
+            current_session.reset(session_token)
+        return get_response_method(fallback[0])(message, model=fallback[1], temperature=temperature, seed=seed, caller=caller, session=session, **kwargs)
+
+    return cached_response
 
 
 def get_response_method(model):
@@ -180,5 +390,209 @@ def get_response_method(model):
         "gpt_azure": gpt_azure_response,
         "vllm": vllm_response,
         "genai": gemini_response,
+        "mock": mock_response,
+    }
+    if model.split("-")[0] not in response_methods:
+        return lambda _: NotImplementedError()
+    return with_cache(model.split("-")[0], response_methods[model.split("-")[0]])
+
+
+def gpt_azure_stream(message, model, temperature, seed, **kwargs):
+    stream = get_client("gpt_azure").chat.completions.create(
+        model=model, messages=message, temperature=temperature, seed=seed, stream=True, stream_options={"include_usage": True}, **kwargs
+    )
+    return openai_chunks(stream)
+
+
+def gemini_stream(message, model, temperature, seed, **kwargs):
+    return genai_chunks(get_client("genai").models.generate_content_stream(**gemini_request(message, model, temperature, seed, **kwargs)))
+
+
+def vllm_stream(message, model, temperature, seed, **kwargs):
+    assert (get_model_spec(model) or {}).get("provider") == "vllm", f"Unregistered vLLM model: {model}"
+    # The replica keeps the request as outstanding until the stream is consumed or closed
+    with vllm_endpoints(model).route(current_session.get()) as base_url:
+        stream = get_client("vllm", base_url).chat.completions.create(
+            model=model, messages=message, temperature=temperature, seed=seed, stream=True, stream_options={"include_usage": True}
+        )
+        yield from openai_chunks(stream)
+
+
+def mock_stream_chunks(message, model, temperature, seed, **kwargs):
+    return mock_stream(message, model, seed)
+
+
+def open_stream(api_type, chunks_method, message, model, temperature, seed, **kwargs):
+    # Rate limiting and retries cover the request up to its first chunk; a stream that fails midway is not retried
+    limiter = get_rate_limiter(api_type, model)
+
+    def send(message):
+        chunks = chunks_method(message, model, temperature, seed, **kwargs)
+        first = next(chunks, None)
+
+        def resume():
+            try:
+                if first is not None:
+                    yield first
+                yield from chunks
+            finally:
+                chunks.close()
+
+        return resume()
+
+    def attempt(message):
+        wait_start = time.monotonic()
+        acquire_rate_limit(api_type, model, message, **kwargs)
+        metrics.observe("llm_queue_wait_seconds", call_labels(api_type, model), time.monotonic() - wait_start)
+        return send(message)
+
+    return get_retry_policy(api_type).call(
+        guarded(get_circuit_breaker(api_type), attempt), message, trim=drop_oldest_turn, limiter=limiter, label=(api_type, model)
+    )
+
+
+def get_stream_method(model):
+    # Same arguments as get_response_method, but returns a ResponseStream of text deltas
+    stream_methods = {
+        "gpt_azure": gpt_azure_stream,
+        "vllm": vllm_stream,
+        "genai": gemini_stream,
+        "mock": mock_stream_chunks,
+    }
+    api_type = model.split("-")[0]
+    if api_type not in stream_methods:
+        raise NotImplementedError(f"No streaming client for api type: {model}")
+    record_format = "genai" if api_type == "genai" else "openai"
+
+    def stream_response(message, model=None, temperature=0, seed=42, caller=None, session=None, call_info=None, **kwargs):
+        request = message
+        token, session_token = current_caller.set(caller), current_session.set(session)
+        try:
+            message = fit_context(api_type, model, message, caller)
+            start_time = time.monotonic()
+            label = (api_type, model, caller or api_type)
+            key, record, latency = lookup_response(api_type, message, model, temperature, seed, **kwargs)
+            if record is not None:
+                metrics.inc("llm_cache_hits_total", call_labels(api_type, model))
+                time.sleep(latency)
+                usage = {k: record[k] for k in ["prompt_tokens", "completion_tokens", "total_tokens"]}
+                return ResponseStream(iter([(record["text"], usage)]), record["format"], None, start_time)
+
+            limiter = get_rate_limiter(api_type, model)
+            estimated_tokens = estimate_tokens(message, completion_budget(limiter, **kwargs))
+            labels = call_labels(api_type, model)
+
+            def on_complete(response, duration, completed, failed, ttft):
+                record_usage(limiter, estimated_tokens, response)
+                usage = get_token_log(response)
+                metrics.record_call(labels, duration, usage["prompt_tokens"], usage["completion_tokens"], ttft=ttft)
+                cost_ledger.record(labels, usage["prompt_tokens"], usage["completion_tokens"])
+                if not failed:  # a stream that broke off midway is not a response at all
+                    store_response(key, api_type, model, temperature, seed, response, duration, truncated=not completed)
+
+            chunks = open_stream(api_type, stream_methods[api_type], message, model, temperature, seed, **kwargs)
+            return ResponseStream(chunks, record_format, label, start_time, prompt_tokens=estimate_tokens(message), on_complete=on_complete)
+        except CircuitOpenError:
+            fallback = use_fallback(api_type, model, caller, call_info)
+            if fallback is None:
+                raise
+        finally:
+            current_caller.reset(token)
+            current_session.reset(session_token)
+        return get_stream_method(fallback[0])(request, model=fallback[1], temperature=temperature, seed=seed, caller=caller, session=session, **kwargs)
+
+    return stream_response
+
+
+def set_concurrency_limit(api_type, limit):
+    concurrency_limit[api_type] = limit
+    for semaphores in _semaphores.values():
+        for key in [key for key in semaphores if key[0] == api_type]:
+            semaphores.pop(key)
+
+
+def get_semaphore(api_type, model=None):
+    # Semaphores are bound to the running event loop, so keep one set per loop
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    key = (api_type, model)
+    if key not in semaphores:
+        semaphores[key] = asyncio.Semaphore(concurrency_limit.get(api_type) or get_concurrency(api_type, model))
+    return semaphores[key]
+
+
+async def gpt_azure_response_async(message: list, model="gpt-4o", temperature=0, seed=42, **kwargs):
+    async def send(message):
+        return await get_async_client("gpt_azure").chat.completions.create(model=model, messages=message, temperature=temperature, seed=seed, **kwargs)
+
+    return await call_backend_async("gpt_azure", model, message, send, **kwargs)
+
+
+async def gemini_response_async(message: list, model="gemini-2.0-flash", temperature=0, seed=42, **kwargs):
+    async def send(message):
+        return await get_async_client("genai").aio.models.generate_content(**gemini_request(message, model, temperature, seed, **kwargs))
+
+    return await call_backend_async("genai", model, message, send, **kwargs)
+
+
+async def vllm_response_async(message: list, model=None, temperature=0, seed=42, **kwargs):
+    assert (get_model_spec(model) or {}).get("provider") == "vllm", f"Unregistered vLLM model: {model}"
+
+    async def send(message):
+        with vllm_endpoints(model).route(current_session.get()) as base_url:
+            return await get_async_client("vllm", base_url).chat.completions.create(
+                model=model,
+                messages=message,
+                temperature=temperature,
+                seed=seed,
+            )
+
+    return await call_backend_async("vllm", model, message, send, **kwargs)
+
+
+async def mock_response_async(message: list, model="mock", temperature=0, seed=42, **kwargs):
+    async def send(message):
+        return await mock_send_async(message, model, seed)
+
+    return await call_backend_async("mock", model, message, send, **kwargs)
+
+
+def with_cache_async(api_type, response_method):
+    async def cached_response(message, model=None, temperature=0, seed=42, caller=None, session=None, call_info=None, **kwargs):
+        token, session_token = current_caller.set(caller), current_session.set(session)
+        try:
+            fitted = await fit_context_async(api_type, model, message, caller)
+            key, record, latency = lookup_response(api_type, fitted, model, temperature, seed, **kwargs)
+            if record is not None:
+                metrics.inc("llm_cache_hits_total", call_labels(api_type, model))
+                await asyncio.sleep(latency)
+                return record_to_response(record)
+            start_time = time.monotonic()
+            response = await get_hedge_policy(api_type).call_async(
+                api_type, model, lambda: response_method(fitted, model=model, temperature=temperature, seed=seed, **kwargs), hedge_endpoints(api_type, model)
+            )
+            store_response(key, api_type, model, temperature, seed, response, time.monotonic() - start_time)
+            return response
+        except CircuitOpenError:
+            fallback = use_fallback(api_type, model, caller, call_info)
+            if fallback is None:
+                raise
+        finally:
+            current_caller.reset(token)
+            current_session.reset(session_token)
+        return await get_async_response_method(fallback[0])(
+            message, model=fallback[1], temperature=temperature, seed=seed, caller=caller, session=session, **kwargs
+        )
+
+    return cached_response
+
+
+def get_async_response_method(model):
+    response_methods = {
+        "gpt_azure": gpt_azure_response_async,
+        "vllm": vllm_response_async,
+        "genai": gemini_response_async,
+        "mock": mock_response_async,
     }
-    return response_methods.get(model.split("-")[0], lambda _: NotImplementedError())
\ No newline at end of file
+    if model.split("-")[0] not in response_methods:
+        raise NotImplementedError(f"No async client for api type: {model}")
+    return with_cache_async(model.split("-")[0], response_methods[model.split("-")[0]])
@@ -4,56 +4,131 @@ import time
 import json
 import hydra
 import random
+import asyncio
 import logging
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 logging.getLogger("httpx").setLevel(logging.WARNING)
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from hydra.core.hydra_config import HydraConfig
 from agent.doctor_agent import DoctorAgent
 from agent.patient_agent import PatientAgent
-from utils import file_to_string, save_to_dialogue, set_seed, detect_termination
+from scenario_store import ScenarioStore
+from utils import file_to_string, save_to_dialogue, set_seed, detect_termination, record_key, shard_of, shard_path
+from llm_client.rate_limiter import configure_rate_limit
+from llm_client.registry import resolve_model
+from llm_client.retry import configure_retry, retry_stats
+from llm_client.hedging import configure_hedging
+from llm_client.pacing import configure_pacing, get_pacer
+from llm_client.circuit_breaker import CircuitOpenError, configure_circuit_breaker, configure_fallback
+from llm_client.cassette import configure_cassette
+from llm_client.context_window import configure_context, context_stats
+from llm_client.streaming import stream_stats
+from llm_client.telemetry import metrics, serve_metrics
+from llm_client.cost import cost_ledger, configure_budget, current_scenario
 
 
 class ScenarioLoaderMIMICIV:
-    def __init__(self, data_dir, data_name="sample_info") -> None:
-        with open(os.path.join(data_dir, f"{data_name}.json"), "r") as f:
-            self.scenario_dict = json.load(f)
-        self.num_scenarios = len(self.scenario_dict)
-        logging.info(f"Load {self.num_scenarios} scenarios from {data_dir}")
+    # Scenarios by position in the (optionally filtered) scenario store; each one is decoded when it is requested
+    def __init__(self, data_dir, data_name="sample_info", filters=None) -> None:
+        self.scenario_store = ScenarioStore.open(data_dir, data_name)
+        if filters:
+            self.scenario_store = self.scenario_store.filter(**filters)
+        self.num_scenarios = len(self.scenario_store)
+        logging.info(f"Load {self.num_scenarios} scenarios from {self.scenario_store.path}")
 
     def sample_scenario(self):
-        return self.scenario_dict[random.randint(0, self.num_scenarios - 1)]
+        return self.scenario_store[random.randint(0, self.num_scenarios - 1)]
 
     def get_scenario(self, id):
+        # A new copy of the profile, as the patient agent rewrites its persona fields
         if id is None:
             return self.sample_scenario()
-        return self.scenario_dict[id]
+        return self.scenario_store[id]
 
+    def get_info(self, id):
+        # hadm_id, diagnosis, split and persona fields of a scenario, read from the index
+        return self.scenario_store.info(id)
 
-@hydra.main(config_path="./config", config_name="base", version_base="1.3")
-def main(cfg):
-    # Set random seed & create save directory
-    set_seed(cfg.experiment.random_seed)
-    cfg.save_dir = os.path.join(HydraConfig.get().run.dir, cfg.save_dir)
-    os.makedirs(cfg.save_dir, exist_ok=True)
-    if cfg.experiment.verbose:
-        print(f"Save directory: {cfg.save_dir}")
 
-    # Load scenarios
-    scenario_loader = ScenarioLoaderMIMICIV(cfg.data_dir, cfg.data.data_file_name)
-    logging.info(f"Load Datasets from {cfg.data_dir}, size: {scenario_loader.num_scenarios}")
-    logging.info(f"""Patient prompt template:\n\t{file_to_string(os.path.join(cfg.prompt_dir, cfg.data.patient_prompt_file + ".txt"))}""")
-    logging.info(f"""Doctor prompt template:\n\t{file_to_string(os.path.join(cfg.prompt_dir, cfg.data.doctor_prompt_file + ".txt"))}""")
+def run_inference(agent, question, stream=False):
+    # Streaming consumes the text deltas and returns the final answer (the return value of inference_stream)
+    if not stream:
+        return agent.inference(question)
+    generator = agent.inference_stream(question)
+    while True:
+        try:
+            next(generator)
+        except StopIteration as e:
+            return e.value
 
-    # Pipeline for huggingface models
-    num_scenarios = min(cfg.data.num_scenarios, scenario_loader.num_scenarios) if cfg.data.num_scenarios is not None else scenario_loader.num_scenarios
-    for _scenario_id in range(0, num_scenarios):
-        # Initialize scenarios
-        scenario = scenario_loader.get_scenario(id=_scenario_id)
-        logging.info(f"\n=== Scenario {_scenario_id} / {num_scenarios} | hadm_id: {scenario['hadm_id']} ===")
+
+# Agent state saved in a turn checkpoint
+CHECKPOINT_FIELDS = {"patient": ["messages", "token_log", "fallback_log"], "doctor": ["messages", "token_log", "fallback_log", "infs"]}
+PERSONA_FIELDS = [("cefr_type", "cefr"), ("personality_type", "personality"), ("recall_level_option", "recall_level"), ("dazed_level_option", "dazed_level")]
+
+
+def persona_key(cfg, scenario):
+    # hadm_id / persona combination a scenario is simulated with (a persona set in the config overrides the profile's)
+    persona = cfg.patient_agent.persona
+    return (str(scenario["hadm_id"]),) + tuple(persona[option] if persona[option] is not None else scenario[field] for option, field in PERSONA_FIELDS)
+
+
+def backend_key(cfg):
+    return (cfg.patient_agent.backend, cfg.doctor_agent.backend)
+
+
+def load_completed(dialogue_path, with_backends=False, repair=True):
+    # Keys of the dialogues already in dialogue.jsonl. A last line cut off by a crash is removed (repair), so new
+    # records are not appended to it; otherwise it is ignored.
+    if not os.path.exists(dialogue_path):
+        return set()
+    with open(dialogue_path, "rb") as f:
+        data = f.read()
+    if data and not data.endswith(b"\n"):
+        data = data[: data.rfind(b"\n") + 1]
+        if repair:
+            logging.warning(f"Removing an incomplete last line from {dialogue_path}")
+            with open(dialogue_path, "wb") as f:
+                f.write(data)
+    return {record_key(json.loads(line), with_backends) for line in data.decode("utf-8").splitlines() if line.strip()}
+
+
+def checkpoint_path(cfg, scenario):
+    # One file per scenario, persona and backend pair (several of them share a run in a sweep)
+    name = "_".join(str(value) for value in persona_key(cfg, scenario) + backend_key(cfg))
+    return os.path.join(cfg.save_dir, "checkpoints", name.replace(os.sep, "-") + ".json")
+
+
+def save_checkpoint(path, state):
+    # Written to a temporary file first, so a crash never leaves a half-written checkpoint
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class Dialogue:
+    # One doctor-patient dialogue, advanced a turn at a time: by run_scenario on its own thread, or by the lockstep
+    # engine together with other dialogues. `checkpoint`: file the dialogue state is saved to after every turn, and
+    # resumed from if it exists.
+    def __init__(self, cfg, scenario, checkpoint=None):
+        self.cfg = cfg
+        self.scenario = scenario
+        self.checkpoint = checkpoint
+        self.key = persona_key(cfg, scenario) + backend_key(cfg)  # the ledger key of its calls (see current_scenario); before PatientAgent pops the persona fields
 
         # Initialize agents
-        patient_agent = PatientAgent(
+        self.patient_agent = PatientAgent(
             patient_profile=scenario,
             backend_str=cfg.patient_agent.backend,
             backend_api_type=cfg.patient_agent.api_type,
@@ -67,7 +142,7 @@ def main(cfg):
             client_params=cfg.patient_agent.params,
             verbose=cfg.experiment.verbose,
         )
-        doctor_agent = DoctorAgent(
+        self.doctor_agent = DoctorAgent(
             max_infs=cfg.doctor_agent.max_infs,
             top_k_diagnosis=cfg.doctor_agent.top_k_diagnosis,
             backend_str=cfg.doctor_agent.backend,
@@ -76,40 +151,77 @@ def main(cfg):
             prompt_file=cfg.data.doctor_prompt_file,
             patient_info=scenario,
             client_params=cfg.doctor_agent.params,
+            prefix_stable=cfg.doctor_agent.prefix_stable,
+            stop_at_ddx=cfg.doctor_agent.stop_at_ddx,
             verbose=cfg.experiment.verbose,
         )
 
-        # Start dialogue
-        start_time = time.time()
-        dialog_history = [{"role": "Doctor", "content": doctor_agent.doctor_greet}]
-        doctor_agent.messages.append({"role": "assistant", "content": f"{doctor_agent.doctor_greet}"})
-        logging.info(f"Doctor: {doctor_agent.doctor_greet}")
+        # Start dialogue (log lines carry the hadm_id when dialogues run concurrently)
+        self.tag = f"[{scenario['hadm_id']}] " if cfg.experiment.num_workers > 1 else ""
+        self.start_time = time.time()
+        self.start_cost = cost_ledger.job_cost(self.key)  # this process may already have spent some on an earlier, parked attempt
+        self.state = load_checkpoint(checkpoint)
+        if self.state is None:
+            self.state = {"turn": 0, "elapsed_time": 0.0, "idle_time": 0.0, "cost": dict.fromkeys(self.start_cost, 0)}
+            self.dialog_history = [{"role": "Doctor", "content": self.doctor_agent.doctor_greet}]
+            self.doctor_agent.messages.append({"role": "assistant", "content": f"{self.doctor_agent.doctor_greet}"})
+            logging.info(f"{self.tag}Doctor: {self.doctor_agent.doctor_greet}")
+        else:
+            self.dialog_history = self.state["dialog_history"]
+            self.state.setdefault("idle_time", 0.0)
+            for name, agent in [("patient", self.patient_agent), ("doctor", self.doctor_agent)]:
+                for field in CHECKPOINT_FIELDS[name]:
+                    setattr(agent, field, self.state[name][field])
+            logging.info(f"{self.tag}Resuming the dialogue at turn {self.state['turn']} from {checkpoint}")
 
-        for inf_idx in range(cfg.experiment.total_inferences):
-            # # Obtain response from patient
-            patient_response = patient_agent.inference(dialog_history[-1]["content"])
+        self.backends = [(self.patient_agent.backend_api_type, self.patient_agent.model), (self.doctor_agent.backend_api_type, self.doctor_agent.model)]
+        self.turn = self.state["turn"]
+        self.done = self.turn >= cfg.experiment.total_inferences
 
-            dialog_history.append({"role": "Patient", "content": patient_response})
-            logging.info("Patient [{}%]: {}".format(int(((inf_idx + 1) / cfg.experiment.total_inferences) * 100), patient_response))
+    def spent(self):
+        # Cost of the dialogue so far, earlier runs included
+        current = cost_ledger.job_cost(self.key)
+        return {field: self.state["cost"][field] + current[field] - self.start_cost[field] for field in current}
 
-            # Obtain doctor dialogue
-            if inf_idx == cfg.experiment.total_inferences - 1:
-                doctor_response = doctor_agent.inference(dialog_history[-1]["content"] + "\nThis is the final turn. Now, you must provide your top5 differential diagnosis.")
-            else:
-                doctor_response = doctor_agent.inference(dialog_history[-1]["content"])
-            dialog_history.append({"role": "Doctor", "content": doctor_response})
-            logging.info("Doctor [{}%]: {}".format(int(((inf_idx + 1) / cfg.experiment.total_inferences) * 100), doctor_response))
+    def progress(self):
+        return int(((self.turn + 1) / self.cfg.experiment.total_inferences) * 100)
 
-            end_flag = detect_termination(doctor_response)
-            if end_flag:
-                break
+    def patient_question(self):
+        return self.dialog_history[-1]["content"]
 
-            # Prevent API timeouts
-            time.sleep(1.0)
+    def add_patient_response(self, patient_response):
+        self.dialog_history.append({"role": "Patient", "content": patient_response})
+        logging.info(self.tag + "Patient [{}%]: {}".format(self.progress(), patient_response))
 
-        end_time = time.time()
+    def doctor_question(self):
+        if self.turn == self.cfg.experiment.total_inferences - 1:
+            return self.dialog_history[-1]["content"] + "\nThis is the final turn. Now, you must provide your top5 differential diagnosis."
+        return self.dialog_history[-1]["content"]
+
+    def add_doctor_response(self, doctor_response):
+        # Ends the turn: the dialogue is done after the doctor's diagnosis or the last turn, and checkpointed otherwise
+        self.dialog_history.append({"role": "Doctor", "content": doctor_response})
+        logging.info(self.tag + "Doctor [{}%]: {}".format(self.progress(), doctor_response))
+        self.turn += 1
+        self.done = detect_termination(doctor_response) or self.turn >= self.cfg.experiment.total_inferences
+        if self.done or self.checkpoint is None:
+            return
+        save_checkpoint(
+            self.checkpoint,
+            {
+                "turn": self.turn,
+                "dialog_history": self.dialog_history,
+                "elapsed_time": self.state["elapsed_time"] + time.time() - self.start_time,
+                "idle_time": self.state["idle_time"],
+                "cost": self.spent(),
+                **{name: {field: getattr(agent, field) for field in CHECKPOINT_FIELDS[name]} for name, agent in [("patient", self.patient_agent), ("doctor", self.doctor_agent)]},
+            },
+        )
+
+    def record(self):
+        patient_agent, doctor_agent = self.patient_agent, self.doctor_agent
         dialog_info = {
-            "hadm_id": scenario["hadm_id"],
+            "hadm_id": self.scenario["hadm_id"],
             "doctor_engine_name": doctor_agent.backend,
             "patient_engine_name": patient_agent.backend,
             "doctor_api_type": doctor_agent.backend_api_type,
@@ -119,12 +231,302 @@ def main(cfg):
             "recall_level_type": patient_agent.patient_profile["recall_level_option"],
             "dazed_level_type":patient_agent.patient_profile["dazed_level_option"],
             "diagnosis": patient_agent.diagnosis,
-            "dialog_history": dialog_history,
+            "dialog_history": self.dialog_history,
             "patient_token_log": patient_agent.token_log,
             "doctor_token_log": doctor_agent.token_log,
-            "elapsed_time": end_time - start_time,
+            "fallback_calls": {"patient": patient_agent.fallback_log, "doctor": doctor_agent.fallback_log},
+            "cost": self.spent(),
+            "elapsed_time": self.state["elapsed_time"] + time.time() - self.start_time,
+            "idle_time": self.state["idle_time"],
+        }
+        return dialog_info
+
+
+def run_scenario(cfg, scenario, checkpoint=None):
+    # Runs one doctor-patient dialogue and returns its record
+    # Raises CircuitOpenError when a backend is down and has no fallback
+    dialogue = Dialogue(cfg, scenario, checkpoint)
+    while not dialogue.done:
+        # # Obtain response from patient
+        dialogue.add_patient_response(run_inference(dialogue.patient_agent, dialogue.patient_question(), cfg.experiment.stream))
+
+        # Obtain doctor dialogue
+        dialogue.add_doctor_response(run_inference(dialogue.doctor_agent, dialogue.doctor_question(), cfg.experiment.stream))
+
+        # Pause between turns only as long as the backends need (rate-limit feedback, 429s, latency)
+        if not dialogue.done:
+            dialogue.state["idle_time"] += get_pacer().pause(dialogue.backends)
+    return dialogue.record()
+
+
+def configure_backends(cfg):
+    # Rate limits & fallbacks of the agents' backend models (shared by every call to the same backend model)
+    for caller, agent_cfg in [("patient", cfg.patient_agent), ("doctor", cfg.doctor_agent)]:
+        model = resolve_model(agent_cfg.backend)
+        configure_rate_limit(agent_cfg.api_type, model, rpm=agent_cfg.rate_limit.rpm, tpm=agent_cfg.rate_limit.tpm)
+        if agent_cfg.fallback.backend is not None:
+            configure_fallback(caller, agent_cfg.api_type, model, agent_cfg.fallback.api_type, resolve_model(agent_cfg.fallback.backend))
+
+
+def configure_run(cfg):
+    # Per-call LLM metrics, optionally served live at http://<host>:<metrics_port>/metrics
+    if cfg.experiment.metrics_port:
+        serve_metrics(cfg.experiment.metrics_port)
+
+    # Record or replay every LLM call of the run (a resumed run adds to the cassette it was recording)
+    if cfg.experiment.cassette:
+        resumed = cfg.experiment.resume and cfg.experiment.cassette_mode == "record"
+        configure_cassette(cfg.experiment.cassette, mode="append" if resumed else cfg.experiment.cassette_mode)
+
+    # Set retry policy & rate limits (shared by every call to the same backend model)
+    configure_retry(max_attempts=cfg.retry.max_attempts, base_delay=cfg.retry.base_delay, max_delay=cfg.retry.max_delay)
+    configure_hedging(**cfg.hedging)
+    configure_pacing(**cfg.pacing)
+    configure_budget(cfg.experiment.budget_usd)
+    configure_circuit_breaker(
+        enabled=cfg.circuit_breaker.enabled,
+        failure_threshold=cfg.circuit_breaker.failure_threshold,
+        recovery_timeout=cfg.circuit_breaker.recovery_timeout,
+        half_open_max_calls=cfg.circuit_breaker.half_open_max_calls,
+    )
+    configure_backends(cfg)
+    configure_context("patient", **cfg.patient_agent.context)
+    configure_context("doctor", **cfg.doctor_agent.context)
+
+
+def simulate(jobs, scenario_loader, dialogue_path, num_workers=1, max_requeues=3):
+    # Runs the (cfg, scenario id) jobs and appends their records to dialogue_path
+    pending = deque((index, 0) for index in range(len(jobs)))  # (job index, times parked)
+    parked = []  # (time the circuit lets calls through again, job index, times parked)
+    running = {}  # future -> (job index, times parked, checkpoint file)
+
+    # Up to num_workers dialogues run at once, each on its own thread with its own agents. Every LLM call carries its own
+    # seed (client_params), so a dialogue does not depend on which others run next to it. Records are written here, by
+    # the main thread, in the order the dialogues finish.
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="scenario") as executor:
+        while pending or parked or running:
+            # Over budget: scenarios that have not started are not scheduled any more
+            if (pending or parked) and cost_ledger.exhausted():
+                logging.warning(f"Skipping {len(pending) + len(parked)} scenario(s) not started before the budget ran out")
+                pending.clear()
+                parked = []
+
+            # Re-queue the parked scenarios whose circuit lets calls through again; wait for them if nothing else is left
+            if parked and not pending and not running:
+                time.sleep(max(0.0, min(item[0] for item in parked) - time.time()))
+            pending.extend((index, num_parked) for ready_at, index, num_parked in sorted(parked) if ready_at <= time.time())
+            parked = [item for item in parked if item[0] > time.time()]
+
+            while pending and len(running) < num_workers:
+                index, num_parked = pending.popleft()
+                cfg, _scenario_id = jobs[index]
+
+                # Initialize scenarios
+                scenario = scenario_loader.get_scenario(id=_scenario_id)
+                logging.info(f"\n=== Scenario {_scenario_id} ({index + 1} / {len(jobs)}) | hadm_id: {scenario['hadm_id']} ===")
+                checkpoint = checkpoint_path(cfg, scenario) if cfg.experiment.checkpoint else None
+                context = contextvars.copy_context()
+                context.run(current_scenario.set, persona_key(cfg, scenario) + backend_key(cfg))
+                running[executor.submit(context.run, run_scenario, cfg, scenario, checkpoint)] = (index, num_parked, checkpoint)
+            if not running:
+                continue
+
+            timeout = max(0.0, min(item[0] for item in parked) - time.time()) if parked else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, num_parked, checkpoint = running.pop(future)
+                _scenario_id = jobs[index][1]
+                try:
+                    dialog_info = future.result()
+                except CircuitOpenError as e:
+                    # The backend is down and there is no fallback: park the scenario and keep the run going with the others
+                    if num_parked >= max_requeues:
+                        logging.error(f"Scenario {_scenario_id} dropped after being parked {num_parked} time(s): {e}")
+                        continue
+                    logging.warning(f"Scenario {_scenario_id} parked ({e})")
+                    parked.append((time.time() + e.retry_after, index, num_parked + 1))
+                    continue
+                save_to_dialogue(dialog_info, dialogue_path)
+                if checkpoint is not None and os.path.exists(checkpoint):
+                    os.remove(checkpoint)
+                logging.info(f"Cost: ${dialog_info['cost']['cost_usd']:.4f} for scenario {_scenario_id}, ${cost_ledger.total:.4f} in total")
+
+
+def output_path(cfg, name):
+    # Files of a sharded run carry the shard in their name, so shards can share a save directory and be merged
+    return shard_path(os.path.join(cfg.save_dir, name), cfg.experiment.shard_index, cfg.experiment.num_shards)
+
+
+def in_shard(cfg, key):
+    assert 0 <= cfg.experiment.shard_index < cfg.experiment.num_shards, "experiment.shard_index must be in [0, num_shards)"
+    return cfg.experiment.num_shards <= 1 or shard_of(key, cfg.experiment.num_shards) == cfg.experiment.shard_index
+
+
+class LockstepStats:
+    # Per phase of a lockstep wave: dialogues stepped, share of the wave slots in use and completion tokens per second
+    def __init__(self, wave_size):
+        self.wave_size = wave_size
+        self.phases = 0
+        self.dialogues = 0
+        self.tokens = 0
+        self.seconds = 0.0
+
+    def record(self, phase, size, tokens, seconds):
+        self.phases += 1
+        self.dialogues += size
+        self.tokens += tokens
+        self.seconds += seconds
+        labels = {"phase": phase}
+        metrics.observe("llm_wave_size", labels, size)
+        metrics.observe("llm_wave_occupancy", labels, size / self.wave_size)
+        if seconds > 0:
+            metrics.observe("llm_wave_tokens_per_second", labels, tokens / seconds)
+
+    def summary(self):
+        if not self.phases:
+            return {}
+        return {
+            "phases": self.phases,
+            "mean_wave_size": round(self.dialogues / self.phases, 2),
+            "occupancy": round(self.dialogues / (self.phases * self.wave_size), 3),
+            "completion_tokens_per_second": round(self.tokens / self.seconds, 1) if self.seconds else None,
         }
-        save_to_dialogue(dialog_info, os.path.join(cfg.save_dir, "dialogue.jsonl"))
+
+
+async def step_wave(dialogues, phase):
+    # One turn of the phase ("patient" or "doctor") for every dialogue, all requests sent at once; returns the
+    # exception of each dialogue whose call failed (None for the others)
+    async def step(dialogue):
+        current_scenario.set(dialogue.key)  # each gathered call runs in its own copy of the context
+        if phase == "patient":
+            dialogue.add_patient_response(await dialogue.patient_agent.ainference(dialogue.patient_question()))
+        else:
+            dialogue.add_doctor_response(await dialogue.doctor_agent.ainference(dialogue.doctor_question()))
+
+    return await asyncio.gather(*(step(dialogue) for dialogue in dialogues), return_exceptions=True)
+
+
+def simulate_lockstep(jobs, scenario_loader, dialogue_path, num_workers=1, max_requeues=3):
+    # Alternative to simulate(): up to num_workers dialogues advance in lockstep on one event loop. The patient turns of
+    # the whole wave go out together, then its doctor turns, so a vLLM server batches them on the GPU. Finished dialogues
+    # leave the wave and queued scenarios take their slots before the next turn (continuous batching).
+    pending = deque((index, 0) for index in range(len(jobs)))  # (job index, times parked)
+    parked = []  # (time the circuit lets calls through again, job index, times parked)
+    active = []  # (dialogue, job index, times parked)
+    stats = LockstepStats(num_workers)
+    if jobs and jobs[0][0].experiment.stream:
+        logging.warning("The lockstep engine does not stream replies (experiment.stream is ignored)")
+    loop = asyncio.new_event_loop()
+    try:
+        while pending or parked or active:
+            # Over budget: scenarios that have not started are not scheduled any more
+            if (pending or parked) and cost_ledger.exhausted():
+                logging.warning(f"Skipping {len(pending) + len(parked)} scenario(s) not started before the budget ran out")
+                pending.clear()
+                parked = []
+
+            # Re-queue the parked scenarios whose circuit lets calls through again; wait for them if nothing else is left
+            if parked and not pending and not active:
+                time.sleep(max(0.0, min(item[0] for item in parked) - time.time()))
+            pending.extend((index, num_parked) for ready_at, index, num_parked in sorted(parked) if ready_at <= time.time())
+            parked = [item for item in parked if item[0] > time.time()]
+
+            # Admit new scenarios into the free slots of the wave
+            while pending and len(active) < num_workers:
+                index, num_parked = pending.popleft()
+                cfg, _scenario_id = jobs[index]
+                scenario = scenario_loader.get_scenario(id=_scenario_id)
+                logging.info(f"\n=== Scenario {_scenario_id} ({index + 1} / {len(jobs)}) | hadm_id: {scenario['hadm_id']} ===")
+                dialogue = Dialogue(cfg, scenario, checkpoint_path(cfg, scenario) if cfg.experiment.checkpoint else None)
+                active.append((dialogue, index, num_parked))
+            if not active:
+                continue
+
+            for phase in ["patient", "doctor"]:
+                start_time = time.monotonic()
+                errors = loop.run_until_complete(step_wave([item[0] for item in active], phase))
+                stepped = []
+                for (dialogue, index, num_parked), error in zip(active, errors):
+                    if isinstance(error, CircuitOpenError):
+                        # The backend is down and there is no fallback: park the scenario, it resumes from its checkpoint
+                        if num_parked >= max_requeues:
+                            logging.error(f"Scenario {jobs[index][1]} dropped after being parked {num_parked} time(s): {error}")
+                        else:
+                            logging.warning(f"Scenario {jobs[index][1]} parked ({error})")
+                            parked.append((time.time() + error.retry_after, index, num_parked + 1))
+                    elif error is not None:
+                        raise error
+                    else:
+                        stepped.append((dialogue, index, num_parked))
+                agent = "patient_agent" if phase == "patient" else "doctor_agent"
+                tokens = sum(getattr(item[0], agent).token_log["completion_tokens"][-1] or 0 for item in stepped)
+                stats.record(phase, len(active), tokens, time.monotonic() - start_time)
+                active = stepped
+
+            # Save the finished dialogues; the others pause for the pacer (once for the whole wave) before the next turn
+            for dialogue, index, _ in [item for item in active if item[0].done]:
+                dialog_info = dialogue.record()
+                save_to_dialogue(dialog_info, dialogue_path)
+                if dialogue.checkpoint is not None and os.path.exists(dialogue.checkpoint):
+                    os.remove(dialogue.checkpoint)
+                logging.info(f"Cost: ${dialog_info['cost']['cost_usd']:.4f} for scenario {jobs[index][1]}, ${cost_ledger.total:.4f} in total")
+            active = [item for item in active if not item[0].done]
+            if active:
+                gap = get_pacer().pause(list(dict.fromkeys(backend for item in active for backend in item[0].backends)))
+                for dialogue, _, _ in active:
+                    dialogue.state["idle_time"] += gap
+    finally:
+        loop.close()
+    logging.info(f"Lockstep waves: {stats.summary()}")
+
+
+def log_run_stats(cfg):
+    logging.info(f"LLM call attempts: {retry_stats.summary()}")
+    logging.info(f"Context trimming: {context_stats.summary()}")
+    if cfg.experiment.stream:
+        logging.info(f"Streaming latency: {stream_stats.summary()}")
+    metrics.dump(output_path(cfg, "llm_metrics"))
+    if cfg.experiment.num_shards > 1:
+        metrics.save_snapshot(output_path(cfg, "llm_metrics_snapshot.json"))  # raw counts, merged by merge_shards.py
+    cost_ledger.save(output_path(cfg, "cost_summary.json"))
+
+
+@hydra.main(config_path="./config", config_name="base", version_base="1.3")
+def main(cfg):
+    # Set random seed & create save directory
+    set_seed(cfg.experiment.random_seed)
+    # experiment.resume=<run dir> continues an earlier run in place (with the same overrides), instead of a new Hydra run dir
+    cfg.save_dir = os.path.join(cfg.experiment.resume or HydraConfig.get().run.dir, cfg.save_dir)
+    os.makedirs(cfg.save_dir, exist_ok=True)
+    if cfg.experiment.verbose:
+        print(f"Save directory: {cfg.save_dir}")
+
+    # Load scenarios
+    scenario_loader = ScenarioLoaderMIMICIV(cfg.data_dir, cfg.data.data_file_name, cfg.data.filter)
+    logging.info(f"Load Datasets from {cfg.data_dir}, size: {scenario_loader.num_scenarios}")
+    logging.info(f"""Patient prompt template:\n\t{file_to_string(os.path.join(cfg.prompt_dir, cfg.data.patient_prompt_file + ".txt"))}""")
+    logging.info(f"""Doctor prompt template:\n\t{file_to_string(os.path.join(cfg.prompt_dir, cfg.data.doctor_prompt_file + ".txt"))}""")
+
+    configure_run(cfg)
+
+    # Pipeline for huggingface models
+    num_scenarios = min(cfg.data.num_scenarios, scenario_loader.num_scenarios) if cfg.data.num_scenarios is not None else scenario_loader.num_scenarios
+    dialogue_path = output_path(cfg, "dialogue.jsonl")
+    scenario_ids = range(num_scenarios)
+    if cfg.experiment.num_shards > 1:
+        # This node simulates only the scenarios (hadm_id + persona) hashed to its shard
+        scenario_ids = [scenario_id for scenario_id in scenario_ids if in_shard(cfg, persona_key(cfg, scenario_loader.get_info(id=scenario_id)))]
+        logging.info(f"Shard {cfg.experiment.shard_index} / {cfg.experiment.num_shards}: {len(scenario_ids)} of {num_scenarios} scenario(s)")
+    if cfg.experiment.resume:
+        # Skip the dialogues already saved; interrupted ones continue from their last turn checkpoint
+        completed = load_completed(dialogue_path)
+        left = [scenario_id for scenario_id in scenario_ids if persona_key(cfg, scenario_loader.get_info(id=scenario_id)) not in completed]
+        logging.info(f"Resuming {cfg.save_dir}: {len(scenario_ids) - len(left)} scenario(s) already done, {len(left)} left")
+        scenario_ids = left
+    jobs = [(cfg, scenario_id) for scenario_id in scenario_ids]
+    engine = simulate_lockstep if cfg.experiment.engine == "lockstep" else simulate
+    engine(jobs, scenario_loader, dialogue_path, num_workers=max(1, cfg.experiment.num_workers), max_requeues=cfg.circuit_breaker.max_requeues)
+    log_run_stats(cfg)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import hydra
+import random
+import logging
+import itertools
+from omegaconf import OmegaConf
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from hydra.core.hydra_config import HydraConfig
+from utils import set_seed
+from run_simulation import ScenarioLoaderMIMICIV, PERSONA_FIELDS, persona_key, backend_key, load_completed, configure_run, configure_backends, simulate, simulate_lockstep, output_path, in_shard, log_run_stats
+
+# Prompt file listing the valid values of each persona option
+PERSONA_PROMPTS = {"cefr_type": "cefr_type", "personality_type": "personality_type", "recall_level_option": "recall_level_type", "dazed_level_option": "dazed_level_type"}
+
+
+def expand_grid(cfg):
+    # One config per backend x persona combination. Backends vary fastest, so consecutive jobs spread over the endpoints.
+    options = [option for option, _ in PERSONA_FIELDS]
+    axes = [list(cfg.sweep[option]) if cfg.sweep[option] else [cfg.patient_agent.persona[option]] for option in options]
+    for option, values in zip(options, axes):
+        valid = json.load(open(os.path.join(cfg.prompt_dir, PERSONA_PROMPTS[option] + ".json"), "r"))
+        invalid = [value for value in values if value is not None and value not in valid]
+        if invalid:
+            raise ValueError(f"Invalid sweep.{option} value(s) {invalid}, expected some of {list(valid)}")
+    return [
+        OmegaConf.merge(cfg, backends, {"patient_agent": {"persona": dict(zip(options, values))}})
+        for values in itertools.product(*axes)
+        for backends in cfg.sweep.backends
+    ]
+
+
+def earlier_outputs(path):
+    # dialogue.jsonl of a run dir, or the file itself
+    for candidate in [os.path.join(path, "outputs", "dialogue.jsonl"), os.path.join(path, "dialogue.jsonl")]:
+        if os.path.isfile(candidate):
+            return candidate
+    return path
+
+
+@hydra.main(config_path="./config", config_name="sweep", version_base="1.3")
+def main(cfg):
+    # Set random seed & create save directory
+    set_seed(cfg.experiment.random_seed)
+    cfg.save_dir = os.path.join(cfg.experiment.resume or HydraConfig.get().run.dir, cfg.save_dir)
+    os.makedirs(cfg.save_dir, exist_ok=True)
+    if cfg.experiment.verbose:
+        print(f"Save directory: {cfg.save_dir}")
+
+    # Load scenarios
+    scenario_loader = ScenarioLoaderMIMICIV(cfg.data_dir, cfg.data.data_file_name, cfg.data.filter)
+    num_scenarios = min(cfg.data.num_scenarios, scenario_loader.num_scenarios) if cfg.data.num_scenarios is not None else scenario_loader.num_scenarios
+
+    # Every setting of the run is shared by the whole grid; only the rate limits / fallbacks differ per backend
+    combinations = expand_grid(cfg)
+    configure_run(cfg)
+    for combination in combinations:
+        configure_backends(combination)
+
+    # Expand the grid into jobs. Combinations that resolve to the same dialogue (e.g. an empty axis, where the persona
+    # comes from the profile) are scheduled once.
+    jobs, keys = [], set()
+    for scenario_id in range(num_scenarios):
+        scenario = scenario_loader.get_info(id=scenario_id)
+        for combination in combinations:
+            key = persona_key(combination, scenario) + backend_key(combination)
+            if key not in keys:
+                keys.add(key)
+                jobs.append((key, combination, scenario_id))
+    num_grid = len(combinations) * num_scenarios
+    if cfg.experiment.num_shards > 1:
+        # This node runs only the jobs (hadm_id + persona + backends) hashed to its shard; the sample is drawn from them
+        jobs = [job for job in jobs if in_shard(cfg, job[0])]
+    if cfg.sweep.sample is not None and cfg.sweep.sample < len(jobs):
+        # Drawn with the experiment seed, so a resumed sweep draws the same jobs
+        jobs = [jobs[index] for index in sorted(random.Random(cfg.experiment.random_seed).sample(range(len(jobs)), cfg.sweep.sample))]
+
+    # Skip the jobs simulated by earlier runs (and by this one, when resumed)
+    dialogue_path = output_path(cfg, "dialogue.jsonl")
+    completed = load_completed(dialogue_path, with_backends=True)
+    for path in cfg.sweep.skip_outputs:
+        completed |= load_completed(earlier_outputs(path), with_backends=True, repair=False)
+    todo = [(combination, scenario_id) for key, combination, scenario_id in jobs if key not in completed]
+    logging.info(
+        f"Sweep: {len(combinations)} combination(s) x {num_scenarios} scenario(s) = {num_grid} job(s), "
+        f"{num_grid - len(keys)} duplicate(s), {len(keys) - len(jobs)} in other shards or left out by sampling, "
+        f"{len(jobs) - len(todo)} already simulated, {len(todo)} to run"
+    )
+
+    # One executor (and client pool) for the whole grid
+    engine = simulate_lockstep if cfg.experiment.engine == "lockstep" else simulate
+    engine(todo, scenario_loader, dialogue_path, num_workers=max(1, cfg.experiment.num_workers), max_requeues=cfg.circuit_breaker.max_requeues)
+    log_run_stats(cfg)
+
+
+if __name__ == "__main__":
+    main()
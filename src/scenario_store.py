@@ -0,0 +1,151 @@
+import os
+import json
+import copy
+import logging
+import argparse
+import threading
+
+# Fields kept in the index (when present in the profiles): enough to look up and filter scenarios, and to compute
+# their persona key, without decoding the records
+INDEX_FIELDS = ["hadm_id", "diagnosis", "split", "cefr", "personality", "recall_level", "dazed_level"]
+INDEX_VERSION = 1
+
+
+def normalize_id(hadm_id):
+    # hadm_ids are stored as int, float or str depending on the source
+    try:
+        return str(int(float(hadm_id)))
+    except (TypeError, ValueError):
+        return str(hadm_id)
+
+
+class ScenarioStore:
+    """Patient profiles with a hadm_id index and lazy per-record decoding.
+
+    A `.jsonl` file is read record by record: only the byte offsets and INDEX_FIELDS of each line are kept in memory
+    (cached next to the file as `<file>.index.json`), and get() decodes one line. A `.json` list is loaded whole and
+    served from memory. Every record is returned as a new dict, so callers can modify it.
+    """
+
+    def __init__(self, path, entries=None, records=None):
+        self.path = path
+        self.records = records  # decoded profiles (.json list), None for .jsonl
+        self.entries = entries if entries is not None else self.load_index()  # [(offset or position, length, fields)]
+        self.positions = {}
+        for i, entry in enumerate(self.entries):
+            self.positions.setdefault(entry[2]["hadm_id"], i)  # the first profile of a repeated hadm_id, like get_profile
+        self.lock = threading.Lock()
+        self.file = None
+
+    @classmethod
+    def open(cls, data_dir, data_name):
+        # <data_name>.jsonl when it exists (see `python scenario_store.py` to convert), else <data_name>.json
+        path = os.path.join(data_dir, f"{data_name}.jsonl")
+        if os.path.exists(path):
+            return cls(path)
+        path = os.path.join(data_dir, f"{data_name}.json")
+        with open(path, "r") as f:
+            records = json.load(f)
+        return cls(path, [(i, 0, cls.index_fields(record)) for i, record in enumerate(records)], records)
+
+    @staticmethod
+    def index_fields(record):
+        fields = {field: record[field] for field in INDEX_FIELDS if field in record}
+        fields["hadm_id"] = normalize_id(record["hadm_id"])
+        return fields
+
+    def load_index(self):
+        # Reuses the cached index while the file is unchanged; otherwise scans the file once and caches the index
+        index_path = self.path + ".index.json"
+        stat = os.stat(self.path)
+        signature = {"version": INDEX_VERSION, "size": stat.st_size, "mtime": stat.st_mtime}
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            if index["signature"] == signature:
+                return [tuple(entry) for entry in index["entries"]]
+        entries = []
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    entries.append((offset, len(line), self.index_fields(json.loads(line))))
+                offset += len(line)
+        try:
+            with open(index_path + ".tmp", "w") as f:
+                json.dump({"signature": signature, "entries": entries}, f)
+            os.replace(index_path + ".tmp", index_path)
+        except OSError as e:
+            logging.warning(f"Could not cache the scenario index at {index_path}: {e}")
+        return entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, position):
+        # The profile at this position (in file order, or in the order of a filtered store)
+        offset, length, _ = self.entries[position]
+        if self.records is not None:
+            return copy.deepcopy(self.records[offset])
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "rb")
+            self.file.seek(offset)
+            line = self.file.read(length)
+        return json.loads(line)
+
+    def __getstate__(self):
+        # Picklable for multiprocessing workers, which reopen the file
+        state = self.__dict__.copy()
+        state["lock"], state["file"] = None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def ids(self):
+        return [entry[2]["hadm_id"] for entry in self.entries]
+
+    def info(self, position):
+        # Indexed fields of the profile at this position, without decoding it
+        return dict(self.entries[position][2])
+
+    def get(self, hadm_id):
+        # The profile with this hadm_id, or None
+        position = self.positions.get(normalize_id(hadm_id))
+        return self[position] if position is not None else None
+
+    def filter(self, **conditions):
+        # A store restricted to the profiles whose indexed fields match, e.g. filter(split="info", diagnosis=[...]).
+        # Evaluated on the index: no record is decoded.
+        for field in conditions:
+            assert field in INDEX_FIELDS, f"Can only filter on the indexed fields {INDEX_FIELDS}, not {field}"
+        conditions = {field: [value] if isinstance(value, (str, int, float)) else list(value) for field, value in conditions.items()}
+        if "hadm_id" in conditions:
+            conditions["hadm_id"] = [normalize_id(value) for value in conditions["hadm_id"]]
+        entries = [entry for entry in self.entries if all(entry[2].get(field) in values for field, values in conditions.items())]
+        return ScenarioStore(self.path, entries, self.records)
+
+
+def main(args):
+    # Converts a profile list (.json) to .jsonl and builds its index
+    source = os.path.join(args.data_dir, f"{args.data_file_name}.json")
+    target = os.path.join(args.data_dir, f"{args.data_file_name}.jsonl")
+    assert not os.path.exists(target), f"{target} exists"
+    with open(source, "r") as f:
+        records = json.load(f)
+    with open(target, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    store = ScenarioStore(target)
+    print(f"Wrote {len(store)} profiles to {target} (index: {target}.index.json)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a patient profile list to an indexed JSONL scenario store")
+    parser.add_argument("--data_dir", type=str, default="./data/final_data")
+    parser.add_argument("--data_file_name", type=str, default="patient_profile")
+
+    args = parser.parse_args()
+    main(args)
@@ -1,12 +1,10 @@
 import os
 import re
-import yaml
 import json
-import torch
 import random
+import hashlib
+import threading
 import logging
-import jsonlines
-import numpy as np
 
 
 def prompt_valid_check(prompt, data_dict):
@@ -21,18 +19,55 @@ def find_missing_keys(format_string, data):
     return [key for key in keys if key not in data]
 
 
-def check_all_patterns_present(text):
-    patterns = [r"1\..*", r"2\..*", r"3\..*", r"4\..*", r"5\..*"]
-    return all(re.search(pattern, text) for pattern in patterns)
+# Phrases that open a doctor's differential diagnosis (matched case-insensitively)
+DDX_KEYS = ["ddx ready:", "my top 5", "here are my top", "[ddx]", "[ddx", "here are some potential concerns we need to consider", "ddx:", 
+            "differential diagnoses", "top 5 likely diagnoses", "[pddx]", "most likely possibilities", "top 5 possibilities", "top 5 likely diagnoses", "top possibilities"]
+# Without the keys that contain another key (e.g. "[ddx]" contains "[ddx"): they can never decide a match
+TERMINATION_KEYS = sorted({key for key in DDX_KEYS if not any(other != key and other in key for other in DDX_KEYS)})
+DDX_ITEMS = ["1.", "2.", "3.", "4.", "5."]
 
 
 def detect_termination(response):
-    end_flag = False
-    ddx_key = ["ddx ready:", "my top 5", "here are my top", "[ddx]", "[ddx", "here are some potential concerns we need to consider", "ddx:", 
-               "differential diagnoses", "top 5 likely diagnoses", "[pddx]", "most likely possibilities", "top 5 possibilities", "top 5 likely diagnoses", "top possibilities"]
-    all_present = check_all_patterns_present(response)
-    end_flag = any(key.lower() in response.lower() for key in ddx_key)
-    return all_present or end_flag
+    # The doctor ends the dialogue with a DDX phrase, or with a list numbered 1. to 5.
+    text = response.lower()
+    return any(key in text for key in TERMINATION_KEYS) or all(item in response for item in DDX_ITEMS)
+
+
+class TerminationDetector:
+    """detect_termination over a reply that arrives in pieces (a streamed doctor turn).
+
+    feed() checks each delta together with the end of the text seen so far (so phrases split across deltas are found),
+    which keeps the cost per delta constant instead of rescanning the whole reply. It returns True once the DDX list is
+    complete: after a DDX phrase, a line starting with item `top_k` (e.g. "5. Pneumonia") has ended.
+    """
+
+    def __init__(self, top_k=5):
+        self.last_item = re.compile(rf"^[ \t]*{top_k}\.[ \t]+\S[^\n]*\n", re.MULTILINE)
+        self.overlap = max(len(key) for key in TERMINATION_KEYS) - 1
+        self.tail = ""
+        self.items = set()
+        self.terminated = False
+        self.listing = None  # text after the DDX phrase, once it has been seen
+        self.complete = False
+
+    def feed(self, delta):
+        if self.complete or not delta:
+            return self.complete
+        if self.listing is not None:
+            self.listing += delta
+        else:
+            text = self.tail + delta
+            lowered = text.lower()
+            self.items.update(item for item in DDX_ITEMS if item in text)
+            ends = [lowered.find(key) + len(key) for key in TERMINATION_KEYS if key in lowered]
+            if ends:
+                self.listing = text[min(ends):]
+            self.terminated = self.terminated or bool(ends) or len(self.items) == len(DDX_ITEMS)
+            self.tail = text[-self.overlap:]
+        # Only the list items written on their own lines after the phrase count, not e.g. "stage 5." or "150/95."
+        if self.listing is not None and "\n" in delta:
+            self.complete = self.last_item.search(self.listing) is not None
+        return self.complete
 
 
 def process_string(input_string):
@@ -46,6 +81,8 @@ def process_string(input_string):
 
 
 def load_config(yaml_file):
+    import yaml
+
     with open(yaml_file, "r") as file:
         config = yaml.safe_load(file)
     return config
@@ -63,6 +100,8 @@ def load_json(filename):
 
 
 def load_jsonl(filename):
+    import jsonlines
+
     with jsonlines.open(filename, "r") as file:
         data_list = [line for line in file]
     return data_list
@@ -79,8 +118,14 @@ def save_to_jsonl(data_list, save_path):
             f.write(json.dumps(req, ensure_ascii=False) + "\n")
 
 
+_dialogue_lock = threading.Lock()
+
+
 def save_to_dialogue(data, output_file):
-    with jsonlines.open(output_file, mode="a") as writer:
+    import jsonlines
+
+    # One writer at a time, so concurrent dialogues never interleave their lines
+    with _dialogue_lock, jsonlines.open(output_file, mode="a") as writer:
         writer.write(data)
 
 
@@ -90,6 +135,26 @@ def get_profile(scenario_dict, trg_id):
             return profile
 
 
+def record_key(record, with_backends=False):
+    # hadm_id and persona of a dialogue record (plus the patient / doctor backends)
+    key = (str(record["hadm_id"]), record["cefr_type"], record["personality_type"], record["recall_level_type"], record["dazed_level_type"])
+    return key + (record["patient_engine_name"], record["doctor_engine_name"]) if with_backends else key
+
+
+def shard_of(key, num_shards):
+    # Stable shard of a key: a hash of its values (unlike hash(), the same in every process and on every machine)
+    digest = hashlib.sha1("\x1f".join(str(value) for value in key).encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def shard_path(path, shard_index, num_shards):
+    # Output file of one shard: <name>.shard-<i>-of-<n>[.json|.jsonl] (the path itself when the run is not sharded)
+    if num_shards <= 1:
+        return path
+    ext = next((ext for ext in (".jsonl", ".json") if path.endswith(ext)), "")
+    return f"{path[: len(path) - len(ext)]}.shard-{shard_index}-of-{num_shards}{ext}"
+
+
 def log_and_print(message):
     """Logs a message to both the console and a log file."""
     print(message)  # Print to console
@@ -97,8 +162,15 @@ def log_and_print(message):
 
 
 def set_seed(seed):
+    # numpy / torch are imported here rather than at module level to keep startup fast
+    import numpy as np
+
     random.seed(seed)
     np.random.seed(seed)
+    try:
+        import torch
+    except ImportError:  # torch is only needed by the embedding-based evaluation
+        return
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
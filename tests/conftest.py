@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other from src/ (as the scripts do with sys.path.append)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
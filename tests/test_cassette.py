@@ -0,0 +1,84 @@
+import pytest
+
+from agent.doctor_agent import DoctorAgent
+from llm_client.cassette import Cassette, CassetteMissError, configure_cassette
+from llm_client.response_cache import configure_cache
+from models import get_answer, get_response_method
+
+
+@pytest.mark.parametrize("name", ["calls.jsonl", "calls.jsonl.gz"])
+def test_record_replaces_an_existing_cassette(tmp_path, name):
+    path = str(tmp_path / name)
+    Cassette(path).record("key", "mock", "mock", {"text": "old"}, 0.1)
+    Cassette(path).record("key", "mock", "mock", {"text": "new"}, 0.1)
+    record, _ = Cassette(path, mode="replay").replay("key")
+    assert record == {"text": "new"}
+
+
+def test_append_keeps_the_recorded_calls(tmp_path):
+    path = str(tmp_path / "calls.jsonl")
+    Cassette(path).record("first", "mock", "mock", {"text": "a"}, 0.1)
+    Cassette(path, mode="append").record("second", "mock", "mock", {"text": "b"}, 0.1)
+    cassette = Cassette(path, mode="replay")
+    assert cassette.replay("first")[0] == {"text": "a"}
+    assert cassette.replay("second")[0] == {"text": "b"}
+
+
+def test_replay_order_and_misses(tmp_path):
+    path = str(tmp_path / "calls.jsonl")
+    cassette = Cassette(path)
+    for text in ["a", "b"]:
+        cassette.record("key", "mock", "mock", {"text": text}, 0.1)
+    cassette = Cassette(path, mode="replay", replay_latency=True)
+    assert cassette.replay("key") == ({"text": "a"}, 0.1)
+    assert cassette.replay("key") == ({"text": "b"}, 0.1)
+    assert cassette.replay("key") == ({"text": "b"}, 0.1)  # repeated beyond the recording: the last answer again
+    with pytest.raises(CassetteMissError):
+        cassette.replay("other")
+
+
+@pytest.fixture
+def mock_calls(monkeypatch):
+    from llm_client.mock_backend import MOCK_CONFIG
+
+    monkeypatch.setitem(MOCK_CONFIG, "latency_median", 0.0)
+    yield
+    configure_cassette(None)
+    configure_cache(None)
+
+
+def test_record_with_the_cache_on_then_replay(tmp_path, mock_calls):
+    path = str(tmp_path / "calls.jsonl")
+    ask = get_response_method("mock")
+    message = [{"role": "user", "content": "Summarize the findings."}]
+    configure_cache(str(tmp_path / "cache.sqlite"))
+    answer = get_answer(ask(message, model="mock-judge"))
+
+    # Served from the cache, but the cassette still has to get it
+    configure_cassette(path, mode="record")
+    assert get_answer(ask(message, model="mock-judge")) == answer
+    configure_cache(None)
+    configure_cassette(path, mode="replay")
+    assert get_answer(ask(message, model="mock-judge")) == answer
+
+
+def stream_ddx(prompt_dir):
+    # One streamed doctor turn that ends with the DDX, stopped once the list is complete
+    doctor = DoctorAgent(backend_str="mock-doctor", backend_api_type="mock", prompt_dir=str(prompt_dir), prompt_file="doctor", stop_at_ddx=True)
+    deltas = doctor.inference_stream("This is the final turn, please give your diagnosis.")
+    while True:
+        try:
+            next(deltas)
+        except StopIteration as stop:
+            return stop.value
+
+
+def test_streamed_ddx_record_then_replay(tmp_path, mock_calls):
+    path = str(tmp_path / "calls.jsonl")
+    (tmp_path / "doctor.txt").write_text("You are playing the role of a kind and patient doctor. Turn {curr_idx} of {total_idx}.")
+    configure_cassette(path, mode="record")
+    answer = stream_ddx(tmp_path)
+    assert answer.splitlines()[-1].startswith("5. ")  # cut off after the list
+
+    configure_cassette(path, mode="replay")
+    assert stream_ddx(tmp_path) == answer
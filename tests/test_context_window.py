@@ -0,0 +1,53 @@
+from llm_client.context_window import ContextPolicy, count_tokens
+
+HISTORY = [
+    {"role": "system", "content": "You are a doctor."},
+    {"role": "assistant", "content": "Hello, how can I help you?"},
+    {"role": "user", "content": "I have had a cough for three days."},
+    {"role": "assistant", "content": "Do you have a fever?"},
+    {"role": "user", "content": "Yes, since yesterday."},
+]
+
+
+def policy_with_budget(budget, strategy="truncate"):
+    # The mock model has a 131072-token window; the reserve leaves `budget` tokens for the prompt
+    return ContextPolicy(strategy=strategy, reserve_tokens=131072 - 64 - budget, summary_tokens=0)
+
+
+def test_under_budget_history_is_unchanged():
+    for strategy in ["truncate", "summarize"]:
+        message, dropped = policy_with_budget(10000, strategy).fit(HISTORY, "mock", "mock", caller="test")
+        assert message == HISTORY
+        assert dropped == []
+
+
+def test_over_budget_history_drops_oldest_turns_and_starts_on_user():
+    budget = count_tokens(HISTORY[:1] + HISTORY[-2:], "mock", "mock")
+    message, dropped = policy_with_budget(budget).fit(HISTORY, "mock", "mock", caller="test")
+    assert message[0] == HISTORY[0]
+    assert message[1]["role"] == "user"
+    assert message[-1] == HISTORY[-1]
+    assert dropped == HISTORY[1 : 1 + len(dropped)]
+    assert len(message) + len(dropped) == len(HISTORY)
+
+
+def test_keep_last_turns():
+    message, dropped = ContextPolicy(keep_last_turns=3).fit(HISTORY, "mock", "mock", caller="test")
+    assert message == [HISTORY[0]] + HISTORY[-3:]
+    assert dropped == HISTORY[1:2]
+    # The kept history never starts on an assistant turn cut from its question
+    message, dropped = ContextPolicy(keep_last_turns=2).fit(HISTORY, "mock", "mock", caller="test")
+    assert message == [HISTORY[0], HISTORY[-1]]
+
+
+def test_summaries_are_bounded(monkeypatch):
+    import models
+
+    monkeypatch.setattr(models, "MAX_SUMMARIES", 3)
+    monkeypatch.setattr(models, "_summaries", models.OrderedDict())
+    for i in range(3):
+        models.put_summary(i, f"summary {i}")
+    assert models.get_summary(0) == "summary 0"  # now the most recently used
+    models.put_summary(3, "summary 3")
+    assert list(models._summaries) == [2, 0, 3]
+    assert models.get_summary(1) is None
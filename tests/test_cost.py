@@ -0,0 +1,38 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_client.cost import CostLedger, current_scenario
+
+LABELS = {"caller": "patient", "backend": "mock", "model": "mock-patient"}
+JOBS = [("1000", "B", "plain", "low", "normal", "mock-patient", "mock-doctor"), ("1000", "B", "verbose", "low", "normal", "mock-patient", "mock-doctor")]
+
+
+def record_calls(ledger, job, prompt_tokens, calls):
+    context = contextvars.copy_context()
+    context.run(current_scenario.set, job)
+    for _ in range(calls):
+        context.run(ledger.record, LABELS, prompt_tokens, 1)
+
+
+def test_concurrent_jobs_of_one_hadm_id_are_costed_apart():
+    ledger = CostLedger()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda args: record_calls(ledger, *args), [(JOBS[0], 10, 50), (JOBS[1], 100, 50)]))
+    assert ledger.job_cost(JOBS[0])["prompt_tokens"] == 500
+    assert ledger.job_cost(JOBS[1])["prompt_tokens"] == 5000
+    # The summary aggregates the jobs per hadm_id
+    summary = ledger.summary()
+    assert summary["by_scenario"]["1000"]["prompt_tokens"] == 5500
+    assert summary["by_scenario"]["1000"]["calls"] == 100
+
+
+def test_merge_keeps_jobs():
+    ledger = CostLedger()
+    record_calls(ledger, JOBS[0], 10, 2)
+    record_calls(ledger, "1001", 20, 1)  # a plain hadm_id, as set by the evaluation scripts
+    merged = CostLedger()
+    merged.merge(ledger.summary())
+    merged.merge(ledger.summary())
+    assert merged.job_cost(JOBS[0])["prompt_tokens"] == 40
+    assert merged.job_cost("1001")["prompt_tokens"] == 40
+    assert merged.summary()["by_scenario"] == {"1000": merged.job_cost(JOBS[0]), "1001": merged.job_cost("1001")}
@@ -0,0 +1,28 @@
+from llm_client.circuit_breaker import configure_fallback, get_fallback
+from models import use_fallback
+
+
+def test_fallbacks_are_kept_per_backend():
+    # Two backend combinations of a sweep, configured one after the other
+    configure_fallback("patient", "vllm", "meta-llama/Llama-3.3-70B-Instruct", "gpt_azure", "gpt-4o")
+    configure_fallback("patient", "vllm", "Qwen/Qwen2.5-72B-Instruct", "genai", "gemini-2.5-flash")
+    try:
+        assert get_fallback("patient", "vllm", "meta-llama/Llama-3.3-70B-Instruct") == ("gpt_azure", "gpt-4o")
+        assert get_fallback("patient", "vllm", "Qwen/Qwen2.5-72B-Instruct") == ("genai", "gemini-2.5-flash")
+        assert get_fallback("doctor", "vllm", "Qwen/Qwen2.5-72B-Instruct") is None
+
+        call_info = {}
+        assert use_fallback("vllm", "Qwen/Qwen2.5-72B-Instruct", "patient", call_info) == ("genai", "gemini-2.5-flash")
+        assert call_info["fallback_model"] == "gemini-2.5-flash"
+    finally:
+        configure_fallback("patient", "vllm", "meta-llama/Llama-3.3-70B-Instruct")
+        configure_fallback("patient", "vllm", "Qwen/Qwen2.5-72B-Instruct")
+    assert get_fallback("patient", "vllm", "meta-llama/Llama-3.3-70B-Instruct") is None
+
+
+def test_no_fallback_on_the_same_api_type():
+    configure_fallback("doctor", "gpt_azure", "gpt-4o", "gpt_azure", "gpt-4o-mini")
+    try:
+        assert use_fallback("gpt_azure", "gpt-4o", "doctor", None) is None  # rejected by the same breaker
+    finally:
+        configure_fallback("doctor", "gpt_azure", "gpt-4o")
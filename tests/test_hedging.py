@@ -0,0 +1,76 @@
+import time
+import threading
+
+from llm_client.hedging import HedgePolicy
+from llm_client.load_balancer import EndpointPool, current_session
+
+SLOW, FAST = "http://slow:8000/v1", "http://fast:8000/v1"
+
+
+def make_policy(**kwargs):
+    policy = HedgePolicy(enabled=True, min_delay=0.05, max_extra_load=1.0, min_samples=1, **kwargs)
+    policy.observe(("vllm", "model"), 0.01)
+    return policy
+
+
+def routed_send(pool, calls, release):
+    # A request to the slow replica hangs until released
+    def send():
+        with pool.route(current_session.get()) as base_url:
+            calls.append(base_url)
+            if base_url == SLOW:
+                release.wait(5)
+            return base_url
+
+    return send
+
+
+def sticky_pool():
+    pool = EndpointPool("model", [SLOW, FAST], probe_interval=0)
+    pool.sessions["dialogue"] = pool.replicas[0]  # the conversation is pinned to the slow replica
+    return pool
+
+
+def test_hedge_goes_to_another_endpoint():
+    pool, calls, release = sticky_pool(), [], threading.Event()
+    current_session.set("dialogue")
+    try:
+        assert make_policy().call("vllm", "model", routed_send(pool, calls, release), num_endpoints=2) == FAST
+        assert calls == [SLOW, FAST]
+    finally:
+        release.set()
+        current_session.set(None)
+
+
+def test_single_endpoint_is_not_hedged():
+    calls = []
+
+    def send():
+        calls.append(1)
+        time.sleep(0.2)
+        return "ok"
+
+    policy = make_policy()
+    assert policy.call("gpt_azure", "model", send, num_endpoints=1) == "ok"
+    assert calls == [1]
+    assert policy.hedges == 0
+
+
+def test_running_losers_are_capped():
+    pool, calls, release = sticky_pool(), [], threading.Event()
+    policy = make_policy(max_losers=1)
+    current_session.set("dialogue")
+    try:
+        assert policy.call("vllm", "model", routed_send(pool, calls, release), num_endpoints=2) == FAST
+        assert policy.losers == 1  # the primary is still hanging on the slow replica
+        pool.sessions["dialogue"] = pool.replicas[0]
+        started = time.monotonic()
+        threading.Timer(0.3, release.set).start()
+        assert policy.call("vllm", "model", routed_send(pool, calls, release), num_endpoints=2) == SLOW  # not hedged
+        assert time.monotonic() - started >= 0.25
+        assert policy.hedges == 1
+    finally:
+        release.set()
+        current_session.set(None)
+    time.sleep(0.1)
+    assert policy.losers == 0
@@ -0,0 +1,25 @@
+import os
+import sys
+import statistics
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+BUDGET_MS = 150.0
+NUM_RUNS = 5
+# Backend SDKs and torch are imported on first use, never by `import models, utils`
+HEAVY_MODULES = ["torch", "openai", "google.genai"]
+
+
+def run_import(code):
+    # A fresh interpreter per run, so nothing is already in sys.modules
+    return subprocess.check_output([sys.executable, "-c", f"import sys, time; t = time.perf_counter(); import models, utils; {code}"], cwd=SRC_DIR, text=True)
+
+
+def test_import_time_budget():
+    timings = [float(run_import("print(time.perf_counter() - t)")) * 1000 for _ in range(NUM_RUNS)]
+    assert statistics.median(timings) < BUDGET_MS, f"import models, utils: {sorted(timings)} ms"
+
+
+def test_no_heavy_modules_at_import():
+    loaded = run_import(f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))").split()
+    assert loaded == []
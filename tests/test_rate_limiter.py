@@ -0,0 +1,21 @@
+from llm_client.rate_limiter import RateLimiter, DEFAULT_COMPLETION_TOKENS
+from models import completion_budget
+
+
+def test_completion_estimate_follows_observed_replies():
+    limiter = RateLimiter(tpm=30000)
+    assert completion_budget(limiter) == DEFAULT_COMPLETION_TOKENS
+    assert completion_budget(limiter, max_tokens=100) == 100
+    for completion_tokens in [40, 60, 80]:
+        limiter.record_usage(1000, 1000 + completion_tokens, completion_tokens)
+    assert completion_budget(limiter) == 60
+    assert completion_budget(limiter, max_completion_tokens=50) == 50
+
+
+def test_reservation_is_reconciled_with_usage():
+    limiter = RateLimiter(tpm=30000)
+    assert limiter.reserve(1256) == 0.0
+    limiter.record_usage(1256, 1060, 60)
+    assert round(limiter.tokens.level) == 30000 - 1060
+    # Calls well under the TPM budget are not delayed by the registry max_tokens (e.g. 16384 for gpt-4o)
+    assert all(limiter.reserve(1000 + completion_budget(limiter)) == 0.0 for _ in range(20))
@@ -0,0 +1,32 @@
+import sqlite3
+
+from llm_client.response_cache import ResponseCache
+
+
+def table_size(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+def test_total_size_follows_inserts_replacements_and_evictions(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path, max_size_mb=0.01)  # about 10 kB
+    for i in range(200):
+        cache.put(f"key-{i}", {"text": "x" * 100})
+        cache.put(f"key-{i}", {"text": "y" * (50 + i % 7)})  # replaced with a record of another size
+        assert cache.total_size(cache.connect()) == table_size(path)
+    assert table_size(path) <= cache.max_size
+    assert cache.get("key-199") == {"text": "y" * (50 + 199 % 7)}
+    assert cache.get("key-0") is None  # least recently used, evicted
+
+
+def test_existing_cache_gets_its_total(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    with sqlite3.connect(path) as conn:  # a cache written before the total was kept
+        conn.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, record TEXT, size INTEGER, created REAL, accessed REAL)")
+        conn.execute("INSERT INTO responses VALUES ('old', '{}', 1234, 0, 0)")
+    cache = ResponseCache(path)
+    assert cache.total_size(cache.connect()) == 1234
+    cache.put("new", {"text": "a"})
+    assert cache.total_size(cache.connect()) == table_size(path)
+    assert cache.get("old") == {}
@@ -0,0 +1,57 @@
+import pytest
+
+from llm_client.retry import RetryPolicy, classify_error
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+class RemoteProtocolError(Exception):
+    pass
+
+
+@pytest.mark.parametrize(
+    "error, error_class",
+    [
+        (StatusError(429), "rate_limit"),
+        (StatusError(503), "server"),
+        (StatusError(400), "bad_request"),
+        (StatusError(401), "auth"),
+        (TimeoutError("read timed out"), "timeout"),
+        (ConnectionResetError("reset by peer"), "connection"),
+        (RemoteProtocolError("peer closed connection"), "connection"),
+        (KeyError("choices"), "bad_request"),
+        (AttributeError("'NoneType' object has no attribute 'content'"), "unknown"),
+    ],
+)
+def test_classify_error(error, error_class):
+    assert classify_error(error) == error_class
+
+
+def failing(errors):
+    calls = []
+
+    def send(message):
+        calls.append(message)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return send, calls
+
+
+def test_transient_errors_are_retried():
+    send, calls = failing([StatusError(503), StatusError(429)])
+    assert RetryPolicy(base_delay=0.0).call(send, "hi") == "ok"
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize("error", [AttributeError("no attribute"), TypeError("bad argument"), KeyError("choices"), RuntimeError("bug")])
+def test_programming_errors_are_not_retried(error):
+    send, calls = failing([error])
+    with pytest.raises(type(error)):
+        RetryPolicy(base_delay=0.0).call(send, "hi")
+    assert len(calls) == 1
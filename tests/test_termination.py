@@ -0,0 +1,85 @@
+import re
+import random
+
+import pytest
+
+from utils import detect_termination, TerminationDetector
+
+
+def stream(text, top_k=5, split=r"[^\S\n]*\S+|\n+"):
+    # Feeds the text to a detector word by word; returns the text received when it stopped, and the detector
+    detector = TerminationDetector(top_k)
+    received = ""
+    for delta in re.findall(split, text):
+        received += delta
+        if detector.feed(delta):
+            break
+    return received, detector
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Thank you. [DDX] 1. A 2. B 3. C 4. D 5. E", True),
+        ("What brings you in today?", False),
+        ("1. Cough 2. Fever 3. Chills 4. Fatigue", False),
+        ("1. a\n2. b\n3. c\n4. d\n5. e", True),
+        ("Here are my top five", True),
+        ("DIFFERENTIAL DIAGNOSES: Pneumonia", True),
+        ("[Ddx ready", True),
+    ],
+)
+def test_detect_termination(text, expected):
+    assert detect_termination(text) == expected
+
+
+def test_detector_matches_detect_termination_on_any_split():
+    rng = random.Random(0)
+    alphabet = list("12345. [dx]ytop DDXmyhere:\n") + ["[ddx]", "top 5 possibilities", "1.", "5."]
+    for _ in range(2000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        detector, i = TerminationDetector(), 0
+        while i < len(text):
+            size = rng.randint(1, 4)
+            detector.feed(text[i : i + size])
+            i += size
+        assert detector.terminated == detect_termination(text), text
+
+
+def test_stops_after_last_item_line():
+    text = "Thanks.\n[DDX]\n1. Pneumonia\n2. Sepsis\n3. PE\n4. ACS\n5. GERD\n\nThese are based on what you told me."
+    received, detector = stream(text)
+    assert detector.complete
+    assert received.rstrip() == text[: text.index("\n\nThese")]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # a number before the DDX phrase
+        "Your blood pressure is 150/95.\n[DDX]\n1. Hypertension\n2. CKD\n3. AKI\n4. Diabetes\n5. Anemia\nPlease follow up.",
+        # "5." inside an item
+        "[DDX]\n1. CKD stage 5.\n2. AKI\n3. Sepsis\n4. Anemia\n5. Hyperkalemia\nPlease follow up.",
+        # decimals
+        "[DDX]\n1. Hb 5.5 g/dL suggests anemia\n2. AKI\n3. Sepsis\n4. CKD\n5. Dehydration\nPlease follow up.",
+    ],
+)
+def test_numbers_inside_the_reply_do_not_end_the_list(text):
+    received, detector = stream(text)
+    assert detector.complete
+    assert received.rstrip() == text[: text.index("\nPlease")]
+
+
+def test_list_on_one_line_is_not_cut_off():
+    text = "[DDX] 1. A 2. B 3. C 4. D 5. E. These are my thoughts."
+    received, detector = stream(text)
+    assert received == text
+    assert detector.terminated and not detector.complete
+
+
+def test_top_k():
+    text = "[DDX]\n" + "".join(f"{i}. Diagnosis {i}\n" for i in range(1, 11)) + "Done."
+    received, _ = stream(text, top_k=10)
+    assert received.endswith("10. Diagnosis 10\n")
+    received, _ = stream(text, top_k=3)
+    assert received.endswith("3. Diagnosis 3\n")